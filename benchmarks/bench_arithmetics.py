@@ -0,0 +1,126 @@
+"""
+Benchmarks for generating arithmetic expressions and treebanks,
+computing their solutions and intermediate targets, and converting
+treebanks to input data for the sequential training architectures.
+
+Run python bench_arithmetics.py -h for usage. The size of a
+benchmark is the number of expressions processed by one run.
+"""
+
+from __future__ import print_function
+from processing_arithmetics.arithmetics.MathExpression import MathExpression
+from processing_arithmetics.arithmetics.MathTreebank import MathTreebank
+from harness import main
+import numpy as np
+
+digits = np.arange(-10, 11)
+operators = ['+', '-']
+languages = ['L1', 'L3', 'L5', 'L7', 'L9', 'L9_left', 'L9_right']
+mixed = dict([('L%i' % length, 1) for length in xrange(1, 10)])
+classifiers = ['intermediate_locally', 'intermediate_recursively', 'subtracting', 'grammatical',
+               'depth', 'minus1depth', 'switch_mode']
+
+
+def mixed_treebank(size):
+    """
+    Treebank with size expressions of lengths 1 to 9.
+    """
+    return MathTreebank(dict([(name, max(size / len(mixed), 1)) for name in mixed]), digits=digits)
+
+
+def generate_me(length):
+    def setup(size):
+        digit_strs = [str(digit) for digit in digits]
+
+        def run():
+            return [MathExpression.generateME(length, operators, digit_strs) for _ in xrange(size)]
+        return run, size
+    return setup
+
+
+def construct_treebank(language):
+    def setup(size):
+        def run():
+            return MathTreebank({language: size}, digits=digits)
+        return run, size
+    return setup
+
+
+def solve(method, **kwargs):
+    def setup(size):
+        treebank = mixed_treebank(size)
+
+        def run():
+            return [getattr(expression, method)(**kwargs) for expression, answer in treebank.examples]
+        return run, len(treebank.examples)
+    return setup
+
+
+def get_targets(size):
+    treebank = mixed_treebank(size)
+
+    def run():
+        for expression, answer in treebank.examples:
+            expression.get_targets('infix', *classifiers)
+    return run, len(treebank.examples)
+
+
+# architectures are built once and reused for all sizes
+_architectures = {}
+
+
+def architecture(name):
+    if name in _architectures:
+        return _architectures[name]
+
+    from processing_arithmetics.sequential.architectures import ScalarPrediction, ComparisonTraining, \
+        Seq2Seq, DiagnosticClassifier, DCgates, DiagnosticTrainer
+    from keras.layers import GRU
+
+    def generate(training):
+        training.generate_model(recurrent_layer=GRU, input_length=40, input_size=2, size_hidden=3)
+        return training
+
+    cls = {'ScalarPrediction': ScalarPrediction, 'ComparisonTraining': ComparisonTraining, 'Seq2Seq': Seq2Seq,
+           'DiagnosticClassifier': DiagnosticClassifier, 'DCgates': DCgates,
+           'DiagnosticTrainer': DiagnosticTrainer}[name]
+    if name in ['ScalarPrediction', 'ComparisonTraining', 'Seq2Seq']:
+        training = generate(cls(digits=digits, operators=operators))
+    else:
+        model = architecture('ScalarPrediction').model
+        training = cls(digits=digits, operators=operators, model=model,
+                       classifiers=['intermediate_locally', 'subtracting'])
+        if name == 'DiagnosticTrainer':
+            generate(training)
+
+    # no profiling overhead in benchmarks
+    training.profiler = None
+    _architectures[name] = training
+    return training
+
+
+def data_from_treebank(name):
+    def setup(size):
+        training = architecture(name)
+        treebank = mixed_treebank(size)
+
+        def run():
+            return training.data_from_treebank(treebank)
+        return run, len(treebank.examples)
+    return setup
+
+
+benchmarks = [('generateME[L%i]' % length, generate_me(length)) for length in [1, 3, 5, 7, 9]] + \
+             [('MathTreebank[%s]' % language, construct_treebank(language)) for language in languages] + \
+             [('solve', solve('solve')),
+              ('solve_locally', solve('solve_locally', return_sequences=True)),
+              ('solve_recursively', solve('solve_recursively', return_sequences=True)),
+              ('get_targets', get_targets)] + \
+             [('data_from_treebank[%s]' % name, data_from_treebank(name))
+              for name in ['ScalarPrediction', 'ComparisonTraining', 'Seq2Seq',
+                           'DiagnosticClassifier', 'DCgates', 'DiagnosticTrainer']]
+
+
+if __name__ == '__main__':
+    main('arithmetics', benchmarks, default_sizes=[100, 1000],
+         description="Benchmark generation of arithmetic expressions and sequential training data")
@@ -0,0 +1,209 @@
+"""
+Benchmarks for the treebased recursive network: constructing
+networks from arithmetic expressions, forward and backward passes,
+training minibatches, optimizer updates and evaluation of comparison
+treebanks, for several expression lengths and dimensionalities.
+
+Run python bench_treebased.py -h for usage. The size of a benchmark
+is the number of expressions (or expression pairs) processed by one
+run, for optimizer updates it is the number of updates.
+"""
+
+from __future__ import print_function
+from processing_arithmetics.arithmetics.MathTreebank import MathTreebank
+from processing_arithmetics.treebased import NN, myTheta, Optimizer, data, parallel, batched
+from processing_arithmetics.treebased.training_routines import train_batch, train_forest_batch
+from harness import main
+import numpy as np
+import tempfile
+import os
+
+digits = np.arange(-10, 11)
+lengths = [1, 3, 5, 7, 9]
+dims = [2, 10]
+optimizers = {'SGD': Optimizer.SGD, 'Adagrad': Optimizer.Adagrad, 'Adam': Optimizer.Adam}
+
+
+def theta(d, comparison=0):
+    """
+    Freshly initialised parameters with inside and word dimensionality d,
+    as created by myTheta.install_theta.
+    """
+    dims = {'inside': d, 'word': d, 'min_arity': 3, 'max_arity': 3}
+    voc = ['UNKNOWN'] + [str(w) for w in digits] + ['+', '-']
+    params = myTheta.Theta(dims=dims, vocabulary=voc, seed=0)
+    params.extend4Classify(2, 3, comparison)
+    return params
+
+
+def comparison_treebank(size, length=None, comparison=False):
+    """
+    Comparison treebank with size pairs of expressions of the given
+    length, or of mixed lengths 1 to 9 if length is None.
+    """
+    if length is None:
+        languages = dict([('L%i' % l, max(size // 9, 1)) for l in xrange(1, 10)])
+    else:
+        languages = {'L%i' % length: size}
+    return data.CompareClassifyTB(MathTreebank(languages, digits=digits).paired_examples(), comparison=comparison)
+
+
+def construct_rnn(length):
+    def setup(size):
+        expressions = [expression for expression, answer in MathTreebank({'L%i' % length: size}, digits=digits).examples]
+
+        def run():
+            return [NN.RNN(expression) for expression in expressions]
+        return run, size
+    return setup
+
+
+def compile_treebank(source):
+    def setup(size):
+        treebank = comparison_treebank(size)
+        cache = os.path.join(tempfile.mkdtemp(), 'treebank.forest.npz')
+        batched.Forest.from_comparisons(treebank.items, treebank.labels).save(cache)
+
+        def run():
+            if source == 'networks':
+                examples = treebank.convert_examples(treebank.items, False)
+                return batched.Forest([nw for nw, _ in examples], [target for _, target in examples])
+            elif source == 'expressions':
+                return batched.Forest.from_comparisons(treebank.items, treebank.labels)
+            else:
+                return batched.Forest.load(cache)
+        return run, len(treebank.items)
+    return setup
+
+
+def forward(length, d):
+    def setup(size):
+        params = theta(d)
+        examples = comparison_treebank(size, length).examples
+
+        def run():
+            for nw, target in examples:
+                nw.forward(params)
+        return run, size
+    return setup
+
+
+def backprop(length, d):
+    def setup(size):
+        params = theta(d)
+        examples = comparison_treebank(size, length).examples
+        deltas = []
+        for nw, target in examples:
+            nw.forward(params)
+            delta = np.copy(nw.a)
+            delta[nw.labels.index(target)] -= 1
+            deltas.append(delta)
+
+        def run():
+            gradient = params.gradient()
+            for (nw, target), delta in zip(examples, deltas):
+                nw.backprop(params, delta, gradient)
+            return gradient
+        return run, size
+    return setup
+
+
+def batch(d, comparison):
+    def setup(size):
+        params = theta(d, comparison=-1 if comparison else 0)
+        examples = comparison_treebank(size, comparison=comparison).examples
+
+        def run():
+            return train_batch(params, examples, to_fix=[])
+        return run, len(examples)
+    return setup
+
+
+def parallel_batch(d, workers):
+    def setup(size):
+        params = theta(d)
+        forest = comparison_treebank(size).compile()
+        pool = parallel.WorkerPool(params, forest, workers)
+
+        def run():
+            return pool.train_batch(range(len(forest)))
+        # the workers are stopped after timing, such that they do not compete with later benchmarks
+        return run, len(forest), pool.close
+    return setup
+
+
+# the comparison training data of data.data4comparison(0), built once and used for all sizes
+_comparison_data = []
+
+
+def comparison_data():
+    if not _comparison_data:
+        treebank = data.data4comparison(0)['train']
+        _comparison_data.extend([treebank, treebank.compile()])
+    return _comparison_data
+
+
+def train_epoch(engine, d, b_size=50):
+    def setup(size):
+        """
+        The training loop of training_routines.plain_train (minibatches
+        and SGD updates, no evaluation) on size shuffled training examples
+        of data4comparison(0), with the node by node or the batched engine.
+        """
+        treebank, forest = comparison_data()
+        if engine == 'node':
+            treebank.examples  # construct the networks before timing
+        optimizer = Optimizer.SGD(theta(d))
+        indices = np.random.RandomState(0).permutation(len(forest))[:size]
+
+        def run():
+            for start in xrange(0, len(indices), b_size):
+                minibatch = indices[start:start + b_size]
+                if engine == 'batched':
+                    error, grads = train_forest_batch(optimizer.theta, forest, minibatch, to_fix=[])
+                else:
+                    error, grads = train_batch(optimizer.theta, [treebank.examples[j] for j in minibatch], to_fix=[])
+                optimizer.update(grads)
+        return run, len(indices)
+    return setup
+
+
+def update(name, d):
+    def setup(size):
+        params = theta(d)
+        optimizer = optimizers[name](params)
+        error, gradient = train_batch(params, comparison_treebank(50).examples, to_fix=[])
+
+        def run():
+            for _ in xrange(size):
+                optimizer.update(gradient)
+        return run, size
+    return setup
+
+
+def evaluate(d):
+    def setup(size):
+        params = theta(d)
+        treebank = comparison_treebank(size)
+
+        def run():
+            return treebank.evaluate(params, verbose=0)
+        return run, len(treebank.examples)
+    return setup
+
+
+benchmarks = [('RNN[L%i]' % length, construct_rnn(length)) for length in lengths] + \
+             [('compile[%s]' % source, compile_treebank(source)) for source in ['networks', 'expressions', 'cache']] + \
+             [('forward[L%i,d%i]' % (length, d), forward(length, d)) for d in dims for length in lengths] + \
+             [('backprop[L%i,d%i]' % (length, d), backprop(length, d)) for d in dims for length in lengths] + \
+             [('train_batch[d%i%s]' % (d, ',comparison' if comparison else ''), batch(d, comparison))
+              for d in dims for comparison in [False, True]] + \
+             [('parallel_batch[d%i,workers%i]' % (d, workers), parallel_batch(d, workers)) for d in dims for workers in [2, 4]] + \
+             [('train_epoch[%s,d%i]' % (engine, d), train_epoch(engine, d)) for d in dims for engine in ['node', 'batched']] + \
+             [('update[%s,d%i]' % (name, d), update(name, d)) for name in ['SGD', 'Adagrad', 'Adam'] for d in dims] + \
+             [('evaluate[d%i]' % d, evaluate(d)) for d in dims]
+
+
+if __name__ == '__main__':
+    main('treebased', benchmarks, default_sizes=[100, 1000],
+         description="Benchmark the treebased recursive network")
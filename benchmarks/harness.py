@@ -0,0 +1,185 @@
+"""
+Shared code for the benchmark suites: timing of benchmark
+functions at several sizes, storing results as JSON baselines
+and comparing new results with a baseline to detect regressions.
+
+Python 2 has no tracemalloc, allocations are approximated by
+the number of objects tracked by the garbage collector that
+a run leaves alive and by the growth of the peak resident
+set size of the process.
+"""
+
+from __future__ import print_function
+from collections import OrderedDict
+import argparse
+import platform
+import resource
+import subprocess
+import json
+import time
+import gc
+import os
+import re
+import sys
+import numpy as np
+
+baseline_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+
+def measure(func, n_examples, repeat=3):
+    """
+    Run func repeat times and return timing information.
+    :param func:        function without arguments to benchmark
+    :param n_examples:  number of examples processed by a single call to func
+    :param repeat:      number of times to run func
+    :return:            dictionary with best and mean wall time, examples per second
+                        (based on best time), objects allocated and not freed by a
+                        single run and growth of peak memory usage in MB
+    """
+    times, objects = [], []
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    for i in xrange(repeat):
+        gc.collect()
+        n_objects = len(gc.get_objects())
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+        objects.append(len(gc.get_objects()) - n_objects)
+        del result
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = min(times)
+
+    return OrderedDict([('examples', n_examples),
+                        ('best', best),
+                        ('mean', float(np.mean(times))),
+                        ('examples_per_second', n_examples / best if best > 0 else float('inf')),
+                        ('objects', int(np.median(objects))),
+                        ('rss_growth_mb', (rss_after - rss_before) / 1024.)])
+
+
+def run_benchmarks(benchmarks, sizes, repeat=3, pattern=None, verbose=True):
+    """
+    Run benchmarks at different sizes.
+    :param benchmarks:  list of (name, setup) tuples, setup is a function taking a size
+                        and returning a tuple (func, n_examples), where func is the function
+                        to be timed and n_examples the number of examples it processes,
+                        or (func, n_examples, teardown), where teardown is a function
+                        called after timing to release what setup acquired (e.g. processes)
+    :param sizes:       sizes to run every benchmark at
+    :param repeat:      number of times every function is timed
+    :param pattern:     regular expression, run only benchmarks whose name match
+    :return:            ordered dictionary mapping '<name>[<size>]' to timing results
+    """
+    results = OrderedDict()
+    for name, setup in benchmarks:
+        if pattern and not re.search(pattern, name):
+            continue
+        for size in sizes:
+            key = '%s[%s]' % (name, size)
+            prepared = setup(size)
+            func, n_examples = prepared[:2]
+            try:
+                results[key] = measure(func, n_examples, repeat=repeat)
+            finally:
+                if len(prepared) > 2:
+                    prepared[2]()
+            if verbose:
+                print_result(key, results[key])
+    return results
+
+
+def print_result(key, result):
+    print('%-60s %10.4fs %12.1f ex/s %10i objects' % (key, result['best'], result['examples_per_second'], result['objects']))
+    sys.stdout.flush()
+
+
+def environment():
+    """
+    Return description of the environment the benchmarks are run in.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+                        ('commit', commit),
+                        ('python', platform.python_version()),
+                        ('numpy', np.__version__),
+                        ('machine', platform.node()),
+                        ('processor', platform.processor())])
+
+
+def save_results(results, filename):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as f:
+        json.dump(OrderedDict([('environment', environment()), ('results', results)]), f, indent=2)
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)['results']
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare results with a baseline.
+    :param tolerance:   relative decrease of examples per second that
+                        is considered a regression
+    :return:            list of (key, baseline examples/s, examples/s, ratio, regression)
+                        tuples for all benchmarks in both results and baseline
+    """
+    comparison = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old, new = baseline[key]['examples_per_second'], result['examples_per_second']
+        ratio = new / old if old > 0 else float('inf')
+        comparison.append((key, old, new, ratio, ratio < 1 - tolerance))
+    return comparison
+
+
+def print_comparison(comparison):
+    print('\n%-60s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'speedup'))
+    for key, old, new, ratio, regression in comparison:
+        print('%-60s %12.1f %12.1f %7.2fx%s' % (key, old, new, ratio, '  REGRESSION' if regression else ''))
+
+
+def main(suite, benchmarks, default_sizes, description=None):
+    """
+    Command line interface of a benchmark suite.
+    :param suite:           name of the suite, used for the default baseline file
+    :param benchmarks:      list of (name, setup) tuples, see run_benchmarks
+    :param default_sizes:   sizes to run benchmarks at if none are given
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--sizes", type=int, nargs="*", default=default_sizes, help="Sizes to run benchmarks at")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of times every benchmark is timed")
+    parser.add_argument("--filter", help="Run only benchmarks whose name matches this regular expression")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--save", nargs="?", const=os.path.join(baseline_dir, suite + '.json'),
+                        help="Store results as baseline (default: baselines/%s.json)" % suite)
+    parser.add_argument("--compare", nargs="?", const=os.path.join(baseline_dir, suite + '.json'),
+                        help="Compare results with baseline (default: baselines/%s.json)" % suite)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    results = run_benchmarks(benchmarks, args.sizes, repeat=args.repeat, pattern=args.filter)
+
+    regressions = False
+    if args.compare:
+        comparison = compare(results, load_results(args.compare), tolerance=args.tolerance)
+        print_comparison(comparison)
+        regressions = any([regression for _, _, _, _, regression in comparison])
+
+    if args.save:
+        save_results(results, args.save)
+        print("\nResults written to %s" % args.save)
+
+    sys.exit(1 if regressions else 0)
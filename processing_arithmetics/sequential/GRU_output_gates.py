@@ -1,6 +1,8 @@
 from keras import backend as K
 from keras.engine.topology import Layer
 from keras.layers import GRU
+import theano
+import theano.tensor as T
 import numpy as np
 
 class GRU_output_gates(GRU):
@@ -82,3 +84,125 @@ class GRU_output_gates(GRU):
             return (input_shape[0], input_shape[1], self.units*3)
         else:
             return (input_shape[0], self.units*3)
+
+
+class GRU_gates(GRU):
+    """
+    Gated Recurrent Unit that outputs its gate values
+
+    Computes the same activations as a regular GRU, but
+    returns a list [h, z, r] with the hidden layer activations,
+    update gate values and reset gate values as three
+    separate outputs. Unlike GRU_output_gates, the values
+    are not concatenated and do not need to be split again
+    to monitor a single gate.
+
+    Dropout is not applied, the layer is meant to monitor
+    the gates of an already trained network.
+    """
+    def call(self, inputs, mask=None, training=None, initial_state=None):
+        assert not self.go_backwards, "GRU_gates does not support go_backwards"
+
+        # compute input projections for all timesteps at once
+        x = K.dot(inputs, self.kernel)
+        if self.use_bias:
+            x = K.bias_add(x, self.bias)
+
+        # scan over time dimension
+        x = x.dimshuffle((1, 0, 2))
+        h_0 = T.zeros_like(x[0, :, :self.units])
+
+        if mask is None:
+            mask = T.ones_like(inputs[:, :, 0])
+        mask = T.shape_padright(mask.dimshuffle((1, 0)))
+
+        (h, z, r), _ = theano.scan(self._step_gates,
+                                   sequences=[x, mask],
+                                   outputs_info=[h_0, h_0, h_0])
+
+        outputs = [output.dimshuffle((1, 0, 2)) for output in (h, z, r)]
+
+        if self.return_sequences:
+            return outputs
+        return [output[:, -1] for output in outputs]
+
+    def _step_gates(self, x_t, mask_t, h_tm1, z_tm1, r_tm1):
+        """
+        Compute hidden layer activation and gate values
+        for one timestep. Masked timesteps copy the values
+        of the previous timestep, like the keras backend.
+        """
+        units = self.units
+        matrix_inner = K.dot(h_tm1, self.recurrent_kernel[:, :2 * units])
+
+        z = self.recurrent_activation(x_t[:, :units] + matrix_inner[:, :units])
+        r = self.recurrent_activation(x_t[:, units: 2 * units] + matrix_inner[:, units: 2 * units])
+        hh = self.activation(x_t[:, 2 * units:] + K.dot(r * h_tm1, self.recurrent_kernel[:, 2 * units:]))
+        h = z * h_tm1 + (1 - z) * hh
+
+        return [T.switch(mask_t, new, prev) for new, prev in ((h, h_tm1), (z, z_tm1), (r, r_tm1))]
+
+    def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list):
+            input_shape = input_shape[0]
+        if self.return_sequences:
+            return [(input_shape[0], input_shape[1], self.units)] * 3
+        else:
+            return [(input_shape[0], self.units)] * 3
+
+    def compute_mask(self, inputs, mask):
+        if self.return_sequences:
+            return [mask] * 3
+        else:
+            return [None] * 3
+
+
+def gru_gates_reference(inputs, weights, mask=None, activation='tanh', recurrent_activation='hard_sigmoid'):
+    """
+    Compute hidden layer activations and gate values of
+    a GRU in numpy, to validate the values computed by
+    GRU_gates or GRU_output_gates off-graph.
+    :param inputs:                  array with inputs of shape (samples, timesteps, input_dim)
+    :param weights:                 weights of the GRU layer [kernel, recurrent_kernel, (bias)]
+    :param mask:                    binary array of shape (samples, timesteps), 0 for masked timesteps
+    :param activation:              name of the activation function
+    :param recurrent_activation:    name of the activation function of the gates
+    :return:                        arrays h, z and r of shape (samples, timesteps, units)
+    """
+    activations = {'tanh': np.tanh,
+                   'linear': lambda x: x,
+                   'relu': lambda x: np.maximum(x, 0),
+                   'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+                   'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0, 1)}
+    act, rec_act = activations[activation], activations[recurrent_activation]
+
+    kernel, recurrent_kernel = weights[0], weights[1]
+    units = recurrent_kernel.shape[0]
+    samples, timesteps = inputs.shape[:2]
+
+    x = np.dot(inputs, kernel)
+    if len(weights) > 2:
+        x += weights[2]
+
+    if mask is None:
+        mask = np.ones((samples, timesteps))
+
+    # preallocate outputs
+    h = np.zeros((samples, timesteps, units))
+    z = np.zeros((samples, timesteps, units))
+    r = np.zeros((samples, timesteps, units))
+
+    h_tm1, z_tm1, r_tm1 = np.zeros((samples, units)), np.zeros((samples, units)), np.zeros((samples, units))
+    for t in xrange(timesteps):
+        m = mask[:, t, np.newaxis] != 0
+        inner = np.dot(h_tm1, recurrent_kernel[:, :2 * units])
+        z_t = rec_act(x[:, t, :units] + inner[:, :units])
+        r_t = rec_act(x[:, t, units:2 * units] + inner[:, units:])
+        hh = act(x[:, t, 2 * units:] + np.dot(r_t * h_tm1, recurrent_kernel[:, 2 * units:]))
+        h_t = z_t * h_tm1 + (1 - z_t) * hh
+
+        h[:, t] = h_tm1 = np.where(m, h_t, h_tm1)
+        z[:, t] = z_tm1 = np.where(m, z_t, z_tm1)
+        r[:, t] = r_tm1 = np.where(m, r_t, r_tm1)
+
+    return h, z, r
@@ -3,11 +3,11 @@ Collection of functions to analyse the weight matrices of
 the network.
 """
 
-import itertools as it
 import numpy as np
 # import matplotlib.cm as cm
 # from matplotlib import gridspec
-from sklearn.decomposition import PCA
+from .statespace import StateSpace
+from .embedding_analysis import pair_distances, embedding_norms
 
 def visualise_hidden_layer(output_classifier, *inputs):
     """
@@ -104,27 +104,31 @@ def plot_gate_values(*inputs):
 
     plt.show()
 
-def visualise_paths(*inputs):
+def visualise_paths(*inputs, **kwargs):
     """
     Apply pca to hidden layer activations and visualise
     the paths through statespace in the reduced statespace
     :param inputs:
+    :param state_space: fitted StateSpace to project the activations
+                        with, if not given pca is fitted on the inputs
     :return:
     """
     import matplotlib.pylab as plt
     print(len(inputs))
 
-    # create hl_activations matrix and compute principal components
-    activations_nz =tuple([input[0][np.any(input[0]!=0, axis=2)] for input in inputs])
-    hl_activations = np.concatenate(tuple(activations_nz))
-    pca = PCA(n_components=2)
-    pca.fit(hl_activations)
+    state_space = kwargs.get('state_space', None)
+
+    if state_space is None:
+        # create hl_activations matrix and compute principal components
+        activations_nz =tuple([input[0][np.any(input[0]!=0, axis=-1)] for input in inputs])
+        hl_activations = np.concatenate(tuple(activations_nz))
+        state_space = StateSpace(n_components=2).fit(hl_activations)
 
     for hl, z, r, labels in inputs:
         # cut off zero activations
-        hl_nonzero = hl[np.any(hl!=0, axis=2)]
+        hl_nonzero = hl[np.any(hl!=0, axis=-1)]
         description = ' '.join(labels)
-        hl_reduced = pca.transform(hl_nonzero)
+        hl_reduced = state_space.transform(hl_nonzero)
         plt.plot(hl_reduced[:,0], hl_reduced[:,1], label=description)
         # TODO I should maybe put some annotation of the trajectories, when are they where
 
@@ -135,6 +139,20 @@ def visualise_paths(*inputs):
     plt.show()
 
 
+def visualise_store_paths(store, indices, state_space):
+    """
+    Visualise the paths through statespace of the sequences
+    with the given indices in a RaggedStore with activations.
+    :param store:       RaggedStore, see extraction.py
+    :param indices:     indices of sequences to plot
+    :param state_space: fitted StateSpace, see statespace.py
+    """
+    imap = dict([(value, key) for key, value in store.meta['dmap'].items()])
+    inputs = [(store.sequence('hidden', i), None, None,
+               [imap[symbol] for symbol in store.sequence('inputs', i)]) for i in indices]
+    visualise_paths(*inputs, state_space=state_space)
+
+
 
 def find_longest(inputs):
     """
@@ -154,15 +172,7 @@ def distance_embeddings(embeddings_matrix):
     """
     Compute the average distance between embeddings
     """
-    distance = 0
-    l = 0
-    for row1, row2 in it.combinations(embeddings_matrix, 2):
-        new_distance = np.sqrt(np.sum(np.power(row1-row2, 2)))
-        distance += new_distance
-        l += 1
-
-    av_distance = distance / l
-    return av_distance
+    return pair_distances(embeddings_matrix).mean(axis=-1)
 
 
 def plot_distances(embeddings_matrix):
@@ -171,10 +181,7 @@ def plot_distances(embeddings_matrix):
     vectors in the embeddings matrix.
     """
     import matplotlib.pyplot as plt
-    distances = []
-    for row1, row2 in it.combinations(embeddings_matrix, 2):
-        distance = np.sqrt(np.sum(np.power(row1-row2, 2)))
-        distances.append(distance)
+    distances = pair_distances(embeddings_matrix)
 
     plt.hist(distances, bins = len(distances)/50)
     plt.xlabel("Distance between vectors")
@@ -187,14 +194,7 @@ def length_embeddings(embeddings_matrix):
     """
     Compute the average length of the embeddings.
     """
-    length = 0
-    l = len(embeddings_matrix)
-    for embedding in embeddings_matrix:
-        length += np.sqrt(np.sum(np.power(embedding, 2)))
-
-    av_length = length/l
-    
-    return av_length
+    return embedding_norms(embeddings_matrix).mean(axis=-1)
 
 def colourmap():
     cdict = {'red':     ((0.0, 0.0, 0.0),
@@ -4,9 +4,10 @@ from keras.layers import Embedding, Dense, Input, SimpleRNN, GRU, LSTM, Masking,
 from keras.layers.wrappers import TimeDistributed
 import keras.preprocessing.sequence
 import os
-from .callbacks import TrainingHistory, VisualiseEmbeddings
+from .callbacks import TrainingHistory, VisualiseEmbeddings, EarlyStopping
+from .profiling import Profiler, ProfilingCallback, profile, phase, n_examples
 from ..arithmetics import MathTreebank
-from GRU_output_gates import GRU_output_gates
+from GRU_output_gates import GRU_output_gates, GRU_gates
 from ArithmeticModel import ArithmeticModel
 import theano
 import theano.tensor as T
@@ -14,6 +15,15 @@ import copy
 import numpy as np
 
 
+def pad_sequences(sequences, **kwargs):
+    """
+    Pad sequences with keras, recorded as a phase by the
+    profiler that is currently running.
+    """
+    with phase('pad_sequences', len(sequences)):
+        return keras.preprocessing.sequence.pad_sequences(sequences, **kwargs)
+
+
 class Training(object):
     # TODO write which functions a training class should implement
     """
@@ -33,6 +43,8 @@ class Training(object):
         self.digits = digits
         self.operators = operators
         self.activation_func = None
+        self.sequence_activation_func = None
+        self.profiler = Profiler()
         self.gate_activation_func = None
 
         # set loss functions, metrics and activation functions
@@ -103,7 +115,8 @@ class Training(object):
             self.classifiers = kwargs['classifiers']
 
         # build model
-        self._build(W_embeddings, W_recurrent, W_classifier)
+        with self.profiler.phase('build'):
+            self._build(W_embeddings, W_recurrent, W_classifier)
 
 
     def add_pretrained_model(self, model, copy_weights=['recurrent','embeddings','classifier'], fix_classifier_weights=False, fix_embeddings=False, fix_recurrent_weights=False, mask_zero=True, dropout_recurrent=0.0, **kwargs):
@@ -126,7 +139,7 @@ class Training(object):
             raise ValueError("Model dmap is not identical to architecture dmap")
 
         # find recurrent layer
-        recurrent_layer = {'SimpleRNN': SimpleRNN, 'GRU': GRU, 'LSTM': LSTM, 'GRU_output_gates': GRU_output_gates}[model_info['recurrent_layer']]
+        recurrent_layer = {'SimpleRNN': SimpleRNN, 'GRU': GRU, 'LSTM': LSTM, 'GRU_output_gates': GRU_output_gates, 'GRU_gates': GRU_gates}[model_info['recurrent_layer']]
 
         W_recurrent, W_embeddings, W_classifier = None, None, None
 
@@ -165,6 +178,7 @@ class Training(object):
 
         return dmap
 
+    @profile('generate_training_data')
     def generate_training_data(self, data, digits=np.arange(-10, 11), format='infix', pad_to=None):
         """
         Generate training data
@@ -173,8 +187,10 @@ class Training(object):
         assert not bool(set(digits) - set(self.digits)), "Model cannot process inputted digits"
 
         if isinstance(data, dict):
-            data = MathTreebank(data, digits=digits)
-            np.random.shuffle(data.examples)
+            with self.profiler.phase('treebank') as record:
+                data = MathTreebank(data, digits=digits)
+                np.random.shuffle(data.examples)
+                record['examples'] = len(data.examples)
 
         return self.data_from_treebank(treebank=data,
                                        format=format,
@@ -220,13 +236,24 @@ class Training(object):
 
         return test_data
 
-    def train(self, training_data, batch_size, epochs, filename, optimizer='adam', metrics=None, loss_functions=None, validation_split=0.1, validation_data=None, sample_weight=None, verbosity=2, visualise_embeddings=False, logger=False, save_every=False, loss_weights=None):
+    def train(self, training_data, batch_size, epochs, filename, optimizer='adam', metrics=None, loss_functions=None, validation_split=0.1, validation_data=None, sample_weight=None, verbosity=2, visualise_embeddings=False, logger=False, save_every=False, loss_weights=None, early_stopping=None, initial_epoch=0, history_options=None, optimizer_weights=None):
         """
         Fit the model.
         :param weights_animation:    Set to true to create an animation of the development of the embeddings
                                         after training.
-        :param visualise_embeddings:        Set to N to plot the embeddings every N epochs, only available for 2D
-                                        embeddings.
+        :param visualise_embeddings:        Set to True to record snapshots of the embeddings during training, or to
+                                        a dictionary with arguments for VisualiseEmbeddings (every, schedule,
+                                        growth, max_snapshots, filename), only available for 2D embeddings.
+        :param early_stopping:      dictionary with arguments for the EarlyStopping callback
+                                        (monitor, output, validation, mode, patience, min_delta),
+                                        set to None to always train for all epochs
+        :param initial_epoch:       epoch at which to start training, used to continue
+                                        training a model
+        :param history_options:     dictionary with extra arguments for the TrainingHistory callback
+                                        (batch_metrics, log_file, esp_every, keep_checkpoints)
+        :param optimizer_weights:   values of the weights of the optimizer to continue training with (e.g. the
+                                        moments of adam, see checkpoints.load_optimizer_weights), None to start
+                                        with a new optimizer state
         """
         X_train, Y_train = training_data
 
@@ -238,23 +265,36 @@ class Training(object):
         if not loss_weights:
             loss_weights = self.loss_weights
 
-        # compile model
-        self.model.compile(loss=loss_functions, optimizer=optimizer, metrics=metrics, sample_weight_mode=self.sample_weight_mode, loss_weights=loss_weights)
+        # compile model, compile theano functions before fitting to time them separately
+        with self.profiler.phase('compile'):
+            self.model.compile(loss=loss_functions, optimizer=optimizer, metrics=metrics, sample_weight_mode=self.sample_weight_mode, loss_weights=loss_weights)
+            self.model._make_train_function()
+            if optimizer_weights is not None:
+                self.model.optimizer.set_weights(optimizer_weights)
+            if validation_data or validation_split:
+                self.model._make_test_function()
 
-        callbacks = self.generate_callbacks(visualise_embeddings, logger, recurrent_id=self.get_recurrent_layer_id(), embeddings_id=self.get_embeddings_layer_id(), save_every=save_every, filename=filename)
+        callbacks = self.generate_callbacks(visualise_embeddings, logger, recurrent_id=self.get_recurrent_layer_id(), embeddings_id=self.get_embeddings_layer_id(), save_every=save_every, filename=filename, early_stopping=early_stopping, history_options=history_options)
 
         # fit model
-        self.model.fit(X_train, Y_train, validation_data=validation_data,
-                       validation_split=validation_split, batch_size=batch_size, 
-                       epochs=epochs, sample_weight=sample_weight,
-                       callbacks=callbacks, verbose=verbosity, shuffle=True)
-
-        hist = callbacks[0]
-
-        try:
-            self.embeddings_anim = callbacks[1].all_weights
-        except:
-            pass
+        with self.profiler.phase('fit') as record:
+            self.model.fit(X_train, Y_train, validation_data=validation_data,
+                           validation_split=validation_split, batch_size=batch_size, 
+                           epochs=epochs, sample_weight=sample_weight,
+                           callbacks=callbacks, verbose=verbosity, shuffle=True,
+                           initial_epoch=initial_epoch)
+
+            hist = callbacks[0]
+            # the samples keras trained on in every epoch (without the validation split)
+            record['examples'] = hist.params['samples'] * hist.i
+
+        # store epoch at which training was stopped, None if training was not stopped
+        self.stopped_epoch = None
+        for callback in callbacks[1:]:
+            if isinstance(callback, EarlyStopping):
+                self.stopped_epoch = callback.stopped_epoch
+            elif isinstance(callback, VisualiseEmbeddings):
+                self.embeddings_anim = callback.all_weights
         
         self.trainings_history = hist                    # set trainings history as attribute
 
@@ -290,9 +330,12 @@ class Training(object):
             self.model.compile(loss=self.loss_functions, optimizer='adam', metrics=self.metrics, loss_weights=self.loss_weights)
 
         evaluation = OrderedDict()
-        for name, X, Y in test_data:
-            acc = self.model.evaluate(X, Y)
-            evaluation[name] = dict([(self.model.metrics_names[i], acc[i]) for i in xrange(len(acc))])
+        with self.profiler.phase('test') as record:
+            record['examples'] = 0
+            for name, X, Y in test_data:
+                acc = self.model.evaluate(X, Y)
+                evaluation[name] = dict([(self.model.metrics_names[i], acc[i]) for i in xrange(len(acc))])
+                record['examples'] += n_examples((X, Y))
         return evaluation
 
     def get_activations(self, input_data):
@@ -303,7 +346,18 @@ class Training(object):
         if not self.activation_func:
             self._make_activation_func()
 
-        return self.activations_func(input_data)[0]
+        return self.activation_func(input_data)[0]
+
+    def get_sequence_activations(self, input_data):
+        """
+        Get the activation values of the hidden layer
+        for all timesteps of the input, also for models
+        whose recurrent layer only returns its final state.
+        """
+        if not self.sequence_activation_func:
+            self._make_sequence_activation_func()
+
+        return self.sequence_activation_func(input_data)[0]
 
     def get_gate_activations(self, input_data):
         """
@@ -313,16 +367,29 @@ class Training(object):
         if not self.gate_activation_func:
             self._make_gate_activation_func()
 
-        all_activations = self.gate_activation_func(input_data)[0]
-
-        hl_activations = all_activations[:,:,:self.rec_dim]
-        z = all_activations[:,:,self.rec_dim:2*self.rec_dim]
-        r = all_activations[:,:,2*self.rec_dim:]
+        hl_activations, z, r = self.gate_activation_func(input_data)
         return hl_activations, z, r
 
     def _make_activation_func(self):
 
-        self.activations_func = theano.function([self.model.layers[0].input], [self.model.layers[self.get_recurrent_layer_id()].output])
+        self.activation_func = theano.function([self.model.layers[0].input], [self.model.layers[self.get_recurrent_layer_id()].output])
+
+    def _make_sequence_activation_func(self):
+
+        rec_id = self.get_recurrent_layer_id()
+        recurrent_layer = self.model.layers[rec_id]
+
+        # copy recurrent layer, returning the full sequence
+        rec_config = recurrent_layer.get_config()
+        rec_config.update({'return_sequences': True, 'name': rec_config['name'] + '_sequences'})
+        sequence_layer = recurrent_layer.__class__.from_config(rec_config)
+        sequence_output = sequence_layer(self.model.layers[rec_id-1].get_output_at(0))
+        sequence_layer.set_weights(recurrent_layer.get_weights())
+
+        if isinstance(sequence_output, list):
+            sequence_output = sequence_output[0]
+
+        self.sequence_activation_func = theano.function([self.model.layers[0].input], [sequence_output])
 
     def _make_gate_activation_func(self):
 
@@ -336,13 +403,14 @@ class Training(object):
         rec_config = recurrent_layer.get_config()
         self.rec_dim = rec_config['units']
 
-        gate_output_layer = GRU_output_gates(units=rec_config['units'],
-                                             activation=rec_config['activation'],
-                                             weights=recurrent_layer.get_weights(),
-                                             return_sequences=True)(
-                                                     self.model.layers[rec_id-1].get_output_at(0))
+        gate_outputs = GRU_gates(units=rec_config['units'],
+                                 activation=rec_config['activation'],
+                                 recurrent_activation=rec_config['recurrent_activation'],
+                                 weights=recurrent_layer.get_weights(),
+                                 return_sequences=True)(
+                                         self.model.layers[rec_id-1].get_output_at(0))
 
-        self.gate_activation_func = theano.function([self.model.layers[0].input], [gate_output_layer])
+        self.gate_activation_func = theano.function([self.model.layers[0].input], gate_outputs)
 
 
     def evaluation_string(self, evaluation):
@@ -370,7 +438,7 @@ class Training(object):
         """
 
         if isinstance(model, str):
-            model = load_model(model, custom_objects={"ArithmeticModel": ArithmeticModel, 'GRU_output_gates': GRU_output_gates, 'T': theano.tensor})
+            model = load_model(model, custom_objects={"ArithmeticModel": ArithmeticModel, 'GRU_output_gates': GRU_output_gates, 'GRU_gates': GRU_gates, 'T': theano.tensor})
 
         # check if model is of correct type TODO
         n_layers = len(model.layers)
@@ -401,7 +469,7 @@ class Training(object):
                 model_info['input_dim'] = layer.get_config()['input_dim']
                 model_info['input_length'] = layer.get_config()['input_length']
 
-            elif layer_type in ['SimpleRNN', 'GRU', 'LSTM', 'GRU_output_gates']:
+            elif layer_type in ['SimpleRNN', 'GRU', 'LSTM', 'GRU_output_gates', 'GRU_gates']:
                 assert 'recurrent_layer' not in model_info, 'Model has too many recurrent layers' 
                 model_info['recurrent_layer'] = layer_type
                 model_info['weights_recurrent'] = weights
@@ -420,35 +488,25 @@ class Training(object):
     def visualise_embeddings(self):
         raise NotImplementedError()
 
-    def save_model(self, filename, custom_objects=None):
+    def save_model(self, filename, custom_objects=None, overwrite=True):
         """
         Save model to file
+        :param overwrite:   set to False to raise an error if filename exists
         """
-        # check if filename exists
-        exists = os.path.exists(filename+'.h5')
-        while exists:
-            overwrite = raw_input("Filename exists, overwrite? (y/n)")
-            if overwrite == 'y':
-                exists = False
-                continue
-            filename = raw_input("Provide filename (without extension)")
-              
+        if not overwrite and os.path.exists(filename):
+            raise IOError("File %s exists" % filename)
+
         # save file
         self.model.save(filename)
 
-    def save_weights(self, filename):
+    def save_weights(self, filename, overwrite=True):
         """
         Save model weights to file
+        :param overwrite:   set to False to raise an error if filename exists
         """
-        # check if filename exists
-        exists = os.path.exists(filename+'.h5')
-        while exists:
-            overwrite = raw_input("Filename exists, overwrite? (y/n)")
-            if overwrite == 'y':
-                exists = False
-                continue
-            filename = raw_input("Provide filename (without extension)")
-              
+        if not overwrite and os.path.exists(filename):
+            raise IOError("File %s exists" % filename)
+
         # save file
         self.model.save_weights(filename)
 
@@ -534,23 +592,32 @@ class Training(object):
             i += 1
         plt.show()
 
-    def generate_callbacks(self, plot_embeddings, print_every, recurrent_id, embeddings_id, save_every, filename):
+    def generate_callbacks(self, plot_embeddings, print_every, recurrent_id, embeddings_id, save_every, filename, early_stopping=None, history_options=None):
         """
         Generate sequence of callbacks to use during training
         :param recurrent_id:
         :param weights_animation:           set to true to generate visualisation of embeddings
-        :param plot_embeddings:             generate scatter plot of embeddings every plot_embeddings epochs
+        :param plot_embeddings:             set to True to record snapshots of the embeddings, or to a dictionary
+                                            with arguments for VisualiseEmbeddings
         :param print_every:                 print summary of results every print_every epochs
+        :param early_stopping:              dictionary with arguments for EarlyStopping callback
+        :param history_options:             dictionary with extra arguments for TrainingHistory callback
         :return:
         """
 
-        history = TrainingHistory(metrics=self.metrics, recurrent_id=recurrent_id, param_id=1, save_every=save_every, filename=filename)
-        callbacks = [history]
+        history = TrainingHistory(metrics=self.metrics, recurrent_id=recurrent_id, param_id=1, save_every=save_every, filename=filename, **(history_options or {}))
+        callbacks = [history, ProfilingCallback(self.profiler)]
+
+        if early_stopping:
+            callbacks.append(EarlyStopping(history, **early_stopping))
 
         if plot_embeddings:
             if plot_embeddings is True:
                 embeddings_plot = VisualiseEmbeddings(self.dmap, embeddings_id=embeddings_id)
                 callbacks.append(embeddings_plot)
+            elif isinstance(plot_embeddings, dict):
+                embeddings_plot = VisualiseEmbeddings(self.dmap, embeddings_id=embeddings_id, **plot_embeddings)
+                callbacks.append(embeddings_plot)
             else:
                 pass
 
@@ -613,6 +680,7 @@ class ScalarPrediction(Training):
         # create model
         self.model = ArithmeticModel(inputs=input_layer, outputs=output_layer, dmap=self.dmap)
 
+    @profile('data_from_treebank')
     def data_from_treebank(self, treebank, format='infix', pad_to=None):
         """
         Generate test data from a MathTreebank object.
@@ -627,7 +695,7 @@ class ScalarPrediction(Training):
 
         # pad sequences to have the same length
         assert pad_to is None or len(X[0]) <= pad_to, 'length test is %i, max length is %i. Test sequences should not be truncated' % (len(X[0]), pad_to)
-        X_padded = keras.preprocessing.sequence.pad_sequences(X, dtype='int32', maxlen=pad_to)
+        X_padded = pad_sequences(X, dtype='int32', maxlen=pad_to)
         X = {'input':X_padded}
         Y = {'output':np.array(Y)}
 
@@ -703,6 +771,7 @@ class ComparisonTraining(Training):
         # create model
         self.model = ArithmeticModel(inputs=[input1, input2], outputs=output_layer, dmap=self.dmap)
 
+    @profile('data_from_treebank')
     def data_from_treebank(self, treebank, format='infix', pad_to=None):
         """
         Generate data from MathTreebank object.
@@ -723,8 +792,8 @@ class ComparisonTraining(Training):
 
         # pad sequences to have the same length
         assert pad_to is None or len(X1[0]) <= pad_to, 'length test is %i, max length is %i. Test sequences should not be truncated' % (len(X1[0]), pad_to)
-        X1_padded = keras.preprocessing.sequence.pad_sequences(X1, dtype='int32', maxlen=pad_to)
-        X2_padded = keras.preprocessing.sequence.pad_sequences(X2, dtype='int32', maxlen=pad_to)
+        X1_padded = pad_sequences(X1, dtype='int32', maxlen=pad_to)
+        X2_padded = pad_sequences(X2, dtype='int32', maxlen=pad_to)
 
         X_padded = {'input1':X1_padded, 'input2': X2_padded}
         Y = {'compare': np.array(Y)}
@@ -792,6 +861,7 @@ class Seq2Seq(Training):
 
         self.model = ArithmeticModel(inputs=input_layer, outputs=output, dmap=self.dmap)
 
+    @profile('data_from_treebank')
     def data_from_treebank(self, treebank, format='infix', pad_to=None):
         """
         Generate test data from a MathTreebank object.
@@ -801,16 +871,17 @@ class Seq2Seq(Training):
         pad_to = pad_to or self.input_length
 
         # loop over examples
-        for expression, answer in treebank.examples:
-            expression.get_targets(format, 'intermediate_locally')
-            input_seq = [self.dmap[i] for i in expression.to_string(format).split()]
-            X.append(input_seq)
-            Y.append(expression.targets['intermediate_locally'])
+        with phase('targets', len(treebank.examples)):
+            for expression, answer in treebank.examples:
+                expression.get_targets(format, 'intermediate_locally')
+                input_seq = [self.dmap[i] for i in expression.to_string(format).split()]
+                X.append(input_seq)
+                Y.append(expression.targets['intermediate_locally'])
 
         # pad sequences to have the same length
         assert pad_to is None or len(X[0]) <= pad_to, 'length test is %i, max length is %i. Test sequences should not be truncated' % (len(X[0]), pad_to)
-        X_padded = keras.preprocessing.sequence.pad_sequences(X, dtype='int32', maxlen=pad_to)
-        Y_padded = keras.preprocessing.sequence.pad_sequences(Y, maxlen=pad_to, dtype='float32')
+        X_padded = pad_sequences(X, dtype='int32', maxlen=pad_to)
+        Y_padded = pad_sequences(Y, maxlen=pad_to, dtype='float32')
 
         X = {'input': X_padded}
         Y = {'output': Y_padded}
@@ -900,6 +971,7 @@ class DiagnosticClassifier(Training):
         self.activations = dict([(key, self.activations[key]) for key in self.classifiers])
 
 
+    @profile('data_from_treebank')
     def data_from_treebank(self, treebank, format='infix', pad_to=None):
         """
         Generate test data from a MathTreebank object.
@@ -909,20 +981,21 @@ class DiagnosticClassifier(Training):
         pad_to = pad_to or self.input_length
 
         # loop over examples
-        for expression, answer in treebank.examples:
-            expression.get_targets(format, *self.classifiers)
-            input_seq = [self.dmap[i] for i in expression.to_string(format).split()]
-            X.append(input_seq)
-            for classifier in self.classifiers:
-                target = expression.targets[classifier]
-                Y[classifier].append(target)
+        with phase('targets', len(treebank.examples)):
+            for expression, answer in treebank.examples:
+                expression.get_targets(format, *self.classifiers)
+                input_seq = [self.dmap[i] for i in expression.to_string(format).split()]
+                X.append(input_seq)
+                for classifier in self.classifiers:
+                    target = expression.targets[classifier]
+                    Y[classifier].append(target)
         # pad sequences to have the same length
         assert pad_to is None or len(X[0]) <= pad_to, 'length test is %i, max length is %i. Test sequences should not be truncated' % (len(X[0]), pad_to)
-        X_padded = keras.preprocessing.sequence.pad_sequences(X, dtype='int32', maxlen=pad_to)
+        X_padded = pad_sequences(X, dtype='int32', maxlen=pad_to)
 
         # make numpy arrays from Y data
         for output in Y:
-            Y[output] = np.array(keras.preprocessing.sequence.pad_sequences(Y[output], maxlen=pad_to))
+            Y[output] = np.array(pad_sequences(Y[output], maxlen=pad_to))
 
         X = {'input': X_padded}
 
@@ -960,7 +1033,7 @@ class DCgates(DiagnosticClassifier):
         Build model with given embeddings and recurrent weights.
         """
         # fetch adapted recurrent layer
-        self.recurrent_layer = {'GRU':GRU_output_gates}[self.recurrent_name]
+        self.recurrent_layer = {'GRU': GRU_gates, 'GRU_gates': GRU_gates}[self.recurrent_name]
 
         # create input layer
         input_layer = Input(shape=(self.input_length,), dtype='int32', name='input')
@@ -973,17 +1046,12 @@ class DCgates(DiagnosticClassifier):
                                mask_zero=self.mask_zero,
                                name='embeddings')(input_layer)
 
-        # create recurrent layer
-        recurrent = self.recurrent_layer(units=self.size_hidden, name='recurrent_layer',
-                                         weights=W_recurrent,
-                                         trainable=False,
-                                         return_sequences=True,
-                                         activation=self.activations['recurrent_layer'],
-                                         recurrent_dropout=self.dropout_recurrent)(embeddings)
-
-        # create gate layers
-        update_gate = TimeDistributed(Lambda(function=DCgates.get_update_gate, output_shape=DCgates.gate_shape))(recurrent)
-        reset_gate = TimeDistributed(Lambda(function=DCgates.get_reset_gate, output_shape=DCgates.gate_shape))(recurrent)
+        # create recurrent layer, outputs hidden layer activations and gate values
+        recurrent, update_gate, reset_gate = self.recurrent_layer(units=self.size_hidden, name='recurrent_layer',
+                                                                  weights=W_recurrent,
+                                                                  trainable=False,
+                                                                  return_sequences=True,
+                                                                  activation=self.activations['recurrent_layer'])(embeddings)
 
         # add classifier layers
         classifiers = []
@@ -1000,27 +1068,6 @@ class DCgates(DiagnosticClassifier):
         # create model
         self.model = ArithmeticModel(inputs=input_layer, outputs=classifiers, dmap=self.dmap)
 
-    # function to get update gate
-    @staticmethod
-    def get_update_gate(state_concatenations):
-        s = state_concatenations.shape[-1]/3
-        update_gate = T.split(state_concatenations, [s, s, s], 3, axis=-1)[1]
-        return update_gate
-
-    # function to get reset gate
-    @staticmethod
-    def get_reset_gate(state_concatenations):
-        s = state_concatenations.shape[-1]/3
-        reset_gate = T.split(state_concatenations, [s, s, s], 3, axis=-1)[2]
-        return reset_gate
-
-    # get gate shape values
-    @staticmethod
-    def gate_shape(input_shape):
-        shape = list(input_shape)
-        shape[-1] = shape[-1]/3
-        return tuple(shape)
-
     def set_attributes(self, **kwargs):
         """
         Set the classifiers that should be trained and their
@@ -1033,7 +1080,7 @@ class DCgates(DiagnosticClassifier):
             raise ValueError("Class should be initialised with model")
         self.recurrent_name = model_info['recurrent_layer']
         try:
-            self.gates = {'GRU':['update_gate', 'reset_gate']}[self.recurrent_name]
+            self.gates = {'GRU': ['update_gate', 'reset_gate'], 'GRU_gates': ['update_gate', 'reset_gate']}[self.recurrent_name]
         except KeyError:
             raise ValueError("output gates not implemented for %s" % self.recurrent_name)
 
@@ -1043,6 +1090,7 @@ class DCgates(DiagnosticClassifier):
             for key in self.classifiers for gate in self.gates])
         self.activations = dict([(key, self.activations[key]) for key in self.classifiers])
 
+    @profile('data_from_treebank')
     def data_from_treebank(self, treebank, format='infix', pad_to=None):
         """
         Generate test data from a MathTreebank object.
@@ -1052,28 +1100,29 @@ class DCgates(DiagnosticClassifier):
         pad_to = pad_to or self.input_length
 
         # loop over examples
-        for expression, answer in treebank.examples:
-            expression.get_targets(format, *self.classifiers)
-            input_seq = [self.dmap[i] for i in expression.to_string(format).split()]
-            X.append(input_seq)
-            for classifier in self.classifiers:
-                target = expression.targets[classifier]
-                for gate in self.gates:
-                    Y[classifier+'_'+gate].append(target)
+        with phase('targets', len(treebank.examples)):
+            for expression, answer in treebank.examples:
+                expression.get_targets(format, *self.classifiers)
+                input_seq = [self.dmap[i] for i in expression.to_string(format).split()]
+                X.append(input_seq)
+                for classifier in self.classifiers:
+                    target = expression.targets[classifier]
+                    for gate in self.gates:
+                        Y[classifier+'_'+gate].append(target)
         # pad sequences to have the same length
         assert pad_to is None or len(X[0]) <= pad_to, 'length test is %i, max length is %i. Test sequences should not be truncated' % (len(X[0]), pad_to)
-        X_padded = keras.preprocessing.sequence.pad_sequences(X, dtype='int32', maxlen=pad_to)
+        X_padded = pad_sequences(X, dtype='int32', maxlen=pad_to)
 
         # make numpy arrays from Y data
         for output in Y:
-            Y[output] = np.array(keras.preprocessing.sequence.pad_sequences(Y[output], maxlen=pad_to))
+            Y[output] = np.array(pad_sequences(Y[output], maxlen=pad_to))
 
         X = {'input': X_padded}
 
         return X, Y
 
     def save_model(self, filename):
-        custom_objects = {'get_update_gate': self.get_update_gate, 'get_reset_gate': self.get_reset_gate, 'gate_shape': self.gate_shape, 'GRU_output_gates': GRU_output_gates}
+        custom_objects = {'GRU_gates': GRU_gates}
         super(DCgates, self).save_model(filename, custom_objects)
 
 
@@ -1142,6 +1191,7 @@ class DiagnosticTrainer(DiagnosticClassifier):
         # create model
         self.model = ArithmeticModel(inputs=input_layer, outputs=outputs, dmap=self.dmap)
 
+    @profile('data_from_treebank')
     def data_from_treebank(self, treebank, format='infix', pad_to=None):
         """
         Generate test data from a MathTreebank object.
@@ -1151,23 +1201,24 @@ class DiagnosticTrainer(DiagnosticClassifier):
         pad_to = pad_to or self.input_length
 
         # loop over examples
-        for expression, answer in treebank.examples:
-            expression.get_targets(format, *self.classifiers)
-            input_seq = [self.dmap[i] for i in expression.to_string(format).split()]
-            X.append(input_seq)
-            for classifier in self.classifiers:
-                target = expression.targets[classifier]
-                Y[classifier].append(target)
-            Y['output'].append(answer)
+        with phase('targets', len(treebank.examples)):
+            for expression, answer in treebank.examples:
+                expression.get_targets(format, *self.classifiers)
+                input_seq = [self.dmap[i] for i in expression.to_string(format).split()]
+                X.append(input_seq)
+                for classifier in self.classifiers:
+                    target = expression.targets[classifier]
+                    Y[classifier].append(target)
+                Y['output'].append(answer)
 
         # pad sequences to have the same length
         assert pad_to is None or len(X[0]) <= pad_to, 'length test is %i, max length is %i. Test sequences should not be truncated' % (len(X[0]), pad_to)
-        X_padded = keras.preprocessing.sequence.pad_sequences(X, dtype='int32', maxlen=pad_to)
+        X_padded = pad_sequences(X, dtype='int32', maxlen=pad_to)
 
         # make numpy arrays from Y data
         for output in Y:
             try:
-                Y[output] = keras.preprocessing.sequence.pad_sequences(Y[output], maxlen=pad_to)
+                Y[output] = pad_sequences(Y[output], maxlen=pad_to)
             except ValueError:
                 Y[output] = np.array(Y[output])
 
@@ -1,20 +1,34 @@
 from keras.callbacks import Callback
 import matplotlib.animation as animation
+import numpy as np
+import threading
+import Queue
+import json
+import os
+from .checkpoints import CheckpointWriter
 
 
 # noinspection PyAttributeOutsideInit
 class TrainingHistory(Callback):
     """
     Track different aspects of the network and network performance
-    during training.
+    during training. Losses and metrics are stored in preallocated
+    numpy arrays with one column per loss or metric, and can be
+    written to an append-only log file by a background thread.
     """
-    def __init__(self, metrics, recurrent_id,  save_every, filename, param_id=1):
+    def __init__(self, metrics, recurrent_id,  save_every, filename, param_id=1,
+                 batch_metrics=False, log_file=None, esp_every=None, keep_checkpoints=None):
         """
         :param metrics:        metrics to be monitored during training
         :param recurrent_id:   id of the recurrent layer 
         :param save_every:     store model every save_every epochs
         :param filename:       filename to write trained model to
-        :param_id:             
+        :param param_id:       id of the recurrent weights in the weights of the recurrent layer
+        :param batch_metrics:  also store losses and metrics on the training set after every batch
+        :param log_file:       file to append losses and metrics to, as one json dictionary per line
+        :param esp_every:      compute the spectral radius of the recurrent weights every esp_every epochs
+        :param keep_checkpoints: number of most recent checkpoints written every save_every epochs
+                               to keep on disk, None to keep all
         """
         assert (isinstance(metrics, dict) or isinstance(metrics, list))
         self.recurrent_id = recurrent_id
@@ -27,70 +41,289 @@ class TrainingHistory(Callback):
         self.filename = filename
         if isinstance(metrics, list):
             self.metrics = {'output': metrics}
+        self.batch_metrics = batch_metrics
+        self.log_file = log_file
+        self.esp_every = esp_every
+        self.keep_checkpoints = keep_checkpoints
+
+        # one column per loss and metric, with the names keras uses in logs
+        self.columns = []
+        for output in sorted(self.metrics):
+            for metric in ['loss'] + list(self.metrics[output]):
+                self.columns += [self.log_name(output, metric), self.log_name(output, metric, validation=True)]
+        self.column_ids = dict([(column, i) for i, column in enumerate(self.columns)])
+        self.batch_columns = [column for column in self.columns if not column.startswith('val_')]
+
+        self.values = np.zeros((0, len(self.columns)))
+        self.batch_values = np.zeros((0, len(self.batch_columns)))
+        self.esp, self.esp_epochs = [], []
+        self.i, self.n_batches = 0, 0
+
+    def log_name(self, output, metric, validation=False):
+        """
+        Return the name keras uses in logs for a metric of an output.
+        """
+        name = '' if len(self.metrics) == 1 else output + '_'
+        return ('val_' if validation else '') + name + metric
 
-    def on_train_begin(self, logs={}):
+    def column(self, name):
+        """
+        Return array with the values of a loss or metric
+        for all finished epochs.
+        """
+        return self.values[:self.i, self.column_ids[name]]
 
-        # if metrics is a dictionary, model has multiple outputs
-        self.losses = dict([(output, []) for output in self.metrics])
-        self.val_losses = dict([(output, []) for output in self.metrics])
-        self.prediction_error = dict([(output, []) for output in self.metrics])
+    def batch_column(self, name):
+        return self.batch_values[:self.n_batches, self.batch_columns.index(name)]
 
-        self.metrics_train = dict([(output, dict([(self.metrics[output][metric], []) for metric in xrange(len(self.metrics[output]))])) for output in self.metrics])       # track metrics on training set
-        self.metrics_val = dict([(output, dict([(self.metrics[output][metric], []) for metric in xrange(len(self.metrics[output]))])) for output in self.metrics])       # track metrics on training set
+    @property
+    def losses(self):
+        return dict([(output, self.column(self.log_name(output, 'loss'))) for output in self.metrics])
+
+    @property
+    def val_losses(self):
+        return dict([(output, self.column(self.log_name(output, 'loss', validation=True))) for output in self.metrics])
+
+    @property
+    def metrics_train(self):
+        return dict([(output, dict([(metric, self.column(self.log_name(output, metric)))
+                                    for metric in self.metrics[output]])) for output in self.metrics])
+
+    @property
+    def metrics_val(self):
+        return dict([(output, dict([(metric, self.column(self.log_name(output, metric, validation=True)))
+                                    for metric in self.metrics[output]])) for output in self.metrics])
+
+    def on_train_begin(self, logs={}):
 
-        self.esp = []                   # track esp recurrent layer
+        # preallocate arrays for all epochs (and batches)
+        epochs = max(self.params.get('epochs') or 1, 1)
+        self.values = np.full((epochs, len(self.columns)), np.nan)
+        self.epoch_ids = np.zeros(epochs, dtype=int)
         self.i = 0                      # track epoch nr
 
+        if self.batch_metrics:
+            steps = self.params.get('steps') or \
+                int(np.ceil(float(self.params.get('samples') or 1) / (self.params.get('batch_size') or 1)))
+            self.batch_values = np.full((epochs * max(steps, 1), len(self.batch_columns)), np.nan)
+            self.n_batches = 0
+
+        self.esp, self.esp_epochs = [], []   # track esp recurrent layer
+
+        # write checkpoints in background
+        self.checkpoints = None
+        if self.filename and self.save_every != float("inf"):
+            self.checkpoints = CheckpointWriter(keep=self.keep_checkpoints)
+
+        # write logs and compute esp in background
+        self.queue = None
+        if self.log_file or self.esp_every:
+            self.queue = Queue.Queue()
+            self.writer = threading.Thread(target=self._process_queue)
+            self.writer.daemon = True
+            self.writer.start()
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs={}):
+        if not self.batch_metrics:
+            return
+
+        if self.n_batches == len(self.batch_values):
+            self.batch_values = _grow(self.batch_values)
+
+        row = self.batch_values[self.n_batches]
+        for i, column in enumerate(self.batch_columns):
+            row[i] = logs.get(column, np.nan)
+        self.n_batches += 1
+
+        if self.log_file:
+            self.queue.put(('batch', self.epoch, batch, self.batch_columns, row.copy()))
+
     def on_epoch_end(self, epoch, logs={}):
         """
-        Append tracking objects to their respective lists
+        Store losses and metrics in their columns
         """
-        for output in self.metrics:
-            if len(self.metrics) == 1:
-                name = ''
-            else:
-                name = output + '_'
+        if self.i == len(self.values):
+            self.values = _grow(self.values)
+            self.epoch_ids = np.concatenate([self.epoch_ids, np.zeros_like(self.epoch_ids)])
 
-            self.losses[output].append(logs.get(name+'loss'))
-            self.losses[output].append(logs.get('val_'+name+'loss'))
+        row = self.values[self.i]
+        for i, column in enumerate(self.columns):
+            row[i] = logs.get(column, np.nan)
+        self.epoch_ids[self.i] = epoch
 
-            for metric in self.metrics[output]:
-                self.metrics_train[output][metric].append(logs.get(name+metric))
-                self.metrics_val[output][metric].append(logs.get('val_'+name+metric))
+        if self.log_file:
+            self.queue.put(('epoch', epoch, None, self.columns, row.copy()))
 
-        if self.i % self.save_every == 0 and self.i != 0:
-            self.write_to_file()
-
-        self.i += 1
+        # compute esp on weights snapshot
+        if self.esp_every and self.i % self.esp_every == 0:
+            recurrent_weights = self.model.layers[self.recurrent_id].get_weights()[self.param_id]
+            self.queue.put(('esp', epoch, None, None, recurrent_weights))
 
-        # compute esp
-        # recurrent_weights = self.model.layers[self.recurrent_id].get_weights()[self.param_id]
-        # spec = np.max(np.absolute(np.linalg.eig(recurrent_weights)[0]))
-        # self.esp.append(spec)
+        if self.checkpoints is not None and self.i % self.save_every == 0 and self.i != 0:
+            self.checkpoints.save(self.model, self.checkpoint_name() + '.h5')
 
+        self.i += 1
 
-    def on_train_end(self, logs):
+    def on_train_end(self, logs={}):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.writer.join()
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+            if self.checkpoints.dropped:
+                print("%i checkpoints were not written because writing could not keep up" % self.checkpoints.dropped)
         self.write_to_file()
 
+    def _process_queue(self):
+        """
+        Process logs and weight snapshots put in the queue
+        during training, until None is received.
+        """
+        f = open(self.log_file, 'a') if self.log_file else None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, epoch, batch, columns, values = item
+            if kind == 'esp':
+                self.esp.append(spectral_radius(values))
+                self.esp_epochs.append(epoch)
+                line = {'kind': 'esp', 'epoch': epoch, 'esp': self.esp[-1]}
+            else:
+                line = dict(zip(columns, [float(value) for value in values]))
+                line.update({'kind': kind, 'epoch': int(epoch), 'batch': batch})
+            if f:
+                f.write(json.dumps(line) + '\n')
+                if self.queue.empty():
+                    f.flush()
+        if f:
+            f.close()
+
+    def checkpoint_name(self):
+        if self.save_every == float("inf"):
+            return self.filename
+        return self.filename+'_'+str(self.i)
+
     def write_to_file(self):
         """
-        Save model to file.
+        Save model, including optimizer state, to file.
+        The model is written to a temporary file first, such
+        that an existing file is only replaced by a complete model.
         """
         if not self.filename:
             return
-        elif self.save_every == float("inf"):
-            filename = self.filename
+
+        filename = self.checkpoint_name() + '.h5'
+        self.model.save(filename + '.tmp', overwrite=True)
+        os.rename(filename + '.tmp', filename)
+
+
+def spectral_radius(weights):
+    """
+    Compute the spectral radius of a recurrent weight matrix.
+    Recurrent kernels of GRUs and LSTMs contain square blocks
+    for every gate, the radius of every block is returned.
+    """
+    units = weights.shape[0]
+    return [float(np.max(np.abs(np.linalg.eigvals(weights[:, start:start+units]))))
+            for start in xrange(0, weights.shape[1], units)]
+
+
+def _grow(array):
+    """
+    Double the number of rows of an array, filling
+    the new rows with nan.
+    """
+    return np.concatenate([array, np.full(array.shape, np.nan)])
+
+
+class EarlyStopping(Callback):
+    """
+    Stop training when a loss or metric tracked by a
+    TrainingHistory callback has stopped improving.
+    """
+    def __init__(self, history, monitor='loss', output=None, validation=True, mode='auto', patience=5, min_delta=0.0):
+        """
+        :param history:        TrainingHistory callback that tracks the metrics,
+                               should precede this callback in the list of callbacks
+        :param monitor:        'loss' or name of a metric tracked by history
+        :param output:         output to monitor, can be left out for single output models
+        :param validation:     monitor value on validation set instead of training set
+        :param mode:           'min', 'max' or 'auto' (max for accuracies, min otherwise)
+        :param patience:       number of epochs without improvement after which training is stopped
+        :param min_delta:      minimum change that counts as an improvement
+        """
+        self.history = history
+        self.monitor = monitor
+        self.output = output
+        self.validation = validation
+        self.patience = patience
+        self.min_delta = abs(min_delta)
+        if mode == 'auto':
+            mode = 'max' if 'accuracy' in monitor else 'min'
+        if mode not in ['min', 'max']:
+            raise ValueError("Unknown mode %s" % mode)
+        self.sign = {'min': 1, 'max': -1}[mode]
+
+    def on_train_begin(self, logs={}):
+        if self.output is None:
+            assert len(self.history.metrics) == 1, "specify output to monitor for models with multiple outputs"
+            self.output = list(self.history.metrics)[0]
+        self.wait = 0
+        self.stopped_epoch = None
+        self.best = float("inf")
+
+    def current(self):
+        """
+        Return the last value of the monitored quantity.
+        """
+        if self.monitor == 'loss':
+            values = (self.history.val_losses if self.validation else self.history.losses)[self.output]
         else:
-            filename = self.filename+'_'+str(self.i)
+            values = (self.history.metrics_val if self.validation else self.history.metrics_train)[self.output][self.monitor]
+        if not len(values) or np.isnan(values[-1]):
+            return None
+        return values[-1]
 
-        self.model.save(filename+'.h5', overwrite=False)
+    def on_epoch_end(self, epoch, logs={}):
+        current = self.current()
+        if current is None:
+            return
 
+        # compare values with sign, such that lower is always better
+        if self.sign * current < self.best - self.min_delta:
+            self.best = self.sign * current
+            self.wait = 0
+        else:
+            self.wait += 1
+            if self.wait >= self.patience:
+                self.stopped_epoch = epoch
+                self.model.stop_training = True
 
-class VisualiseEmbeddings(Callback):
 
-    def __init__(self, dmap, embeddings_id):
+class VisualiseEmbeddings(Callback):
+    """
+    Record snapshots of the embeddings during training. Snapshots
+    are stored in a preallocated ring buffer (in memory or in a
+    memory mapped file), such that recording uses constant memory
+    for runs of any length. If the buffer is full, the oldest
+    snapshots are overwritten.
+    """
+    def __init__(self, dmap, embeddings_id, every=10, schedule='every', growth=1.5, max_snapshots=1000, filename=None):
         """
         Plot embeddings
+        :param dmap:            map from symbols to embedding ids
+        :param embeddings_id:   id of the embeddings layer
+        :param every:           take a snapshot every n batches (for schedule 'every')
+        :param schedule:        'every' to take snapshots at fixed intervals, 'log' to take
+                                snapshots at log-spaced batches, that are each growth times
+                                further apart than the previous snapshot
+        :param growth:          growth of interval between snapshots for schedule 'log'
+        :param max_snapshots:   size of the ring buffer
+        :param filename:        .npy file to store snapshots in, if None they are kept in memory
         """
         # import plotting library
         # import matplotlib
@@ -100,46 +333,88 @@ class VisualiseEmbeddings(Callback):
         # self.ax = self.fig.add_subplot(1, 1, 1)
         # self.ax.set_xlim([-1, 1])
         # self.ax.set_ylim([-1, 1])
+        if schedule not in ['every', 'log']:
+            raise ValueError("Unknown schedule %s" % schedule)
         self.embeddings_id = embeddings_id
         self.dmap = dict(zip(dmap.values(), dmap.keys()))
         # self.cmap = self.make_cmap(self.dmap)
-        self.all_weights = []
+        self.every = every
+        self.schedule = schedule
+        self.growth = growth
+        self.max_snapshots = max_snapshots
+        self.filename = filename
+        self.buffer = None
+        self.n_snapshots = 0
 
     def on_train_begin(self, logs={}):
         # check if embeddings have correct dimensionality
-        assert self.model.layers[self.embeddings_id].get_weights()[0].shape[1] == 2, "only 2D embddings can be visualised"
-
-        img = []
         weights = self.model.layers[self.embeddings_id].get_weights()[0]
-        self.all_weights.append(weights)
-        # for i in xrange(1, len(weights)):
-        #     xy = tuple(weights[i])
-        #     x, y = xy
-        #     img += self.ax.plot(x, y, 'o')
-        #     img.append(self.ax.annotate(self.dmap[i], xy=xy))
-        # plt.plot()
-        # self.imgs = [img]
-        self.i=0
+        assert weights.shape[1] == 2, "only 2D embddings can be visualised"
+
+        # preallocate buffer
+        shape = (self.max_snapshots,) + weights.shape
+        if self.filename:
+            self.buffer = np.lib.format.open_memmap(self.filename, mode='w+', dtype=weights.dtype, shape=shape)
+        else:
+            self.buffer = np.zeros(shape, dtype=weights.dtype)
+        self.batches = np.zeros(self.max_snapshots, dtype=int)
+        self.n_snapshots = 0
+
+        self.i = 0
+        self.next_snapshot = 0
+        self.snapshot()
 
     def on_batch_end(self, batch, logs={}):
-        # get snapshot of the embedding weights every 20 batches
-        if self.i % 10 == 0:
-            weights = self.model.layers[self.embeddings_id].get_weights()[0]
-            self.all_weights.append(weights)
-            # img = []
-            # for i in xrange(1, len(weights)):
-            #     xy = tuple(weights[i])
-            #     x, y = xy
-            #     img += self.ax.plot(x, y, 'o', color=self.cmap[i])
-            #     img.append(self.ax.annotate(self.dmap[i], xy=xy))
-
-            # plt.plot()
-            # self.imgs.append(img)
-        self.i+=1
+        # get snapshot of the embedding weights according to schedule
+        self.i += 1
+        if self.i >= self.next_snapshot:
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Store current embeddings in the buffer and
+        determine the batch of the next snapshot.
+        """
+        slot = self.n_snapshots % self.max_snapshots
+        self.buffer[slot] = self.model.layers[self.embeddings_id].get_weights()[0]
+        self.batches[slot] = self.i
+        self.n_snapshots += 1
+
+        if self.schedule == 'every':
+            self.next_snapshot = self.i + self.every
+        else:
+            self.next_snapshot = max(self.i + 1, int(np.ceil(self.i * self.growth)))
 
+    def order(self):
+        """
+        Return the slots of the buffer in chronological order.
+        """
+        if self.n_snapshots <= self.max_snapshots:
+            return np.arange(self.n_snapshots)
+        start = self.n_snapshots % self.max_snapshots
+        return np.roll(np.arange(self.max_snapshots), -start)
+
+    @property
+    def all_weights(self):
+        """
+        Array with all recorded snapshots in chronological order.
+        """
+        if self.buffer is None:
+            return np.zeros((0,))
+        return self.buffer[self.order()]
+
+    @property
+    def snapshot_batches(self):
+        """
+        Batch numbers at which the recorded snapshots were taken.
+        """
+        if self.buffer is None:
+            return np.zeros((0,), dtype=int)
+        return self.batches[self.order()]
 
     def on_train_end(self, logs={}):
-        pass
+        if isinstance(self.buffer, np.memmap):
+            self.buffer.flush()
         # Create animation of weight changes
         # anim = animation.ArtistAnimation(self.fig, self.imgs, interval=500, blit=False, repeat_delay=3000)
         # plt.show()
@@ -0,0 +1,176 @@
+"""
+Write checkpoints of keras models in a background thread,
+such that models can be saved frequently during training
+without slowing down training.
+"""
+
+from keras import backend as K
+import keras
+import threading
+import collections
+import h5py
+import os
+
+
+class CheckpointWriter(object):
+    """
+    Snapshot the weights of a model in memory and write
+    them to HDF5 files in a worker thread. Files are written
+    to a temporary file and renamed when complete, such that
+    a checkpoint on disk is never partially written. The files
+    can be loaded with keras.models.load_model (without optimizer
+    state) or with model.load_weights.
+    An error in writing a checkpoint is raised in the training
+    thread, by the next call of save, wait or close.
+    """
+    def __init__(self, keep=None, max_pending=2, block=False):
+        """
+        :param keep:        number of most recent checkpoints to keep on disk,
+                            None to keep all checkpoints
+        :param max_pending: maximum number of snapshots waiting to be written,
+                            if writing cannot keep up the oldest waiting snapshot
+                            is dropped (and counted in dropped)
+        :param block:       instead of dropping snapshots, let save wait until there
+                            is room. This stalls training when checkpoints are saved
+                            more often than they can be written
+        """
+        self.keep = keep
+        self.max_pending = max_pending
+        self.block = block
+        self.written = []
+        self.dropped = 0
+        self.errors = []
+
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.writing = False
+        self.model_configs = {}
+
+        self.thread = threading.Thread(target=self._write_pending)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, model, filename):
+        """
+        Snapshot the weights of model, to be written to filename.
+        """
+        self._raise_error()
+        # the configuration of a model does not change during training
+        if id(model) not in self.model_configs:
+            self.model_configs[id(model)] = model.to_json()
+
+        layers = [(layer.name, [str(w.name) if getattr(w, 'name', None) else 'param_%i' % i
+                                for i, w in enumerate(layer.weights)], len(layer.weights))
+                  for layer in model.layers]
+        values = K.batch_get_value([w for layer in model.layers for w in layer.weights])
+
+        with self.condition:
+            if self.closed:
+                raise ValueError("CheckpointWriter is closed")
+            while self.block and len(self.pending) >= self.max_pending and not self.errors:
+                self.condition.wait()
+            self._raise_error()
+            self.pending.append((filename, self.model_configs[id(model)], layers, values))
+            # the oldest snapshots would be the first removed by keep anyway
+            while len(self.pending) > self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+            self.condition.notify_all()
+
+    def wait(self):
+        """
+        Wait until all pending snapshots are written.
+        """
+        with self.condition:
+            while self.pending or self.writing:
+                self.condition.wait()
+        self._raise_error()
+
+    def close(self):
+        """
+        Write pending snapshots and stop the worker thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        # raise the first error of the worker thread (once)
+        with self.condition:
+            if not self.errors:
+                return
+            error = self.errors[0]
+            del self.errors[:]
+        raise error
+
+    def _write_pending(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                snapshot = self.pending.popleft()
+                self.writing = True
+                self.condition.notify_all()
+
+            try:
+                self._write(*snapshot)
+            except Exception as e:
+                self.errors.append(e)
+
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def _write(self, filename, model_config, layers, values):
+        tmp_file = filename + '.tmp'
+        f = h5py.File(tmp_file, 'w')
+        try:
+            f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+            f.attrs['backend'] = K.backend().encode('utf8')
+            f.attrs['model_config'] = model_config.encode('utf8')
+
+            group = f.create_group('model_weights')
+            group.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in layers]
+            group.attrs['backend'] = K.backend().encode('utf8')
+            group.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+
+            start = 0
+            for layer_name, weight_names, n_weights in layers:
+                g = group.create_group(layer_name)
+                g.attrs['weight_names'] = [name.encode('utf8') for name in weight_names]
+                for name, value in zip(weight_names, values[start:start+n_weights]):
+                    g.create_dataset(name, data=value)
+                start += n_weights
+        finally:
+            f.close()
+
+        os.rename(tmp_file, filename)
+
+        if filename in self.written:
+            self.written.remove(filename)
+        self.written.append(filename)
+        if self.keep:
+            while len(self.written) > self.keep:
+                old_file = self.written.pop(0)
+                if os.path.exists(old_file):
+                    os.remove(old_file)
+
+
+def load_optimizer_weights(filename):
+    """
+    Return the values of the optimizer weights stored in a
+    model file written by model.save, None if it has none.
+    """
+    f = h5py.File(filename, 'r')
+    try:
+        if 'optimizer_weights' not in f:
+            return None
+        group = f['optimizer_weights']
+        return [group[name][()] for name in [n.decode('utf8') for n in group.attrs['weight_names']]]
+    finally:
+        f.close()
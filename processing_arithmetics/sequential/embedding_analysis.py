@@ -0,0 +1,142 @@
+"""
+Vectorized analysis of embedding matrices. All functions
+accept either a single embeddings matrix of shape (n, d) or
+the embedding matrices of a population of models stacked into
+an array of shape (models, n, d), in which case statistics
+are computed for all models in one call.
+"""
+
+from scipy.stats import rankdata
+import numpy as np
+
+
+def _stack(embeddings):
+    """
+    Return embeddings as float array of shape (models, n, d)
+    and whether the input was a single matrix.
+    """
+    embeddings = np.asarray(embeddings, dtype='float64')
+    if embeddings.ndim == 2:
+        return embeddings[np.newaxis], True
+    return embeddings, False
+
+
+def stack_embeddings(models):
+    """
+    Stack the embedding matrices of a list of keras
+    models into an array of shape (models, n, d).
+    """
+    matrices = []
+    for model in models:
+        layer = [layer for layer in model.layers if layer.__class__.__name__ == 'Embedding'][0]
+        matrices.append(layer.get_weights()[0])
+    return np.stack(matrices)
+
+
+def pairwise_distances(embeddings):
+    """
+    Compute euclidean distances between all pairs of rows.
+    :param embeddings:  array of shape (n, d) or (models, n, d)
+    :return:            array of shape (n, n) or (models, n, n)
+    """
+    stacked, single = _stack(embeddings)
+    squared_norms = np.einsum('mnd,mnd->mn', stacked, stacked)
+    gram = np.einsum('mid,mjd->mij', stacked, stacked)
+    squared = squared_norms[:, :, np.newaxis] + squared_norms[:, np.newaxis, :] - 2 * gram
+    # remove negative values caused by rounding errors
+    distances = np.sqrt(np.maximum(squared, 0))
+    distances[:, np.arange(stacked.shape[1]), np.arange(stacked.shape[1])] = 0
+    return distances[0] if single else distances
+
+
+def pair_distances(embeddings):
+    """
+    Return the distances of all unordered pairs of rows,
+    in the order of itertools.combinations.
+    :return: array of shape (pairs,) or (models, pairs)
+    """
+    distances = pairwise_distances(embeddings)
+    i, j = np.triu_indices(distances.shape[-1], k=1)
+    return distances[..., i, j]
+
+
+def embedding_norms(embeddings):
+    """
+    Compute the length of every row.
+    :return: array of shape (n,) or (models, n)
+    """
+    return np.linalg.norm(np.asarray(embeddings, dtype='float64'), axis=-1)
+
+
+def digit_ordering(embeddings, dmap, digits=np.arange(-10, 11)):
+    """
+    Measure to what extent the embeddings of the digits
+    reflect their numerical order.
+    :param embeddings:  array of shape (n, d) or (models, n, d), rows indexed by dmap values
+    :param dmap:        map from symbols to rows of the embeddings matrix
+    :param digits:      digits to include
+    :return:            dictionary with per model
+                        distance_correlation: spearman correlation between the numerical
+                                              difference of digit pairs and their distance
+                        projection_correlation: spearman correlation between the digits and
+                                                their projection on the line between the
+                                                embeddings of the lowest and highest digit
+    """
+    stacked, single = _stack(embeddings)
+    digits = np.sort(np.asarray(digits))
+    rows = [dmap[str(digit)] for digit in digits]
+    digit_embeddings = stacked[:, rows]
+
+    i, j = np.triu_indices(len(digits), k=1)
+    differences = np.abs(digits[i] - digits[j])
+    distances = pairwise_distances(digit_embeddings)[:, i, j]
+    distance_correlation = _spearman(np.broadcast_to(differences, distances.shape), distances)
+
+    direction = digit_embeddings[:, -1] - digit_embeddings[:, 0]
+    projections = np.einsum('mnd,md->mn', digit_embeddings - digit_embeddings[:, :1], direction)
+    projection_correlation = _spearman(np.broadcast_to(digits, projections.shape), projections)
+
+    statistics = {'distance_correlation': distance_correlation,
+                  'projection_correlation': projection_correlation}
+    if single:
+        return dict([(key, value[0]) for key, value in statistics.items()])
+    return statistics
+
+
+def embedding_statistics(embeddings, dmap=None, digits=np.arange(-10, 11)):
+    """
+    Compute distance, norm and (if dmap is given) digit
+    ordering statistics of a single embeddings matrix or a
+    population of embedding matrices.
+    :return: dictionary mapping names of statistics to values
+             or arrays with one value per model
+    """
+    stacked, single = _stack(embeddings)
+    distances = pair_distances(stacked)
+    norms = embedding_norms(stacked)
+
+    statistics = {'mean_distance': distances.mean(axis=-1),
+                  'std_distance': distances.std(axis=-1),
+                  'min_distance': distances.min(axis=-1),
+                  'max_distance': distances.max(axis=-1),
+                  'mean_norm': norms.mean(axis=-1),
+                  'std_norm': norms.std(axis=-1)}
+
+    if dmap is not None:
+        statistics.update(digit_ordering(stacked, dmap, digits))
+
+    if single:
+        return dict([(key, value[0]) for key, value in statistics.items()])
+    return statistics
+
+
+def _spearman(x, y):
+    """
+    Compute spearman rank correlation between the rows
+    of x and y, tied values get their average rank.
+    """
+    rank_x = np.apply_along_axis(rankdata, -1, x)
+    rank_y = np.apply_along_axis(rankdata, -1, y)
+    rank_x -= rank_x.mean(axis=-1, keepdims=True)
+    rank_y -= rank_y.mean(axis=-1, keepdims=True)
+    return (rank_x * rank_y).sum(axis=-1) / np.sqrt((rank_x ** 2).sum(axis=-1) * (rank_y ** 2).sum(axis=-1))
@@ -0,0 +1,201 @@
+"""
+Extract hidden layer activations and gate values of trained
+models for entire treebanks, and store them on disk without
+padding.
+
+Activations are stored in a RaggedStore: a folder with one
+array per stored quantity, in which the timesteps of all
+sequences are concatenated, and an array with offsets that
+marks where every sequence starts. Arrays are opened as
+memory maps, such that stores with millions of timesteps can
+be analysed without loading them in memory.
+"""
+
+import keras.preprocessing.sequence
+import numpy as np
+import glob
+import json
+import os
+
+
+class RaggedStore(object):
+    """
+    Collection of arrays with values for every timestep
+    of a set of sequences of varying length.
+    """
+    def __init__(self, path, mode='r'):
+        """
+        Open an existing store.
+        :param path:    folder containing the store
+        :param mode:    'r' to open read only, 'r+' to allow changing values
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.names = [str(name) for name in self.meta['names']]
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.arrays = dict([(name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mode))
+                            for name in self.names])
+
+    @classmethod
+    def create(cls, path, lengths, shapes, dtypes=None, meta=None):
+        """
+        Create a new store with preallocated arrays.
+        :param path:    folder to create the store in
+        :param lengths: lengths of the sequences in the store
+        :param shapes:  dictionary mapping names of arrays to the shape of their
+                        values for a single timestep, e.g. {'hidden': (15,)}
+        :param dtypes:  dictionary mapping names of arrays to dtypes, default float32
+        :param meta:    dictionary with extra information to store
+        """
+        dtypes = dtypes or {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        _remove_cached(path)
+
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype('int64')
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+
+        for name, shape in shapes.items():
+            array = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                              dtype=dtypes.get(name, 'float32'),
+                                              shape=(int(offsets[-1]),) + tuple(shape))
+            del array
+
+        info = dict(meta or {})
+        info['names'] = sorted(shapes.keys())
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(info, f)
+
+        return cls(path, mode='r+')
+
+    def add_array(self, name, shape, dtype='float32'):
+        """
+        Add a new preallocated array to the store, with
+        values of the given shape for every timestep. An
+        existing array with the same name is overwritten.
+        """
+        _remove_cached(self.path, [name])
+        array = np.lib.format.open_memmap(os.path.join(self.path, name + '.npy'), mode='w+',
+                                          dtype=dtype, shape=(self.n_timesteps(),) + tuple(shape))
+        self.arrays[name] = array
+        if name not in self.names:
+            self.names.append(name)
+            self.meta['names'] = self.names
+            with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+                json.dump(self.meta, f)
+
+        return array
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """
+        Return dictionary with the values of all arrays
+        for sequence i.
+        """
+        return dict([(name, self.sequence(name, i)) for name in self.names])
+
+    def n_timesteps(self):
+        return int(self.offsets[-1])
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def values(self, name):
+        """
+        Return (memory mapped) array with the values of
+        all timesteps of all sequences.
+        """
+        return self.arrays[name]
+
+    def sequence(self, name, i):
+        return self.arrays[name][self.offsets[i]:self.offsets[i+1]]
+
+    def sequences(self, name, indices):
+        return [self.sequence(name, i) for i in indices]
+
+    def write(self, name, first_sequence, values):
+        """
+        Write values of consecutive sequences, starting at
+        sequence first_sequence.
+        """
+        start = self.offsets[first_sequence]
+        self.arrays[name][start:start+len(values)] = values
+
+    def iter_batches(self, name, batch_size=100000):
+        """
+        Iterate over the values of all timesteps in
+        batches of batch_size timesteps.
+        """
+        values = self.arrays[name]
+        for start in xrange(0, len(values), batch_size):
+            yield np.asarray(values[start:start+batch_size])
+
+    def flush(self):
+        for array in self.arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+
+
+def _remove_cached(path, names=None):
+    """
+    Remove the results computed from arrays of the store in path
+    (state spaces cached by statespace.state_space), because the
+    arrays are overwritten. All results if names is None.
+    """
+    for filename in glob.glob(os.path.join(path, 'statespace_*.npz')):
+        if names is None or any(os.path.basename(filename).startswith('statespace_%s_' % name) for name in names):
+            os.remove(filename)
+
+
+def extract_activations(training, treebank, path, batch_size=1000, gates=False, format='infix'):
+    """
+    Compute the hidden layer activations (and gate values)
+    of the model of training for all expressions in treebank,
+    in batches of batch_size expressions, and write them to
+    a RaggedStore. The store also contains the inputs of the
+    network (under 'inputs') and the answers of the expressions.
+    :param training:    Training object with a trained model
+    :param treebank:    MathTreebank or list of (expression, answer) tuples
+    :param path:        folder to write the store to
+    :param batch_size:  number of expressions to process at once
+    :param gates:       also store update and reset gate values, only available for GRUs
+    :param format:      format in which expressions are presented to the network
+    :return:            the RaggedStore with the activations
+    """
+    examples = getattr(treebank, 'examples', treebank)
+
+    sequences = [[training.dmap[symbol] for symbol in expression.to_string(format).split()]
+                 for expression, answer in examples]
+    lengths = [len(sequence) for sequence in sequences]
+
+    size_hidden = training.size_hidden
+    shapes = {'hidden': (size_hidden,), 'inputs': ()}
+    if gates:
+        shapes.update({'update_gate': (size_hidden,), 'reset_gate': (size_hidden,)})
+
+    meta = {'format': format, 'dmap': dict([(key, int(value)) for key, value in training.dmap.items()]),
+            'answers': [float(answer) for expression, answer in examples]}
+    store = RaggedStore.create(path, lengths, shapes, dtypes={'inputs': 'int32'}, meta=meta)
+
+    assert max(lengths) <= training.input_length, "Expressions are longer than input length of model"
+
+    for start in xrange(0, len(sequences), batch_size):
+        X = keras.preprocessing.sequence.pad_sequences(sequences[start:start+batch_size],
+                                                       maxlen=training.input_length, dtype='int32')
+        if gates:
+            outputs = zip(['hidden', 'update_gate', 'reset_gate'], training.get_gate_activations(X))
+        else:
+            outputs = [('hidden', training.get_sequence_activations(X))]
+
+        # sequences are padded at the front, selecting all non-padding
+        # timesteps gives the concatenation of the unpadded sequences
+        nonzero = X != 0
+        store.write('inputs', start, X[nonzero])
+        for name, activations in outputs:
+            store.write(name, start, activations[nonzero])
+
+    store.flush()
+    return store
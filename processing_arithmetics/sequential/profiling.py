@@ -0,0 +1,202 @@
+"""
+Measure where the time of a training run goes. A Profiler
+records wall time, cpu time, memory usage and examples per
+second for named phases of the training pipeline (treebank
+generation, data conversion, padding, building, compilation,
+fitting and testing).
+"""
+
+from keras.callbacks import Callback
+from collections import OrderedDict
+from contextlib import contextmanager
+import resource
+import time
+import os
+
+# profilers of the phases that are currently running,
+# such that nested functions can record phases
+_active = []
+
+
+def _usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on linux
+    return time.time(), usage.ru_utime + usage.ru_stime, _current_rss(), usage.ru_maxrss / 1024.
+
+
+def _current_rss():
+    """
+    Return the current resident set size in megabytes, or None on
+    systems without /proc (getrusage only gives the peak of the process).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024. ** 2
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class Profiler(object):
+    """
+    Record the resources used by phases of a training run.
+    """
+    def __init__(self):
+        self.records = []
+        self.depth = 0
+        self.n_started = 0
+
+    def start(self, name):
+        """
+        Start recording a phase, returns the record of the phase.
+        """
+        wall, cpu, rss, _ = _usage()
+        record = {'name': name, 'depth': self.depth, 'order': self.n_started, 'examples': None,
+                  'start_wall': wall, 'start_cpu': cpu, 'start_rss': rss}
+        self.depth += 1
+        self.n_started += 1
+        return record
+
+    def stop(self, record, n_examples=None):
+        """
+        Finish recording a phase.
+        """
+        wall, cpu, rss, peak_rss = _usage()
+        self.depth -= 1
+        start_rss = record.pop('start_rss')
+        record['wall'] = wall - record.pop('start_wall')
+        record['cpu'] = cpu - record.pop('start_cpu')
+        # current memory usage at the end of the phase and its change during the phase,
+        # and the peak memory usage of the process so far (not of the phase)
+        record['rss_mb'] = rss
+        record['rss_growth_mb'] = rss - start_rss if rss is not None and start_rss is not None else None
+        record['process_peak_rss_mb'] = peak_rss
+        if n_examples is not None:
+            record['examples'] = n_examples
+        self.records.append(record)
+        return record
+
+    @contextmanager
+    def phase(self, name, n_examples=None):
+        """
+        Record a phase in a with statement. The number of processed
+        examples can also be set after the phase started, by setting
+        the 'examples' field of the returned record.
+        """
+        record = self.start(name)
+        _active.append(self)
+        try:
+            yield record
+        finally:
+            _active.pop()
+            self.stop(record, n_examples)
+
+    def report(self):
+        """
+        Return an ordered dictionary mapping phase names to the
+        number of calls, total wall and cpu time, the largest memory
+        usage at the end of a call, the total memory growth, the peak
+        memory usage of the process and number of examples processed
+        per second.
+        """
+        report = OrderedDict()
+        # list phases in the order in which they were first started
+        for record in sorted(self.records, key=lambda r: r['order']):
+            summary = report.setdefault(record['name'], OrderedDict([
+                ('depth', record['depth']), ('calls', 0), ('wall', 0.0), ('cpu', 0.0),
+                ('rss_mb', None), ('rss_growth_mb', None), ('process_peak_rss_mb', 0.0), ('examples', None),
+                ('examples_per_second', None)]))
+            summary['calls'] += 1
+            summary['wall'] += record['wall']
+            summary['cpu'] += record['cpu']
+            if record['rss_mb'] is not None:
+                summary['rss_mb'] = max(summary['rss_mb'] or 0, record['rss_mb'])
+                summary['rss_growth_mb'] = (summary['rss_growth_mb'] or 0) + record['rss_growth_mb']
+            summary['process_peak_rss_mb'] = max(summary['process_peak_rss_mb'], record['process_peak_rss_mb'])
+            if record['examples'] is not None:
+                summary['examples'] = (summary['examples'] or 0) + record['examples']
+
+        for summary in report.values():
+            if summary['examples'] is not None and summary['wall'] > 0:
+                summary['examples_per_second'] = summary['examples'] / summary['wall']
+
+        return report
+
+    def summary(self):
+        """
+        Return a string with a table of the report.
+        """
+        lines = ['%-28s %6s %10s %10s %10s %12s' % ('phase', 'calls', 'wall (s)', 'cpu (s)', 'rss (MB)', 'examples/s')]
+        for name, summary in self.report().items():
+            eps = '%12.1f' % summary['examples_per_second'] if summary['examples_per_second'] else '%12s' % '-'
+            rss = '%10.1f' % summary['rss_mb'] if summary['rss_mb'] is not None else '%10s' % '-'
+            lines.append('%-28s %6i %10.3f %10.3f %s %s' % (
+                '  ' * summary['depth'] + name, summary['calls'], summary['wall'],
+                summary['cpu'], rss, eps))
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.records = []
+
+
+@contextmanager
+def phase(name, n_examples=None):
+    """
+    Record a phase with the profiler of the phase that is
+    currently running, do nothing if no phase is running.
+    """
+    if not _active:
+        yield {}
+    else:
+        with _active[-1].phase(name, n_examples) as record:
+            yield record
+
+
+def profile(name):
+    """
+    Decorator to record calls to a method of an object with
+    a profiler attribute as a phase. If the method returns
+    a tuple (X, Y) of training data, the number of examples
+    is recorded.
+    """
+    def decorator(method):
+        def profiled_method(self, *args, **kwargs):
+            profiler = getattr(self, 'profiler', None)
+            if profiler is None:
+                return method(self, *args, **kwargs)
+            with profiler.phase(name) as record:
+                result = method(self, *args, **kwargs)
+                record['examples'] = n_examples(result)
+            return result
+        profiled_method.__name__ = method.__name__
+        profiled_method.__doc__ = method.__doc__
+        return profiled_method
+    return decorator
+
+
+def n_examples(data):
+    """
+    Return the number of examples in training data (X, Y),
+    or None if data is not training data.
+    """
+    if not isinstance(data, tuple) or len(data) != 2:
+        return None
+    X = data[0]
+    if isinstance(X, dict):
+        X = list(X.values())[0]
+    elif isinstance(X, list):
+        X = X[0]
+    return len(X) if hasattr(X, '__len__') else None
+
+
+class ProfilingCallback(Callback):
+    """
+    Record every training epoch as a phase of a profiler.
+    """
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.record = self.profiler.start('epoch')
+
+    def on_epoch_end(self, epoch, logs={}):
+        self.profiler.stop(self.record, n_examples=self.params.get('samples'))
@@ -0,0 +1,147 @@
+"""
+Principal component analysis of the hidden layer state
+space of trained models, fitted over hidden layer activations
+streamed from a RaggedStore (see extraction.py), such that the
+trajectories of complete treebanks can be analysed.
+"""
+
+from sklearn.decomposition import IncrementalPCA, PCA
+from .extraction import RaggedStore
+import numpy as np
+import os
+
+
+class StateSpace(object):
+    """
+    Linear projection of the hidden layer state space
+    on its first principal components.
+    """
+    def __init__(self, n_components=2, method='incremental', batch_size=100000, max_samples=None, seed=0):
+        """
+        :param n_components:    number of principal components
+        :param method:          'incremental' to fit pca batch by batch, 'randomized'
+                                to fit randomized pca on (a sample of) all activations
+        :param batch_size:      number of timesteps processed at once
+        :param max_samples:     maximum number of timesteps used to fit randomized pca
+        :param seed:            seed for randomized pca and sampling
+        """
+        if method not in ['incremental', 'randomized']:
+            raise ValueError("Unknown pca method %s" % method)
+
+        self.n_components = n_components
+        self.method = method
+        self.batch_size = batch_size
+        self.max_samples = max_samples
+        self.seed = seed
+
+        self.components = None
+        self.mean = None
+        self.explained_variance_ratio = None
+
+    def fit(self, activations):
+        """
+        Fit the projection.
+        :param activations: RaggedStore, or array with activations for every timestep
+        """
+        if isinstance(activations, RaggedStore):
+            activations = activations.values('hidden')
+
+        n = len(activations)
+
+        if self.method == 'incremental':
+            pca = IncrementalPCA(n_components=self.n_components)
+            # incremental pca needs at least n_components samples per batch,
+            # add a too small final batch to the previous one
+            starts = range(0, n, self.batch_size)
+            if len(starts) > 1 and n - starts[-1] < self.n_components:
+                starts = starts[:-1]
+            for start, end in zip(starts, starts[1:] + [n]):
+                pca.partial_fit(np.asarray(activations[start:end], dtype='float64'))
+
+        else:
+            if self.max_samples and n > self.max_samples:
+                rng = np.random.RandomState(self.seed)
+                sample = np.sort(rng.choice(n, self.max_samples, replace=False))
+                activations = activations[sample]
+            pca = PCA(n_components=self.n_components, svd_solver='randomized', random_state=self.seed)
+            pca.fit(np.asarray(activations))
+
+        self.components = pca.components_
+        self.mean = pca.mean_
+        self.explained_variance_ratio = pca.explained_variance_ratio_
+
+        return self
+
+    def transform(self, activations):
+        """
+        Project activations on the principal components.
+        :param activations: array of shape (..., size_hidden)
+        :return:            array of shape (..., n_components)
+        """
+        if self.components is None:
+            raise ValueError("StateSpace should be fitted before projecting activations")
+        return np.dot(np.asarray(activations) - self.mean, self.components.T)
+
+    def project_store(self, store, name='hidden', out_name=None):
+        """
+        Project all activations in a store in batches, and
+        add the resulting trajectories to the store.
+        :param store:       RaggedStore with hidden layer activations
+        :param name:        name of the array with activations to project
+        :param out_name:    name of array with projections, default <name>_pc
+        :return:            memory mapped array with projections for all timesteps
+        """
+        out_name = out_name or name + '_pc'
+        projected = store.add_array(out_name, (self.n_components,))
+        values = store.values(name)
+        for start in xrange(0, len(values), self.batch_size):
+            projected[start:start+self.batch_size] = self.transform(values[start:start+self.batch_size])
+
+        store.flush()
+        return projected
+
+    def trajectories(self, store, indices=None, name='hidden'):
+        """
+        Return a list with the projected trajectory through the
+        state space for every sequence in indices.
+        """
+        indices = xrange(len(store)) if indices is None else indices
+        return [self.transform(store.sequence(name, i)) for i in indices]
+
+    def save(self, filename):
+        np.savez(filename, components=self.components, mean=self.mean,
+                 explained_variance_ratio=self.explained_variance_ratio,
+                 method=self.method, n_components=self.n_components)
+
+    @classmethod
+    def load(cls, filename):
+        f = np.load(filename)
+        state_space = cls(n_components=int(f['n_components']), method=str(f['method']))
+        state_space.components = f['components']
+        state_space.mean = f['mean']
+        state_space.explained_variance_ratio = f['explained_variance_ratio']
+        return state_space
+
+
+def state_space(store, n_components=2, method='incremental', name='hidden', **kwargs):
+    """
+    Return the state space of the activations in store. The
+    fitted projection is cached in the folder of the store, such
+    that it is computed only once for the model the activations
+    were extracted from.
+    :param store:           RaggedStore with activations
+    :param n_components:    number of principal components
+    :param method:          'incremental' or 'randomized'
+    :param name:            name of array with activations
+    :param kwargs:          other arguments passed to StateSpace
+    """
+    cache_file = os.path.join(store.path, 'statespace_%s_%s_%i.npz' % (name, method, n_components))
+
+    if os.path.exists(cache_file):
+        return StateSpace.load(cache_file)
+
+    space = StateSpace(n_components=n_components, method=method, **kwargs)
+    space.fit(store.values(name))
+    space.save(cache_file)
+
+    return space
@@ -0,0 +1,524 @@
+"""
+Run hyperparameter sweeps over the sequential training
+architectures.
+
+A sweep is described by a specification dictionary that mirrors
+the arguments of scripts/train_sequential_model.py, e.g.:
+
+    {
+        "search": "grid",
+        "parameters": {
+            "recurrent_layer": ["SimpleRNN", "GRU"],
+            "size_hidden": [10, 15, 20],
+            "format": ["infix", "prefix"]
+        },
+        "fixed": {"architecture": "ScalarPrediction", "nb_epochs": 100}
+    }
+
+For random search ("search": "random", "n_trials": N) a parameter
+can also be given as a distribution, e.g.
+{"distribution": "loguniform", "low": 0.0001, "high": 0.1}.
+Every trial writes its results to a separate file, such that an
+interrupted sweep can be resumed by running it again with the
+same output directory.
+
+Trials can be stopped early with an "early_stopping" dictionary in
+"fixed" (see callbacks.EarlyStopping). To spend the training budget
+on promising configurations, successive halving can be switched on
+by adding e.g.
+
+    "pruning": {"min_epochs": 5, "eta": 3,
+                "monitor": "val_mean_squared_error", "mode": "min"}
+
+to the specification: all trials are trained for min_epochs epochs,
+after which only the best 1/eta of them are trained further, for eta
+times as many epochs, and so on until nb_epochs is reached. Every
+rung writes its models to models/<trial_id>_rung<rung>.h5, the next
+rung continues from these weights and the state of the optimizer.
+"""
+
+from __future__ import print_function
+from keras.layers import SimpleRNN, GRU, LSTM
+from keras import backend as K
+from collections import OrderedDict
+from .architectures import ScalarPrediction, ComparisonTraining, Seq2Seq, DiagnosticClassifier, DiagnosticTrainer
+from .checkpoints import load_optimizer_weights
+from ..arithmetics.treebanks import treebank
+import multiprocessing
+import itertools
+import gc
+import hashlib
+import pickle
+import json
+import os
+import numpy as np
+
+
+architectures = {'ScalarPrediction': ScalarPrediction, 'ComparisonTraining': ComparisonTraining,
+                 'Seq2Seq': Seq2Seq, 'DiagnosticClassifier': DiagnosticClassifier, 'DC': DiagnosticClassifier,
+                 'DiagnosticTrainer': DiagnosticTrainer, 'DT': DiagnosticTrainer}
+
+recurrent_layers = {'SimpleRNN': SimpleRNN, 'SRN': SimpleRNN, 'GRU': GRU, 'LSTM': LSTM}
+
+# default settings, identical to the defaults of train_sequential_model.py
+defaults = OrderedDict([
+    ('architecture', 'ScalarPrediction'),
+    ('recurrent_layer', 'GRU'),
+    ('size_hidden', 15),
+    ('input_size', 2),
+    ('format', 'infix'),
+    ('optimizer', 'adam'),
+    ('loss_function', 'mse'),
+    ('dropout', 0.0),
+    ('batch_size', 24),
+    ('nb_epochs', 100),
+    ('val_split', 0.1),
+    ('maxlen', 15),
+    ('seed', 0),
+    ('seed_test', 100),
+    ('targets', None),
+    ('debug', False),
+    ('early_stopping', None),
+])
+
+digits = np.arange(-10, 11)
+operators = ['+', '-']
+
+
+def grid_search(parameters):
+    """
+    Return a list with all combinations of the values
+    of the parameters in the grid.
+    :param parameters:  dictionary mapping parameter names to lists of values
+    """
+    names = sorted(parameters.keys())
+    values = [parameters[name] if isinstance(parameters[name], list) else [parameters[name]] for name in names]
+    return [OrderedDict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def random_search(parameters, n_trials, seed=0):
+    """
+    Return a list with n_trials configurations sampled
+    from the parameter specification.
+    :param parameters:  dictionary mapping parameter names to lists of values
+                        or to distribution dictionaries
+    :param n_trials:    number of configurations to sample
+    :param seed:        seed of the random generator used for sampling
+    """
+    rng = np.random.RandomState(seed)
+    names = sorted(parameters.keys())
+    configs = []
+    for trial in xrange(n_trials):
+        config = OrderedDict()
+        for name in names:
+            config[name] = sample_parameter(parameters[name], rng)
+        configs.append(config)
+    return configs
+
+
+def sample_parameter(spec, rng):
+    """
+    Sample a single parameter value from its specification.
+    """
+    if isinstance(spec, list):
+        return spec[rng.randint(len(spec))]
+
+    elif isinstance(spec, dict):
+        distribution = spec['distribution']
+        if distribution == 'uniform':
+            return float(rng.uniform(spec['low'], spec['high']))
+        elif distribution == 'loguniform':
+            return float(np.exp(rng.uniform(np.log(spec['low']), np.log(spec['high']))))
+        elif distribution == 'randint':
+            return int(rng.randint(spec['low'], spec['high'] + 1))
+        elif distribution == 'choice':
+            return spec['values'][rng.randint(len(spec['values']))]
+        else:
+            raise ValueError("Unknown distribution %s" % distribution)
+
+    return spec
+
+
+class DataCache(object):
+    """
+    Cache treebanks and the tensors generated from them,
+    such that trials that use the same data do not have
+    to generate it again. Treebanks are cached in memory,
+    tensors both in memory and on disk.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.treebanks = {}
+        self.tensors = {}
+        if cache_dir and not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass        # created by another worker
+
+    def treebank(self, seed, kind, debug=False):
+        """
+        Return treebank, test treebanks are returned as
+        a list with (name, treebank) tuples.
+        """
+        key = (seed, kind, debug)
+        if key not in self.treebanks:
+            tb = treebank(seed=seed, kind=kind, debug=debug)
+            if kind == 'test':
+                tb = list(tb)
+            self.treebanks[key] = tb
+        return self.treebanks[key]
+
+    def data(self, training, seed, kind, format='infix', debug=False, pad_to=None):
+        """
+        Return the data generated by training for the treebank
+        of kind, generated with seed. For test data, return a
+        list with (name, X, Y) tuples.
+        """
+        classifiers = getattr(training, 'classifiers', None)
+        key = (training.__class__.__name__, tuple(classifiers or []), seed, kind,
+               format, debug, pad_to or training.input_length)
+
+        if key in self.tensors:
+            return self.tensors[key]
+
+        filename = self.filename(key)
+        if filename and os.path.exists(filename):
+            data = self.load(filename)
+        else:
+            # set seed to make shuffling of training data reproducible
+            np.random.seed(seed)
+            if kind == 'test':
+                data = training.generate_test_data(self.treebank(seed, kind, debug), digits=digits,
+                                                   format=format, pad_to=pad_to)
+            else:
+                data = training.generate_training_data(self.treebank(seed, kind, debug),
+                                                       format=format, pad_to=pad_to)
+            if filename:
+                self.store(data, filename)
+
+        self.tensors[key] = data
+        return data
+
+    def filename(self, key):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, hashlib.md5(repr(key)).hexdigest() + '.pik')
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def store(data, filename):
+        # write to temporary file first, such that other workers
+        # never read a partially written file
+        tmp_file = '%s.%i.tmp' % (filename, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, filename)
+
+
+# data cache of the current process
+_cache = None
+
+
+def run_trial(trial):
+    """
+    Train (and optionally test) a model for a single
+    trial of the sweep and store the results to file.
+    :param trial:   dictionary with trial_id, config, out_dir, cache_dir and test
+    """
+    global _cache
+    if _cache is None or _cache.cache_dir != trial['cache_dir']:
+        _cache = DataCache(trial['cache_dir'])
+
+    # workers run many trials, release the models of earlier trials and
+    # restart layer names, such that a trial does not depend on the ones before it
+    gc.collect()
+    K.reset_uids()
+
+    config = trial['config']
+    model_file = trial.get('model_file', os.path.join(trial['out_dir'], 'models', trial['trial_id']))
+    epochs = trial.get('epochs', config['nb_epochs'])
+    initial_epoch = trial.get('initial_epoch', 0)
+
+    np.random.seed(config['seed'] + initial_epoch)
+
+    training = architectures[config['architecture']](digits=digits, operators=operators,
+                                                     classifiers=config['targets'])
+    training.generate_model(recurrent_layers[config['recurrent_layer']],
+                            input_size=config['input_size'],
+                            # length of expression with maxlen numeric leaves
+                            input_length=4 * config['maxlen'] - 3,
+                            size_hidden=config['size_hidden'],
+                            dropout_recurrent=config['dropout'],
+                            classifiers=config['targets'])
+
+    # continue training the model of the previous rung, with the state of its optimizer,
+    # such that training in rungs equals training for all epochs at once
+    optimizer_weights = None
+    if initial_epoch > 0:
+        training.model.load_weights(trial['initial_model'] + '.h5')
+        optimizer_weights = load_optimizer_weights(trial['initial_model'] + '.h5')
+
+    training_data = _cache.data(training, seed=config['seed'], kind='train',
+                                format=config['format'], debug=config['debug'])
+    validation_data = _cache.data(training, seed=config['seed'], kind='heldout',
+                                  format=config['format'], debug=config['debug'])
+
+    training.train(training_data=training_data, validation_data=validation_data,
+                   validation_split=config['val_split'], batch_size=config['batch_size'],
+                   optimizer=config['optimizer'], loss_functions=config['loss_function'],
+                   epochs=epochs, verbosity=0, filename=model_file,
+                   save_every=False, early_stopping=config['early_stopping'],
+                   initial_epoch=initial_epoch, optimizer_weights=optimizer_weights)
+
+    history = training.trainings_history
+    results = OrderedDict([('trial_id', trial['trial_id'])])
+    results.update(config)
+    results['model_file'] = model_file + '.h5'
+    results['epochs'] = initial_epoch + len(history.losses[list(history.losses)[0]])
+    results['stopped_early'] = training.stopped_epoch is not None
+    results.update(summarise_history(history))
+
+    if trial['test']:
+        test_data = _cache.data(training, seed=config['seed_test'], kind='test',
+                                format=config['format'], debug=config['debug'])
+        for name, evaluation in training.test(test_data).items():
+            for metric, value in evaluation.items():
+                results['test_%s_%s' % (name, metric)] = value
+
+    store_results(results, trial.get('result_file', os.path.join(trial['out_dir'], 'trials', trial['trial_id'] + '.pik')))
+    return results
+
+
+def summarise_history(history):
+    """
+    Return a dictionary with the values of the
+    losses and metrics after the last epoch.
+    """
+    summary = OrderedDict()
+    for column in history.columns:
+        values = history.column(column)
+        summary[column] = float(values[-1]) if len(values) and not np.isnan(values[-1]) else None
+    return summary
+
+
+def store_results(results, filename):
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(results, f)
+    os.rename(tmp_file, filename)
+
+
+def write_results_table(results, filename):
+    """
+    Write results of all finished trials to a
+    comma separated file.
+    """
+    columns = []
+    for result in results:
+        columns += [column for column in result if column not in columns]
+
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for result in results:
+            f.write(','.join([str(result.get(column, '')).replace(',', ';') for column in columns]) + '\n')
+    os.rename(tmp_file, filename)
+
+
+class Sweep(object):
+    """
+    Train models for all configurations of a grid or
+    random search over the arguments of the sequential
+    training architectures.
+    """
+    def __init__(self, spec, out_dir, n_workers=1, test=False, cache_dir=None):
+        """
+        :param spec:        sweep specification (see module docstring)
+        :param out_dir:     directory to write models, trial results and results table to
+        :param n_workers:   number of trials to run in parallel
+        :param test:        test trained models on the test treebanks
+        :param cache_dir:   directory to cache data, defaults to out_dir/cache
+        """
+        self.spec = spec
+        self.out_dir = out_dir
+        self.n_workers = n_workers
+        self.test = test
+        self.cache_dir = cache_dir or os.path.join(out_dir, 'cache')
+
+        for folder in [out_dir, os.path.join(out_dir, 'trials'), os.path.join(out_dir, 'models')]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+        self.check_spec()
+        self.trials = self.generate_trials()
+
+    def check_spec(self):
+        """
+        Store the specification of the sweep, or check if
+        it matches the specification of the sweep that is
+        resumed.
+        """
+        spec_file = os.path.join(self.out_dir, 'sweep.json')
+        if os.path.exists(spec_file):
+            with open(spec_file) as f:
+                if json.load(f) != json.loads(json.dumps(self.spec)):
+                    raise ValueError("%s contains a sweep with a different specification" % self.out_dir)
+        else:
+            with open(spec_file, 'w') as f:
+                json.dump(self.spec, f, indent=4)
+
+    def generate_trials(self):
+        """
+        Generate the configurations of all trials of the sweep.
+        """
+        search = self.spec.get('search', 'grid')
+        parameters = self.spec.get('parameters', {})
+
+        if search == 'grid':
+            configs = grid_search(parameters)
+        elif search == 'random':
+            configs = random_search(parameters, self.spec['n_trials'], self.spec.get('seed', 0))
+        else:
+            raise ValueError("Unknown search type %s" % search)
+
+        trials = []
+        for i, params in enumerate(configs):
+            config = OrderedDict(defaults)
+            config.update(self.spec.get('fixed', {}))
+            config.update(params)
+            trials.append({'trial_id': 'trial%04i' % i, 'config': config, 'out_dir': self.out_dir,
+                           'cache_dir': self.cache_dir, 'test': self.test})
+        return trials
+
+    def trial_file(self, trial):
+        return os.path.join(self.out_dir, 'trials', trial['trial_id'] + '.pik')
+
+    def finished(self):
+        """
+        Return the results of all trials that were finished.
+        """
+        results = []
+        for trial in self.trials:
+            if os.path.exists(self.trial_file(trial)):
+                with open(self.trial_file(trial), 'rb') as f:
+                    results.append(pickle.load(f))
+        return results
+
+    def run(self):
+        """
+        Run all trials that are not finished yet and
+        write the results of the sweep to a table.
+        """
+        todo = [trial for trial in self.trials if not os.path.exists(self.trial_file(trial))]
+        print("Running %i of %i trials (%i workers)" % (len(todo), len(self.trials), self.n_workers))
+
+        if 'pruning' in self.spec:
+            self.successive_halving(**self.spec['pruning'])
+        else:
+            self.run_trials(todo)
+
+        results = self.finished()
+        write_results_table(results, os.path.join(self.out_dir, 'results.csv'))
+        return results
+
+    def run_trials(self, trials):
+        """
+        Run trials, in parallel if the sweep has more than one worker.
+        """
+        table = os.path.join(self.out_dir, 'results.csv')
+
+        if self.n_workers > 1 and len(trials) > 1:
+            # workers are reused for later trials, such that they use the data cached in their memory
+            pool = multiprocessing.Pool(self.n_workers)
+            try:
+                for result in pool.imap_unordered(run_trial, trials):
+                    print("Finished %s after %i epochs" % (result['trial_id'], result['epochs']))
+                    write_results_table(self.finished(), table)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for trial in trials:
+                result = run_trial(trial)
+                print("Finished %s after %i epochs" % (result['trial_id'], result['epochs']))
+                write_results_table(self.finished(), table)
+
+    def budgets(self, min_epochs, eta):
+        """
+        Return the number of epochs trials are
+        trained for at every rung of successive halving.
+        """
+        max_epochs = max([trial['config']['nb_epochs'] for trial in self.trials])
+        budgets = []
+        budget = min_epochs
+        while budget < max_epochs:
+            budgets.append(int(budget))
+            budget *= eta
+        return budgets + [max_epochs]
+
+    def successive_halving(self, min_epochs, eta=3, monitor='val_loss', mode='min'):
+        """
+        Train all trials for min_epochs epochs, continue training the
+        best 1/eta trials for eta times as many epochs and repeat until
+        the maximum number of epochs is reached. Trials that are not
+        continued, or that are stopped early, are finished with the
+        results of the last rung they were trained in.
+        :param min_epochs:  number of epochs of the first rung
+        :param eta:         fraction of trials that is continued after every rung
+        :param monitor:     column of the results used to rank the trials
+        :param mode:        'min' if lower values of monitor are better, 'max' otherwise
+        """
+        active = self.trials
+        trained = dict([(trial['trial_id'], 0) for trial in self.trials])
+
+        for rung, budget in enumerate(self.budgets(min_epochs, eta)):
+            rung_trials = []
+            for trial in active:
+                rung_trial = dict(trial)
+                # every rung writes its own model, the model of the previous rung
+                # stays intact if training is interrupted
+                rung_trial.update({'epochs': min(budget, trial['config']['nb_epochs']),
+                                   'initial_epoch': trained[trial['trial_id']],
+                                   'initial_model': self.rung_model(trial, rung - 1),
+                                   'model_file': self.rung_model(trial, rung),
+                                   'result_file': self.rung_file(trial, rung)})
+                rung_trials.append(rung_trial)
+
+            print("Rung %i: train %i trials for %i epochs" % (rung, len(rung_trials), budget))
+            self.run_trials([t for t in rung_trials if not os.path.exists(t['result_file'])])
+
+            # collect results and finish trials that cannot be trained further
+            results = {}
+            for trial in rung_trials:
+                with open(trial['result_file'], 'rb') as f:
+                    result = pickle.load(f)
+                result['rung'] = rung
+                trained[trial['trial_id']] = result['epochs']
+                if result['stopped_early'] or result['epochs'] >= result['nb_epochs']:
+                    store_results(result, self.trial_file(trial))
+                else:
+                    results[trial['trial_id']] = result
+
+            # continue only the best 1/eta of the trials
+            ranked = sorted(results.values(), key=lambda r: r[monitor] if mode == 'min' else -r[monitor])
+            n_continue = int(np.ceil(len(ranked) / float(eta)))
+            for result in ranked[n_continue:]:
+                result['pruned'] = True
+                store_results(result, os.path.join(self.out_dir, 'trials', result['trial_id'] + '.pik'))
+
+            continued = set([result['trial_id'] for result in ranked[:n_continue]])
+            active = [trial for trial in active if trial['trial_id'] in continued]
+            if not active:
+                break
+
+    def rung_file(self, trial, rung):
+        return os.path.join(self.out_dir, 'trials', '%s_rung%i.pik' % (trial['trial_id'], rung))
+
+    def rung_model(self, trial, rung):
+        return os.path.join(self.out_dir, 'models', '%s_rung%i' % (trial['trial_id'], rung))
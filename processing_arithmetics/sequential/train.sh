@@ -1,16 +1,11 @@
 #!/bin/sh
 
-# train n networks and write output to file
+# run the sweep described in a spec file with N workers
 
-N=$1
-file=$2
+spec=$1
+out_dir=$2
+N=${3:-1}
 
-echo "Train $N networks, write output to $file"
-echo "Train $N networks, write output to $file" > $file
+echo "Run sweep $spec with $N workers, write output to $out_dir"
 
-for i in $(seq 1 $N)
-do
-    echo "Train network $i"
-    echo "Train network $i" >>$file
-    python train_model.py settings_train >> $file
-done
+python ../../scripts/sweep_sequential_model.py -spec $spec --out_dir $out_dir --workers $N --test
@@ -23,22 +23,37 @@ class Node():
         if activate_in:
             [i.forward(theta, activate_in) for i in self.inputs]
         self.inputsignal = np.concatenate([c.a for c in self.inputs])
-        self.dinputsignal = np.concatenate([c.ad for c in self.inputs])
 
-        M = theta[self.cat + ('M',)]
-        b = theta[self.cat + ('B',)]
+        _, _, M, b = self.parameters(theta)
         if M is None or b is None: raise RuntimeError(
             'Fail to forward node, no matrix and bias vector:' + str(self.cat))
-        self.z = M.dot(self.inputsignal) + b
-        self.a, self.ad = activation.activate(self.z, self.nonlin)
-
+        z = M.dot(self.inputsignal) + b
+        self.a = activation.apply(z, self.nonlin, out=z)
+        self.ad = None
+
+    def derivative(self):
+        # derivative of the activation, computed when backprop needs it
+        if self.ad is None: self.ad = activation.derivative(self.a, self.nonlin)
+        return self.ad
+
+
+    def parameters(self, theta):
+        '''
+        The keys under which the matrix and bias of the node are stored in theta, and the matrix and bias.
+        They are looked up once for every version of theta (see Theta.version).
+        '''
+        bound = getattr(self, '_bound', None)
+        if bound is None or bound[0] is not theta or bound[1] != theta.version:
+            keys = theta.resolve(self.cat + ('M',)), theta.resolve(self.cat + ('B',))
+            bound = self._bound = (theta, theta.version) + keys + (theta[keys[0]], theta[keys[1]])
+        return bound[2:]
 
     def backprop(self, theta, delta, gradient, move_on=True):
-        M = theta[self.cat + ('M',)]
-        gradient[self.cat + ('M',)] += np.outer(delta, self.inputsignal)
-        gradient[self.cat + ('B',)] += delta
+        key_M, key_B, M, _ = self.parameters(theta)
+        gradient[key_M] += np.outer(delta, self.inputsignal)
+        gradient[key_B] += delta
 
-        delta_b = np.multiply(np.transpose(M).dot(delta), self.dinputsignal)
+        delta_b = np.multiply(np.transpose(M).dot(delta), np.concatenate([c.derivative() for c in self.inputs]))
         if move_on:
             lens = [len(c.a) for c in self.inputs]
             splitter = [sum(lens[:i]) for i in range(len(lens))][1:]
@@ -59,7 +74,8 @@ class Leaf(Node):
 
     def forward(self, theta, activate_in=True):
         self.z = theta[self.cat][self.key]
-        self.a, self.ad = activation.activate(self.z, self.nonlin)
+        self.a = activation.apply(self.z, self.nonlin)
+        self.ad = None
 
     def backprop(self, theta, delta, gradient, move_on=False):
         gradient[self.cat][self.key] += delta
@@ -1,23 +1,76 @@
 import numpy as np
 import myTheta
 
+'''
+ Optimizers update the parameter vector of a packed theta (see Theta.pack), only at the
+ elements of the parameters that are present in the gradient: the matrices and biases that
+ were used and the rows of the embeddings of the words in the batch. The state of Adagrad and
+ Adam (histgrad, ms and vs) is kept in gradients with the same layout as theta, and is only
+ updated at the same elements (lazy updates of the state of absent words).
+ get_state and set_state give the state as a dictionary of numbers and arrays, to be stored
+ with theta to resume training.
+'''
+
 class Optimizer():
     def __init__(self, theta, lr = 0.01, lambda_l2 = 0.0001):
-        self.theta = theta
+        # updates are vectorized operations on the parameter vector of theta
+        self.theta = theta.pack()
         self.lr = lr
         self.lambda_l2 = lambda_l2
 
     def new_gradient(self):
         return self.theta.gradient()
 
+    def share(self):
+        # keep theta and the optimizer state in shared memory (see Theta.share)
+        for value in vars(self).values():
+            if isinstance(value, myTheta.Theta): value.share()
+        return self
+
+    def packed(self, grads, tofix):
+        # if theta and grads are packed in the same layout, the indices in theta.flat to update, otherwise None
+        if not self.theta.same_layout(grads):
+            return None
+        return grads.indices(exclude=tofix)
+
+    def _states(self):
+        # (name, gradient) of the state of the optimizer
+        return sorted((name, value) for name, value in vars(self).items()
+                      if isinstance(value, myTheta.Theta) and value is not self.theta)
+
+    def get_state(self):
+        '''
+        The state of the optimizer: its hyperparameters and counters, and the state
+        gradients as vectors in the layout of theta.flat
+        '''
+        state = dict((name, value) for name, value in vars(self).items() if isinstance(value, (int, long, float)))
+        for name, value in self._states():
+            if not self.theta.same_layout(value):
+                raise ValueError('The state ' + name + ' of the optimizer is not packed like theta')
+            state[name] = value.flat.copy()
+        return state
+
+    def set_state(self, state):
+        for name, value in vars(self).items():
+            if isinstance(value, (int, long, float)) and name in state:
+                setattr(self, name, type(value)(state[name]))
+        for name, value in self._states():
+            if name not in state: continue
+            if not self.theta.same_layout(value) or len(state[name]) != len(value.flat):
+                raise ValueError('The state ' + name + ' does not match the parameters of theta')
+            value.flat[...] = state[name]
+            value.mark_present(value.flat != 0)
+
 # regularization
 # TODO: check if this is correct
     def regularize(self, portion=1, tofix = []):
         if self.lambda_l2 == 0: return
+        decay = 1 - portion * self.lambda_l2
         for name in self.theta.keys():
             if name[0] in tofix: continue
             if name[-1] == 'M':
-                self.theta[name] = (1 - portion * self.lambda_l2) * self.theta[name]
+                # in place, also in the parameter vector of a packed theta
+                self.theta[name] *= decay
             else:
                 continue
 
@@ -29,13 +82,19 @@ class SGD(Optimizer):
     def update(self, grads, tofix=[]):
         lr =  self.lr
 
+        indices = self.packed(grads, tofix)
+        if indices is not None:
+            self.theta.flat[indices] -= lr * grads.flat[indices]
+            return
+
         for key, grad in grads.iteritems():
             if key[0] in tofix:
                 continue
             else:
                 if type(grad) == np.ndarray: self.theta[key] -= lr * grad
                 elif type(grad) == myTheta.WordMatrix:
-                    for word in grad: self.theta[key][word] -= lr * grad[word]
+                    rows, values = grad.sparse()
+                    self.theta[key].add_rows(self.theta[key].translate(grad, rows), -lr * values)
                 else: raise NameError("Cannot update theta")
 
 
@@ -48,6 +107,19 @@ class Adagrad(Optimizer):
     def update(self, grads, tofix=[]):
         lr = self.lr
 
+        indices = self.packed(grads, tofix)
+        if indices is not None and self.theta.same_layout(self.histgrad):
+            grad = grads.flat[indices]
+            histgrad = self.histgrad.flat[indices]
+            histgrad += np.square(grad)
+            self.histgrad.flat[indices] = histgrad
+            step = np.sqrt(histgrad, out=histgrad)
+            step += self.epsilon
+            np.divide(grad, step, out=step)
+            step *= lr
+            self.theta.flat[indices] -= step
+            return
+
         for key, grad in grads.iteritems():
             if key[0] in tofix:
                 continue
@@ -56,9 +128,10 @@ class Adagrad(Optimizer):
                     self.histgrad[key] += np.square(grad)
                     self.theta[key] -= lr * np.divide(grad, np.sqrt(self.histgrad[key]) + self.epsilon)
                 elif type(grad) == myTheta.WordMatrix:
-                    for word in grad:
-                        self.histgrad[key][word] += np.square(grad[word])
-                        self.theta[key][word] -= lr * np.divide(grad[word], np.sqrt(self.histgrad[key][word]) + self.epsilon)
+                    rows, values = grad.sparse()
+                    rows = self.theta[key].translate(grad, rows)
+                    self.histgrad[key].add_rows(rows, np.square(values))
+                    self.theta[key].add_rows(rows, -lr * np.divide(values, np.sqrt(self.histgrad[key].matrix[rows]) + self.epsilon))
                 else:
                     raise NameError("Cannot update theta")
 
@@ -78,6 +151,21 @@ class Adam(Optimizer):
         factor = (1 - self.beta_2**self.t)**0.5/(1 - self.beta_1**self.t)
         lr = factor*self.lr
 
+        indices = self.packed(grads, tofix)
+        if indices is not None and self.theta.same_layout(self.ms) and self.theta.same_layout(self.vs):
+            grad = grads.flat[indices]
+            ms, vs = self.ms.flat[indices], self.vs.flat[indices]
+            ms *= self.beta_1
+            ms += (1 - self.beta_1) * grad
+            vs *= self.beta_2
+            vs += (1 - self.beta_2) * np.square(grad, out=grad)
+            self.ms.flat[indices], self.vs.flat[indices] = ms, vs
+            step = np.add(vs, self.epsilon, out=vs)
+            np.sqrt(step, out=step)
+            np.divide(lr * ms, step, out=step)
+            self.theta.flat[indices] -= step
+            return
+
         for key, grad in grads.iteritems():
             if key[0] in tofix:
                 continue
@@ -87,16 +175,11 @@ class Adam(Optimizer):
                     self.vs[key] = self.beta_2 * self.vs[key] + (1 - self.beta_2) * np.square(grad)
                     self.theta[key] -= lr * self.ms[key] / np.sqrt(self.vs[key] + self.epsilon)
                 elif type(grad) == myTheta.WordMatrix:
-                    for word in grad:
-                        self.ms[key][word] = self.beta_1 * self.ms[key][word] + (1 - self.beta_1) * grad[word]
-                        self.vs[key][word] = self.beta_2 * self.vs[key][word] + (1 - self.beta_2) * np.square(grad[word])
-                        self.theta[key][word] -= lr * self.ms[key][word] / np.sqrt(self.vs[key][word] + self.epsilon)
+                    rows, values = grad.sparse()
+                    rows = self.theta[key].translate(grad, rows)
+                    ms, vs = self.ms[key], self.vs[key]
+                    ms.set_rows(rows, self.beta_1 * ms.matrix[rows] + (1 - self.beta_1) * values)
+                    vs.set_rows(rows, self.beta_2 * vs.matrix[rows] + (1 - self.beta_2) * np.square(values))
+                    self.theta[key].add_rows(rows, -lr * ms.matrix[rows] / np.sqrt(vs.matrix[rows] + self.epsilon))
                 else:
                     raise NameError("Cannot update theta")
-
-
-
-
-
-
-
@@ -1,24 +1,54 @@
 import numpy as np
 
+'''
+ Activation functions work on a vector, or on a matrix with one vector per row
+ (softmax is normalized per row). apply computes the activation, in place if out is given
+ (out can be the input itself). The derivative is computed from the activation by derivative,
+ such that it is only computed when backprop needs it.
+'''
 
-def activate(vector, nonlinearity):
+
+def apply(z, nonlinearity, out=None):
     if nonlinearity == 'identity':
-        act = vector
-        der = np.ones_like(act)
+        if out is None or out is z:
+            return z
+        out[...] = z
+        return out
     elif nonlinearity == 'tanh':
-        act = np.tanh(vector)
-        der = 1 - np.square(act)
+        return np.tanh(z, out=out)
     elif nonlinearity == 'ReLU':
-        act = np.array([max(x, 0) + 0.01 * min(x, 0) for x in vector])
-        der = np.array([1 * (x >= 0)+0.01 * (x <= 0) for x in vector])
+        # leaky: max(x, 0) + 0.01 * min(x, 0)
+        return np.maximum(z, 0.01 * z, out=out)
     elif nonlinearity == 'sigmoid':
-        act = 1 / (1 + np.exp(-1 * vector))
-        der = act * (1 - act)
+        out = np.negative(z, out=out)
+        np.exp(out, out=out)
+        out += 1
+        return np.reciprocal(out, out=out)
     elif nonlinearity == 'softmax':
-        e = np.exp(vector)
-        act = e / np.sum(e)
-        der = np.ones_like(act)  # this is never used
+        # subtract the maximum to avoid overflow, this does not change the result
+        out = np.subtract(z, np.max(z, axis=-1, keepdims=True), out=out)
+        np.exp(out, out=out)
+        out /= np.sum(out, axis=-1, keepdims=True)
+        return out
     else:
         print 'no familiar nonlinearity:', nonlinearity, '. Used identity.'
-        act, der = activate(vector, 'identity')
-    return act, der
+        return apply(z, 'identity', out)
+
+
+def derivative(a, nonlinearity):
+    # derivative of the nonlinearity, given its activation a
+    if nonlinearity == 'tanh':
+        return 1 - np.square(a)
+    elif nonlinearity == 'ReLU':
+        # the sign of the activation is the sign of the input
+        return (a >= 0) + 0.01 * (a <= 0)
+    elif nonlinearity == 'sigmoid':
+        return a * (1 - a)
+    else:
+        # identity, softmax (never used) and unfamiliar nonlinearities
+        return np.ones_like(a)
+
+
+def activate(vector, nonlinearity):
+    act = apply(vector, nonlinearity)
+    return act, derivative(act, nonlinearity)
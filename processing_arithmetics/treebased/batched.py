@@ -0,0 +1,290 @@
+from __future__ import division
+import activation
+import json
+import numpy as np
+
+'''
+ Batched forward and backward passes of recursive networks.
+ A Forest compiles a list of networks (trees of NN.Node objects) into flat index arrays:
+ for every node its children, its category and nonlinearity, or its word if it is a leaf.
+ Nodes are ordered by height (leaves have height 0) and by the parameters they use,
+ such that all nodes with the same height and parameters are computed with one matrix
+ multiplication in forward mode, and their gradients with one in backward mode.
+ A forward or backward pass can be restricted to a subset (e.g. a minibatch) of the networks.
+'''
+
+
+def expand_node(node):
+    # children, category, nonlinearity and word (None if not a leaf) of an NN.Node
+    return node.inputs, tuple(node.cat), node.nonlin, getattr(node, 'key', None)
+
+
+def expand_expression(item):
+    '''
+    Children, category, nonlinearity and word of the node that NN.RNN.fromME constructs for a
+    MathExpression (with the default activation, tanh), other nodes are given as such tuples.
+    '''
+    if isinstance(item, tuple):
+        return item
+    if item.label() == 'dummy':
+        return list(item), ('composition', 'dummy', '(' + ', '.join([child.label() for child in item]) + ')', 'I'), 'tanh', None
+    return [], ('word',), 'identity', item.label()
+
+
+class Forest(object):
+    version = 1  # of the file format of save and load
+    # the arrays that describe the structure of a forest
+    _arrays = ['roots', 'offsets', 'children', 'arity', 'cat', 'nonlin', 'word', 'height', 'example']
+
+    def __init__(self, networks, targets=None, labels=None, expand=expand_node):
+        '''
+        :param networks:    list of root nodes, e.g. NN.Classifier objects or the roots of NN.RNN objects
+        :param targets:     list with the target of every network, for classifiers a label
+        :param labels:      the labels of classifiers, default the labels of the first network
+        :param expand:      function giving the children, category, nonlinearity and word of a node
+        '''
+        self.cats, self.nonlins, self.words = [], [], []
+        self._cat_ids, self._nonlin_ids, self._word_ids = {}, {}, {}
+        nodes = []
+        self.roots = np.array([self._add(network, i, nodes, expand) for i, network in enumerate(networks)], dtype=int)
+        self.n_examples = len(networks)
+        self.n_nodes = len(nodes)
+
+        max_arity = max([len(children) for children, _, _, _, _, _ in nodes] + [1])
+        self.children = -np.ones((self.n_nodes, max_arity), dtype=int)
+        for i, (children, _, _, _, _, _) in enumerate(nodes):
+            self.children[i, :len(children)] = children
+        self.arity = np.array([len(node[0]) for node in nodes], dtype=int)
+        self.cat, self.nonlin, self.word, self.height, self.example = \
+            [np.array(column, dtype=int) for column in zip(*nodes)[1:]] if nodes else [np.zeros(0, dtype=int)] * 5
+
+        # the nodes of a network are stored contiguously
+        self.offsets = np.searchsorted(self.example, np.arange(self.n_examples + 1))
+
+        if np.any(np.bincount(self.children[self.children >= 0], minlength=self.n_nodes) > 1):
+            raise ValueError('Networks must be trees, a node can have only one parent')
+
+        self.labels = labels if labels is not None else getattr(networks[0], 'labels', None) if networks else None
+        if targets is None:
+            self.targets = None
+        elif self.labels is not None:
+            self.targets = np.array([self.labels.index(target) for target in targets], dtype=int)
+        else:
+            self.targets = np.array(targets)
+
+        self.source = None  # identifies the data the forest was compiled from, stored with the forest
+        self._word_cats = [cat for cat in self.cats if cat[0] == 'word']
+        self._theta = self._binding = None
+
+    def _index(self, item, items, ids):
+        if item not in ids:
+            ids[item] = len(items)
+            items.append(item)
+        return ids[item]
+
+    @classmethod
+    def from_expressions(cls, expressions, targets=None):
+        # compile MathExpressions into the forest of their NN.RNN networks, without constructing the networks
+        return cls(expressions, targets, expand=expand_expression)
+
+    @classmethod
+    def from_comparisons(cls, items, labels, comparison=False):
+        '''
+        Compile (left, right, label) triples of MathExpressions into the forest of the NN.Classifier
+        networks that data.CompareClassifyTB constructs, without constructing the networks
+        '''
+        roots = []
+        for left, right, _ in items:
+            children = [left, right]
+            if comparison:
+                children = [(children, ('comparison',), 'ReLU', None)]
+            roots.append((children, ('classify',), 'softmax', None))
+        return cls(roots, [label for _, _, label in items], labels=labels, expand=expand_expression)
+
+    def _add(self, node, example, nodes, expand):
+        # add node and its descendants to nodes (children first), return the index of node
+        inputs, node_cat, node_nonlin, key = expand(node)
+        children = [self._add(child, example, nodes, expand) for child in inputs]
+        height = 1 + max([nodes[child][4] for child in children]) if children else 0
+        cat = self._index(node_cat, self.cats, self._cat_ids)
+        nonlin = self._index(node_nonlin, self.nonlins, self._nonlin_ids)
+        word = self._index((node_cat, key), self.words, self._word_ids) if not children else -1
+        nodes.append((children, cat, nonlin, word, height, example))
+        return len(nodes) - 1
+
+    def save(self, filename):
+        # store the structure of the forest (not the activations) in a .npz file
+        meta = {'version': self.version, 'cats': self.cats, 'nonlins': self.nonlins, 'words': self.words,
+                'labels': self.labels, 'targets': self.targets is not None, 'source': self.source}
+        with open(filename, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)),
+                     targets=self.targets if self.targets is not None else np.zeros(0, dtype=int),
+                     **dict((name, getattr(self, name)) for name in self._arrays))
+
+    @classmethod
+    def load(cls, filename):
+        forest = cls.__new__(cls)
+        with open(filename, 'rb') as f:
+            stored = np.load(f)
+            meta = json.loads(str(stored['meta']))
+            if meta['version'] != cls.version:
+                raise ValueError('Forest file ' + filename + ' has version ' + str(meta['version']) + ', expected ' + str(cls.version))
+            for name in cls._arrays:
+                setattr(forest, name, stored[name])
+            forest.targets = stored['targets'] if meta['targets'] else None
+        forest.cats = [tuple(str(part) for part in cat) for cat in meta['cats']]
+        forest.nonlins = [str(nonlin) for nonlin in meta['nonlins']]
+        forest.words = [(tuple(str(part) for part in cat), str(key)) for cat, key in meta['words']]
+        forest.labels = [str(label) for label in meta['labels']] if meta['labels'] is not None else None
+        forest.source = str(meta['source']) if meta.get('source') is not None else None
+        forest._cat_ids, forest._nonlin_ids, forest._word_ids = [dict((item, i) for i, item in enumerate(items))
+                                                                 for items in [forest.cats, forest.nonlins, forest.words]]
+        forest.n_examples, forest.n_nodes = len(forest.roots), len(forest.cat)
+        forest._word_cats = [cat for cat in forest.cats if cat[0] == 'word']
+        forest._theta = forest._binding = None
+        return forest
+
+    def __len__(self):
+        return self.n_examples
+
+    def _resolve(self, theta):
+        '''
+        Find the parameters every node uses in theta and keep references to them, order the nodes
+        by height and parameters and allocate activation buffers.
+        This is only redone for another theta or another version of theta (see Theta.version).
+        '''
+        binding = (theta.version, tuple([theta[cat].version for cat in self._word_cats]))
+        if self._theta is theta and binding == self._binding:
+            return
+
+        # a group is a set of nodes that is computed with the same parameters
+        groups, group_ids = [], {}
+        # leaves are rows of the embedding matrix of their category
+        self._rows = np.array([theta[cat].row(key) for cat, key in self.words], dtype=int)
+        cat_groups = []
+        for cat in self.cats:
+            cat_groups.append(('leaf', cat) if cat[0] == 'word' else (theta.resolve(cat + ('M',)), theta.resolve(cat + ('B',))))
+        combinations, node_combination = np.unique(self.cat * len(self.nonlins) + self.nonlin, return_inverse=True)
+        node_group = np.array([self._index((cat_groups[c // len(self.nonlins)], self.nonlins[c % len(self.nonlins)]),
+                                           groups, group_ids) for c in combinations], dtype=int)[node_combination]
+
+        group_dims = np.array([theta[params[1]].matrix.shape[1] if params[0] == 'leaf' else theta[params[0]].shape[0]
+                               for params, _ in groups], dtype=int)
+        self.dim = group_dims[node_group]
+
+        # the dimensionality of every child of the nodes in a group
+        first = np.zeros(len(groups), dtype=int)
+        first[node_group[::-1]] = np.arange(self.n_nodes)[::-1]
+        self.groups = [(params, nonlin, [self.dim[child] for child in self.children[first[g], :self.arity[first[g]]]])
+                       for g, (params, nonlin) in enumerate(groups)]
+        # the word matrix of leaves, the matrix and bias of other nodes
+        self._params = [(theta[params[1]],) if params[0] == 'leaf' else (theta[params[0]], theta[params[1]])
+                        for params, _ in groups]
+
+        self._sort_key = self.height * len(groups) + node_group
+        self._order = np.argsort(self._sort_key, kind='mergesort')
+        width = max(group_dims) if len(groups) else 0
+        self._a, self._ad, self._delta = [np.zeros((self.n_nodes, width)) for _ in xrange(3)]
+        self._position = np.zeros(self.n_nodes, dtype=int)
+        self._theta, self._binding = theta, binding
+
+    def _plan(self, examples):
+        '''
+        Nodes of examples sorted by height, split into steps of nodes with the same height and parameters.
+        The nodes are stored in this order in the rows of the activation buffers, such that the nodes of a step
+        are a slice of rows. A step is (group, start, end, children) with for every child of the nodes the rows
+        of these children.
+        '''
+        if examples is None:
+            nodes = self._order
+        else:
+            examples = np.unique(examples)
+            starts, sizes = self.offsets[examples], self.offsets[examples + 1] - self.offsets[examples]
+            nodes = np.arange(np.sum(sizes)) + np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+            nodes = nodes[np.argsort(self._sort_key[nodes], kind='mergesort')]
+        self._position[nodes] = np.arange(len(nodes))
+        # rows of the children of the nodes (-1 for no child gives a row that is not used)
+        child_rows = self._position[self.children[nodes]].T.copy()
+        keys = self._sort_key[nodes]
+        bounds = [0] + list(np.flatnonzero(np.diff(keys)) + 1) + [len(nodes)]
+        steps = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            group = keys[start] % len(self.groups)
+            steps.append((group, start, end, child_rows[:len(self.groups[group][2]), start:end]))
+        return nodes, steps
+
+    def forward(self, theta, examples=None):
+        '''
+        Activate the networks (all, or the ones with index in examples)
+        :return:    the activations of their roots, one row per network
+        '''
+        self._resolve(theta)
+        self._nodes, self._steps = self._plan(examples)
+        self._inputs = []
+        a = self._a
+        for group, start, end, children in self._steps:
+            params, nonlin, child_dims = self.groups[group]
+            if params[0] == 'leaf':
+                z = self._params[group][0].matrix[self._rows[self.word[self._nodes[start:end]]]]
+                x = None
+            else:
+                M, B = self._params[group]
+                x = np.concatenate([a[rows, :d] for rows, d in zip(children, child_dims)], axis=1)
+                z = x.dot(M.T)
+                z += B
+            self._inputs.append(x)
+            activation.apply(z, nonlin, out=a[start:end, :z.shape[1]])
+
+        roots = self._position[self.roots if examples is None else self.roots[examples]]
+        return a[roots, :self.dim[self._nodes[roots]].max()] if len(roots) else np.zeros((0, 0))
+
+    def backprop(self, theta, deltas, gradient, examples=None):
+        '''
+        Backpropagate deltas (one row per network) from the roots of the networks
+        activated in the last call to forward and add the gradients to gradient.
+        '''
+        roots = self._position[self.roots if examples is None else self.roots[examples]]
+        a, ad, delta = self._a, self._ad, self._delta
+        # a root can occur more than once in examples, other nodes get their delta from their only parent
+        delta[roots] = 0
+        np.add.at(delta, (roots[:, None], np.arange(deltas.shape[1])[None, :]), deltas)
+
+        # derivatives of the activations are only computed for backprop
+        for group, start, end, _ in self._steps:
+            d = self.dim[self._nodes[start]]
+            ad[start:end, :d] = activation.derivative(a[start:end, :d], self.groups[group][1])
+
+        for (group, start, end, children), x in reversed(zip(self._steps, self._inputs)):
+            params, nonlin, child_dims = self.groups[group]
+            d = self.dim[self._nodes[start]]
+            dz = delta[start:end, :d]
+            if params[0] == 'leaf':
+                gradient[params[1]].add_rows(self._rows[self.word[self._nodes[start:end]]], dz)
+            else:
+                # in place, the arrays of the gradient are created when they are first used
+                gradient[params[0]][...] += dz.T.dot(x)
+                gradient[params[1]][...] += dz.sum(axis=0)
+                dx = np.concatenate([ad[rows, :dim] for rows, dim in zip(children, child_dims)], axis=1)
+                delta_x = dz.dot(self._params[group][0]) * dx
+                column = 0
+                for rows, dim in zip(children, child_dims):
+                    delta[rows, :dim] = delta_x[:, column:column + dim]
+                    column += dim
+
+    def train(self, theta, gradient, examples=None):
+        '''
+        Forward and backward pass of classifiers with a softmax output and cross entropy loss,
+        as in NN.Classifier.train. Gradients are added to gradient.
+        :return:    summed error of the networks
+        '''
+        a = self.forward(theta, examples)
+        targets = self.targets if examples is None else self.targets[examples]
+        rows = np.arange(len(targets))
+        delta = np.copy(a)
+        delta[rows, targets] -= 1
+        self.backprop(theta, delta, gradient, examples)
+        return -np.sum(np.log(a[rows, targets]))
+
+    def predict(self, theta, examples=None):
+        a = self.forward(theta, examples)
+        return [self.labels[i] for i in a.argmax(axis=1)]
@@ -1,8 +1,12 @@
 from __future__ import division
 import random
+import os
+import hashlib
+import numpy as np
 import NN as NN
+import batched
 from ..arithmetics import treebanks as arithmetics
-from collections import defaultdict, Counter
+from collections import defaultdict
 
 class TreeBank():
     def __init__(self, examples):
@@ -42,10 +46,22 @@ class RNNTB(TreeBank):
 
 
 class CompareClassifyTB(TreeBank):
-    def __init__(self, examples, comparison=False):
+    def __init__(self, examples, comparison=False, cache=None):
+        '''
+        :param examples:    (left, right, label) triples of MathExpressions
+        :param cache:       file to store the compiled forest in, it is reused if it exists
+        '''
         self.labels = ['<', '=', '>']
         self.comparison = comparison
-        self.examples = self.convert_examples(examples, comparison)
+        self.items = examples
+        self.cache = cache
+
+    def __getattr__(self, name):
+        # the networks are only constructed when they are used (the compiled forest does not need them)
+        if name == 'examples':
+            self.examples = self.convert_examples(self.items, self.comparison)
+            return self.examples
+        raise AttributeError(name)
 
     def convert_examples(self, items, comparison):
         examples = []
@@ -56,53 +72,114 @@ class CompareClassifyTB(TreeBank):
             examples.append((classifier, label))
         return examples
 
+    def compile(self):
+        # compile the items into a batched.Forest once (or load it from the cache), in the order of the items
+        if getattr(self, 'forest', None) is None:
+            forest = None
+            if self.cache is not None and os.path.exists(self.cache):
+                forest = batched.Forest.load(self.cache)
+                if not self.compiled(forest):
+                    print 'Compiled treebank in', self.cache, 'does not match the examples, compiling again'
+                    forest = None
+            if forest is None:
+                forest = batched.Forest.from_comparisons(self.items, self.labels, self.comparison)
+                forest.source = self.fingerprint()
+                if self.cache is not None:
+                    forest.save(self.cache)
+            self.forest = forest
+        return self.forest
+
+    def compiled(self, forest):
+        # whether forest is a compilation of the items of this treebank (judging by the fingerprint of the items)
+        return forest.source == self.fingerprint() and forest.labels == self.labels and \
+            (('comparison',) in forest.cats) == bool(self.comparison)
+
+    def fingerprint(self):
+        # hash of the expressions and labels of the items, in their order
+        if getattr(self, '_fingerprint', None) is None:
+            digest = hashlib.md5()
+            for left, right, label in self.items:
+                digest.update(str(left) + '\t' + str(right) + '\t' + label + '\n')
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def answers(self):
+        # the values of the left and right expression of every item
+        if getattr(self, '_answers', None) is None:
+            self._answers = np.array([[left.solve(), right.solve()] for left, right, _ in self.items])
+        return self._answers
+
     def evaluate(self, theta, n=0, verbose=1):
-        if n == 0: n = len(self.examples)
-        error = 0.0
-        true = 0.0
-        diffs = []
-        if verbose==1: confusion = defaultdict(Counter)
-        for nw, target in self.get_examples(n):
-            error += nw.evaluate(theta, target)
-            prediction = nw.predict(theta=theta, activate = False)
-            if verbose == 1: confusion[target][prediction] += 1
-            if prediction == target:
-                true += 1
-            else:
-                string = str(nw)
-                results = eval(string.split(':')[1])
-                diffs.append(abs(results[0] - results[1]))
-                if verbose == 2:      print 'wrong prediction:', prediction, 'target:', target, string, results, 'difference:', abs(
-                    results[0] - results[1])
-
-        accuracy = true / n
-        loss = error / n
-        if verbose == 1: print '\tLoss (cross entropy):', loss, ', accuracy:', accuracy, 'Confusion:'
-        if verbose == 1: print confusionS(confusion, self.labels)
-        if verbose > 0: print '\tAverage absolute difference of missclassified examples:', sum(diffs) / len(diffs)
+        # evaluate all examples, or a random sample of n examples, with one batched forward pass
+        forest = self.compile()
+        if n == 0 or n > len(self.items): n = len(self.items)
+        examples = None if n == len(self.items) else np.array(random.sample(xrange(len(self.items)), n))
+        a = forest.forward(theta, examples)
+        targets = forest.targets if examples is None else forest.targets[examples]
+        predictions = a.argmax(axis=1)
+        wrong = np.flatnonzero(predictions != targets)
+        answers = self.answers() if examples is None else self.answers()[examples]
+        diffs = np.abs(answers[wrong, 0] - answers[wrong, 1])
+
+        accuracy = 1 - len(wrong) / n
+        loss = -np.sum(np.log(a[np.arange(n), targets])) / n
+        if verbose == 2:
+            for i, diff in zip(wrong, diffs):
+                left, right, label = self.items[i if examples is None else examples[i]]
+                print 'wrong prediction:', self.labels[predictions[i]], 'target:', label, str(left) + ', ' + str(right), \
+                    tuple(answers[i]), 'difference:', diff
+        if verbose == 1:
+            counts = np.bincount(targets * len(self.labels) + predictions, minlength=len(self.labels) ** 2)
+            confusion = dict((t, dict((p, counts[i * len(self.labels) + j]) for j, p in enumerate(self.labels)))
+                             for i, t in enumerate(self.labels))
+            print '\tLoss (cross entropy):', loss, ', accuracy:', accuracy, 'Confusion:'
+            print confusion_s(confusion, self.labels)
+        if verbose > 0: print '\tAverage absolute difference of missclassified examples:', np.mean(diffs) if len(diffs) else 0
         return {'loss (cross entropy)': loss, 'accuracy': accuracy}
 
-def data4comparison(seed, comparisonLayer=False, debug = False):
+def data4comparison(seed, comparisonLayer=False, debug = False, cache_dir=None):
+    # with a cache_dir, the compiled treebanks are stored on disk and reused
     data = {}
     for part in 'train', 'heldout':
         mtb = arithmetics.treebank(seed, kind=part, debug=debug)
-        data[part] = CompareClassifyTB(mtb.paired_examples(), comparison=comparisonLayer)
+        cache = None
+        if cache_dir is not None:
+            cache = os.path.join(cache_dir, 'comparison_' + part + '_seed' + str(seed) + ('_comparison' if comparisonLayer else '') +
+                                 ('_debug' if debug else '') + '.forest.npz')
+        data[part] = CompareClassifyTB(mtb.paired_examples(), comparison=comparisonLayer, cache=cache)
     return data
 
+def root_representations(theta, examples):
+    '''
+    Representations of the roots of the networks of (expression, answer) examples,
+    computed with one batched forward pass, the answers and the expressions as strings
+    '''
+    expressions = [me for me, _ in examples]
+    forest = batched.Forest.from_expressions(expressions)
+    return forest.forward(theta), np.array([answer for _, answer in examples]), np.array([str(me) for me in expressions])
+
 def data4prediction(theta, seed, debug= False):
-    all_data = defaultdict(lambda: defaultdict(list))
+    all_data = defaultdict(dict)
     for part in 'train', 'heldout':
         mtb = arithmetics.treebank(seed, kind=part, debug=debug)
-        for nw, target in RNNTB(mtb.examples).examples: #getTBs(seed=seed, kind='RNN',debug=debug)['train'].get_examples():
-            a = nw.activate(theta)
-            all_data['X_' + part]['all'].append(a)
-            all_data['Y_' + part]['all'].append(target)
-            all_data['strings_' + part]['all'].append(str(nw))
+        X, Y, strings = root_representations(theta, mtb.examples)
+        all_data['X_' + part]['all'], all_data['Y_' + part]['all'], all_data['strings_' + part]['all'] = X, Y, strings
     mtbt = arithmetics.treebank(seed, kind='test', debug=debug)
     for lan, tb in mtbt:
-        for nw, target in RNNTB(mtb.examples).get_examples():
-            a = nw.activate(theta)
-            all_data['X_test'][lan].append(a)
-            all_data['Y_test'][lan].append(target)
-            all_data['strings_test'][lan].append(str(nw))
+        X, Y, strings = root_representations(theta, tb.examples)
+        all_data['X_test'][lan], all_data['Y_test'][lan], all_data['strings_test'][lan] = X, Y, strings
     return dict(all_data)
+
+def save_prediction_data(dataset, filename):
+    # store the arrays of data4prediction in a .npz file, as <name>/<language>
+    with open(filename, 'wb') as f:
+        np.savez(f, **dict((name + '/' + lan, values) for name, parts in dataset.items() for lan, values in parts.items()))
+
+def load_prediction_data(filename):
+    dataset = defaultdict(dict)
+    with open(filename, 'rb') as f:
+        stored = np.load(f)
+        for key in stored.files:
+            name, lan = key.split('/', 1)
+            dataset[name][lan] = stored[key]
+    return dict(dataset)
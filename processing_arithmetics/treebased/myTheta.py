@@ -1,24 +1,22 @@
 from __future__ import division
 import numpy as np
+import multiprocessing
+import operator
 import sys
 import pickle
+import json
+import struct
+import zipfile
 import processing_arithmetics.arithmetics.treebanks as tb
 
 
 ''' instantiate parameters (theta object): obtain theta from file or create a new theta'''
 def install_theta(theta_file, seed, d, comparison):
     if theta_file != '':
-        with open(theta_file, 'rb') as f:
-            theta = pickle.load(f)
+        theta = load_theta(theta_file)
         print 'Initialized model from file:', theta_file
         if ('classify','B') not in theta: theta.extend4Classify(2, 3, comparison)
 
-        # legacy; in theta from older versions of the code 'plus' and 'minus' in the vocabulary
-        if '+' not in theta[('word',)].voc:
-            theta[('word',)].extend_vocabulary(['+','-'])
-            theta[('word',)]['+'] = theta[('word',)]['plus']
-            theta[('word',)]['-'] = theta[('word',)]['minus']
-
     else:
 
         dims = {'inside': d[0], 'word': d[1], 'min_arity': 3, 'max_arity': 3}
@@ -29,14 +27,119 @@ def install_theta(theta_file, seed, d, comparison):
     theta.extend4Prediction(-1)
     return theta
 
+def load_theta(theta_file, mmap_mode=None):
+    # theta from a checkpoint (see save_checkpoint) or from a pickled theta (earlier versions of the code)
+    if zipfile.is_zipfile(theta_file):
+        return load_checkpoint(theta_file, mmap_mode)[0]
+    with open(theta_file, 'rb') as f:
+        theta = pickle.load(f)
+
+    # legacy; in theta from older versions of the code 'plus' and 'minus' in the vocabulary
+    if '+' not in theta[('word',)].voc:
+        theta[('word',)].extend_vocabulary(['+','-'])
+        theta[('word',)]['+'] = theta[('word',)]['plus']
+        theta[('word',)]['-'] = theta[('word',)]['minus']
+    return theta
+
+def convert_theta(theta_file, out_file):
+    # convert a pickled theta into a checkpoint
+    save_checkpoint(load_theta(theta_file), out_file)
+
+'''
+ A checkpoint stores the parameter vector of a packed theta (see Theta.pack) as one array in
+ a .npz file, with the layout, dimensions and vocabularies as metadata. The parameters can be
+ mapped into memory when loading (mmap_mode as in np.load). Named states, e.g. the state of
+ the optimizer (see Optimizer.get_state), can be stored along: dictionaries of arrays and
+ numbers (or other values that can be stored as json).
+'''
+checkpoint_version = 1
+
+def save_checkpoint(theta, filename, **states):
+    theta.pack()
+    meta = {'version': checkpoint_version, 'dims': theta.dims,
+            'layout': [[list(key), words, start, list(shape)] for key, words, start, shape in theta._layout],
+            'vocabularies': [[list(key), theta[key].voc, theta[key].default, np.flatnonzero(theta[key].present).tolist()]
+                             for key, words, _, _ in theta._layout if words],
+            'states': dict((name, dict((k, v) for k, v in state.items() if not isinstance(v, np.ndarray)))
+                           for name, state in states.items())}
+    arrays = dict((name + '/' + k, v) for name, state in states.items() for k, v in state.items() if isinstance(v, np.ndarray))
+    with open(filename, 'wb') as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), flat=np.asarray(theta.flat), **arrays)
+
+def load_checkpoint(filename, mmap_mode=None):
+    '''
+    Load a checkpoint as a packed theta and the states stored with it
+    :param mmap_mode:   if not None, the parameter vector of theta is a np.memmap of the file, opened in this mode
+    :return:            theta, dictionary of states
+    '''
+    with open(filename, 'rb') as f:
+        stored = np.load(f)
+        meta = json.loads(str(stored['meta']))
+        if meta['version'] != checkpoint_version:
+            raise ValueError('Checkpoint ' + filename + ' has version ' + str(meta['version']) + ', expected ' + str(checkpoint_version))
+        flat = stored['flat'] if mmap_mode is None else _npz_memmap(filename, 'flat', mmap_mode)
+        states = dict((str(name), dict((str(k), v) for k, v in state.items())) for name, state in meta['states'].items())
+        for name in stored.files:
+            if '/' in name:
+                state, k = name.split('/', 1)
+                states[state][k] = stored[name]
+
+    theta = Theta.__new__(Theta)
+    theta.dims = dict((str(k), v) for k, v in meta['dims'].items())
+    vocabularies = dict((tuple(str(part) for part in key), ([str(word) for word in voc], str(default), present))
+                        for key, voc, default, present in meta['vocabularies'])
+    layout = []
+    for key, words, start, shape in meta['layout']:
+        key, shape = tuple(str(part) for part in key), tuple(shape)
+        layout.append((key, words, start, shape))
+        if words:
+            voc, default, _ = vocabularies[key]
+            word_matrix = WordMatrix(voc, default=(default, np.zeros(shape[1:])))
+            if len(word_matrix.words) != shape[0]:
+                raise ValueError('Checkpoint ' + filename + ': the vocabulary of ' + str(key) + ' does not match its matrix')
+            dict.__setitem__(theta, key, word_matrix)
+        else:
+            dict.__setitem__(theta, key, None)
+    if sum(int(np.prod(shape)) for _, _, _, shape in layout) != len(flat):
+        raise ValueError('Checkpoint ' + filename + ': the parameter vector does not match the layout')
+    # the values of theta become views of the stored vector, without copying into it
+    theta._attach(layout, flat, copy=False)
+    for key, (_, _, present) in vocabularies.items():
+        theta[key]._mark_present(np.array(present, dtype=int))
+    return theta, states
+
+def _npz_memmap(filename, name, mode):
+    # map the array name of an (uncompressed) .npz file into memory
+    with zipfile.ZipFile(filename) as archive:
+        info = archive.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError('Cannot map ' + name + ' in compressed file ' + filename + ' into memory')
+    with open(filename, 'rb') as f:
+        # skip the local header of the member in the archive, and the header of the .npy file
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        if np.lib.format.read_magic(f)[0] == 1:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
 '''
  Theta is an object that holds the parameters of a complex neural network.
  A similar object 'Gradient' can be used to hold gradient values.
  The word embeddings are stored in a special object; WordMatrix
  All objects allow for pickling
+ After pack(), all parameters are stored in one contiguous vector 'flat' and the matrices,
+ biases and word vectors in the dictionaries are views of it. Gradients created by a packed
+ theta share its layout, such that updates are vectorized operations on the whole vector.
 '''
 
 class Theta(dict):
+    flat = None  # contiguous parameter vector, None if theta is not packed
+    version = 0  # increased whenever keys are added or removed, or values are replaced by other objects
+
     def __init__(self, dims, embeddings=None, vocabulary=['UNKNOWN'], seed=0):
         if dims is None:
             print 'No dimensions for initialization of theta'
@@ -54,6 +157,170 @@ class Theta(dict):
             self[('word',)] = embeddings
 
 
+    def pack(self):
+        # store all parameters in one contiguous vector (self.flat), the values in theta become views of it
+        if self.flat is not None:
+            return self
+        layout, start = [], 0
+        for key in sorted(self.keys()):
+            value = dict.__getitem__(self, key)
+            if isinstance(value, WordMatrix):
+                layout.append((key, True, start, value.matrix.shape))
+                start += value.matrix.size
+            elif isinstance(value, np.ndarray):
+                layout.append((key, False, start, value.shape))
+                start += value.size
+            else:
+                raise TypeError('Cannot pack ' + str(key) + ' of type ' + str(type(value)))
+        self._attach(layout, np.zeros(start))
+        return self
+
+    def _attach(self, layout, flat, copy=True):
+        # make the values in theta views of flat, copying the current values into flat (if copy)
+        self._changed()
+        self.flat = flat
+        self._layout = layout
+        # (key, words, start, end, elements per word) of every entry of the layout
+        # sizes are multiplied in python, np.prod is slow for tuples (a gradient is attached for every minibatch)
+        self._spans = [(key, words, start, start + int(reduce(operator.mul, shape, 1)), int(reduce(operator.mul, shape[1:], 1)))
+                       for key, words, start, shape in layout]
+        self._views = {}
+        for (key, words, start, shape), (_, _, _, end, _) in zip(layout, self._spans):
+            view = flat[start:end].reshape(shape)
+            if words:
+                word_matrix = dict.__getitem__(self, key)
+                if copy: view[...] = word_matrix.matrix
+                word_matrix._set_matrix(view)
+                word_matrix.theta = self
+            else:
+                self._views[key] = view
+                if dict.__contains__(self, key):
+                    if copy: view[...] = dict.__getitem__(self, key)
+                    dict.__setitem__(self, key, view)
+
+    def unpack(self):
+        # stop keeping the values in theta in one vector (after a change of the keys or shapes of theta)
+        if self.flat is None:
+            return
+        for key, words, _, _ in self._layout:
+            if words and dict.__contains__(self, key):
+                dict.__getitem__(self, key).theta = None
+        self.flat = None
+        del self._layout, self._spans, self._views
+
+    def share(self):
+        # pack theta into a vector in shared memory, such that forked processes see changes of the values
+        self.pack()
+        flat = np.ctypeslib.as_array(multiprocessing.RawArray('d', len(self.flat)))
+        flat[:] = self.flat
+        self._attach(self._layout, flat)
+        return self
+
+    def same_layout(self, other):
+        return self.flat is not None and getattr(other, 'flat', None) is not None and self._layout is other._layout
+
+    def assign(self, other):
+        # copy the parameters of other (e.g. loaded from a checkpoint) into self, both packed with the same keys and shapes
+        self.pack()
+        if other.flat is None or other._layout != self._layout:
+            raise ValueError('Cannot assign the parameters of a theta with other keys or shapes')
+        self.flat[...] = other.flat
+        for key, words, _, _ in self._layout:
+            if words: dict.__getitem__(self, key)._mark_present(np.flatnonzero(other[key].present))
+
+    def mask(self, exclude=[], words_of=None):
+        '''
+        Boolean vector marking the elements of self.flat of the parameters that are
+        present in theta (the keys and words that iterating over theta would give).
+        :param exclude:     categories (first element of keys) to leave out
+        :param words_of:    theta to take the present words from, default self
+        '''
+        words_of = self if words_of is None else words_of
+        mask = np.zeros(len(self.flat), dtype=bool)
+        for key, words, start, end, width in self._spans:
+            if not dict.__contains__(self, key) or key[0] in exclude:
+                continue
+            if words:
+                mask[start:end] = np.repeat(dict.__getitem__(words_of, key).present, width)
+            else:
+                mask[start:end] = True
+        return mask
+
+    def indices(self, exclude=[]):
+        # indices in self.flat of the elements that mask marks, sorted (for sparse updates)
+        parts = []
+        for key, words, start, end, width in self._spans:
+            if not dict.__contains__(self, key) or key[0] in exclude:
+                continue
+            if words:
+                rows = np.flatnonzero(dict.__getitem__(self, key).present)
+                parts.append((start + rows[:, None] * width + np.arange(width)[None, :]).ravel())
+            else:
+                parts.append(np.arange(start, end))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=int)
+
+    def mark_present(self, mask):
+        # make the keys and words with an element marked in mask (see Theta.mask) present
+        for key, words, start, end, width in self._spans:
+            if words:
+                rows = np.flatnonzero(mask[start:end].reshape(-1, width).any(axis=1))
+                dict.__getitem__(self, key)._mark_present(rows)
+            elif mask[start:end].any():
+                dict.__setitem__(self, key, self._views[key])
+
+    def _to_buffer(self, key, value):
+        # if theta is packed, copy value into the view of key
+        if self.flat is not None:
+            view = self._views.get(key)
+            if view is None or np.shape(value) != view.shape:
+                self.unpack()
+            elif value is not view:
+                view[...] = value
+                return view
+        return value
+
+    def __setitem__(self, key, value):
+        value = self._to_buffer(key, value)
+        if dict.get(self, key) is not value: self._changed()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self.flat is not None and key in self._views:
+            self._views[key][...] = 0
+        self._changed()
+        dict.__delitem__(self, key)
+
+    def _changed(self):
+        # references to the values of theta (and resolved keys) are no longer valid
+        self.version += 1
+        self._resolved = {}
+
+    def resolve(self, key):
+        '''
+        The key under which the parameters of key are stored: key itself, or a more general
+        version of key (used with grammar rule specialized parameters).
+        Results are kept until the keys of theta change.
+        '''
+        resolved = self.__dict__.setdefault('_resolved', {})
+        if key not in resolved:
+            if dict.__contains__(self, key):
+                resolved[key] = key
+            else:
+                for fake_key in generalize_key(key):
+                    if dict.__contains__(self, fake_key):
+                        resolved[key] = fake_key
+                        break
+                else:
+                    raise KeyError(str(key) + ' not in theta (missing).')
+        return resolved[key]
+
+    def __getstate__(self):
+        # views are not pickled, a theta is unpacked after unpickling (as are pickles of earlier versions)
+        state = self.__dict__.copy()
+        for name in ['flat', '_layout', '_spans', '_views', '_resolved']:
+            state.pop(name, None)
+        return state
+
     def remove_all(self, to_remove=[]):
         # Remove all matrices and biases that belong to the categories in to_remove
         for key in self.keys():
@@ -128,6 +395,10 @@ class Theta(dict):
 
     def norm(self):
         names = [name for name in self.keys() if name[-1] == 'M']
+        if self.flat is not None:
+            starts = np.array([start for _, _, start, _ in self._layout], dtype=int)
+            norms = np.sqrt(np.add.reduceat(np.square(self.flat), starts)) if len(starts) else []
+            return sum([norm for (key, _, _, _), norm in zip(self._layout, norms) if key in names]) / len(names)
         return sum([np.linalg.norm(self[name]) for name in names]) / len(names)
 
     def gradient(self):
@@ -135,23 +406,27 @@ class Theta(dict):
         for key in self.keys():
             if isinstance(self[key], np.ndarray):
                 molds[key] = np.shape(self[key])
-        # initialize wordmatrix with zeroes default
-        voc = self[('word',)].keys()
-        defaultkey = 'UNKNOWN'
+        # initialize wordmatrix with zeroes default, rows in the same order as theta
+        voc = list(self[('word',)].voc)
+        defaultkey = self[('word',)].default
         defaultvalue = np.zeros_like(self[('word',)][defaultkey])
         word_m = WordMatrix(vocabulary=voc, default=(defaultkey, defaultvalue))
-        return Gradient(molds, word_m)
+        gradient = Gradient(molds, word_m)
+        if self.flat is not None:
+            # a gradient with the same layout as theta
+            gradient._attach(self._layout, np.zeros_like(self.flat))
+        return gradient
 
     def __missing__(self, key):
-        for fake_key in generalize_key(key): # find a more general version of key that is in theta (used with grammar rule specialized parameter)
-            if fake_key in self.keys():
-                return self[fake_key]
-                break
-        else:
-            raise KeyError(str(key) + ' not in theta (missing).')
+        # find a more general version of key that is in theta (used with grammar rule specialized parameter)
+        return dict.__getitem__(self, self.resolve(key))
 
     def __iadd__(self, other):
         scalar = isinstance(other, int)
+        if self.flat is not None and (scalar or self.same_layout(other)):
+            mask = self.mask()
+            self.flat[mask] += other if scalar else other.flat[mask]
+            return self
         for key in self:
             if isinstance(self[key], np.ndarray):
                 if scalar:
@@ -173,6 +448,11 @@ class Theta(dict):
         scalar = isinstance(other, int)
 
         new_t = self.gradient()
+        if self.flat is not None and (scalar or self.same_layout(other)):
+            mask = self.mask()
+            new_t.flat[mask] = self.flat[mask] + (other if scalar else other.flat[mask])
+            new_t._register(self)
+            return new_t
         for key in self:
             if isinstance(self[key], np.ndarray):
                 if scalar:
@@ -197,6 +477,11 @@ class Theta(dict):
         else:
             print 'unknown type of other in theta.itruediv'
 
+        if self.flat is not None and (not th or self.same_layout(other)):
+            # matrices of self are divided, and the words of other
+            mask = self.mask() if not th else self.mask(words_of=other)
+            self.flat[mask] /= other.flat[mask] if th else other
+            return self
         for key in self:
             if isinstance(self[key], np.ndarray):
                 if th:
@@ -218,6 +503,16 @@ class Theta(dict):
     def __idiv__(self, other):
         return self.__itruediv__(other)
 
+    def _register(self, other):
+        # make the keys and words present in other present in self (with their current values in self.flat)
+        for key, words, _, _ in self._layout:
+            if not dict.__contains__(other, key):
+                continue
+            if words:
+                dict.__getitem__(self, key)._mark_present(np.flatnonzero(dict.__getitem__(other, key).present))
+            else:
+                dict.__setitem__(self, key, self._views[key])
+
     def print_dims(self):
         print 'Model dimensionality:'
         for key, value in self.dims.iteritems():
@@ -240,49 +535,136 @@ class Gradient(Theta):
 
     def __missing__(self, key):
         if key in self.molds:
-            self.new_matrix(key, np.zeros(self.molds[key]))
+            self._create(key)
             return self[key]
         else:
             for fake_key in generalize_key(key):
                 if fake_key in self.molds:
-                    self.new_matrix(fake_key, np.zeros(self.molds[fake_key]))
+                    self._create(fake_key)
                     return self[fake_key]
             else:
                 print key, 'not in gradient(missing), and not able to create it.'
                 return None
 
+    def _create(self, key):
+        if self.flat is not None:
+            # the values of absent keys in a packed gradient are kept in the vector
+            dict.__setitem__(self, key, self._views[key])
+        else:
+            self.new_matrix(key, np.zeros(self.molds[key]))
+
     def __setitem__(self, key, val):
         if key in self.molds:
-            dict.__setitem__(self, key, val)
+            dict.__setitem__(self, key, self._to_buffer(key, val))
         else:
             for fake_key in generalize_key(key):
-                if fake_key in self.molds: dict.__setitem__(self, fake_key, val)
+                if fake_key in self.molds: dict.__setitem__(self, fake_key, self._to_buffer(fake_key, val))
                 break
             else:
                 raise KeyError(str(key) + 'not in gradient(setting), and not able to create it.')
 
 
 class WordMatrix(dict):
+    '''
+    Word vectors are the rows of a dense matrix (self.matrix), self.index maps the words in
+    the vocabulary to rows. The dictionary holds views of the rows of the words that are
+    present, self.present marks their rows. Words that are not in the vocabulary use the
+    row of the default word.
+    '''
+    version = 0  # increased when the matrix or the vocabulary changes
+
     def __init__(self, vocabulary=None, default=('UNKNOWN', 0), dic_items=[]):
         self.voc = vocabulary
         dkey, dval = default
         if dkey not in self.voc: raise AttributeError("'default' must be in the vocabulary")
         self.default = dkey
-        dict.__setitem__(self, self.default, dval)
+        self.theta = None  # a packed theta that holds the matrix
+        self._set_matrix(np.zeros((0,) + np.shape(dval)))
+        self[self.default] = dval
         [dic_items.remove((k, v)) for (k, v) in dic_items if k == dkey]
         self.update(dic_items)
 
+    def vocabulary(self):
+        # all words that can have their own vector, without duplicates, in order of their rows
+        words = [self.default]
+        for word in self.voc:
+            if word not in words: words.append(word)
+        return words
+
+    def _set_matrix(self, matrix):
+        # use matrix (which must start with the rows of the current matrix) as storage
+        self.version += 1
+        self.words = self.vocabulary()
+        self.index = dict((word, row) for row, word in enumerate(self.words))
+        if len(matrix) < len(self.words):
+            matrix = np.concatenate([matrix, np.zeros((len(self.words) - len(matrix),) + matrix.shape[1:])])
+        present = np.zeros(len(self.words), dtype=bool)
+        present[:len(getattr(self, 'present', []))] = getattr(self, 'present', [])
+        self.matrix, self.present = matrix, present
+        for word in dict.keys(self):
+            dict.__setitem__(self, word, self.matrix[self.index[word], ...])
+
     def extend_vocabulary(self, wordlist):
+        if self.theta is not None: self.theta.unpack()
+        self.voc.extend(wordlist)
+        self._set_matrix(self.matrix)
         for word in wordlist:
-            self.voc.append(word)
             self[word] = self[self.default]
 
-    def __setitem__(self, key, val):
-        if self.default not in self: raise KeyError("Default not yet in the vocabulary: " + self.default)
-        if key in self.voc:
-            dict.__setitem__(self, key, val)
+    def row(self, word):
+        return self.index.get(word, 0)
+
+    def rows(self, words):
+        return np.array([self.index.get(word, 0) for word in words], dtype=int)
+
+    def sparse(self):
+        # the present words as row indices and a matrix of their values
+        rows = np.flatnonzero(self.present)
+        return rows, self.matrix[rows]
+
+    def translate(self, other, rows):
+        # the rows in self of the words in rows of other
+        if other.words == self.words:
+            return rows
+        return self.rows([other.words[row] for row in rows])
+
+    def add_rows(self, rows, values):
+        # scatter-add values to rows (rows can repeat) and mark them present,
+        # for at least as many rows as words, summing every column with bincount is faster than np.add.at
+        if len(rows) >= len(self.matrix) and self.matrix.ndim == 2:
+            for column in xrange(self.matrix.shape[1]):
+                self.matrix[:, column] += np.bincount(rows, weights=values[:, column], minlength=len(self.matrix))
         else:
-            dict.__setitem__(self, self.default, val)
+            np.add.at(self.matrix, rows, values)
+        self._mark_present(rows)
+
+    def set_rows(self, rows, values):
+        self.matrix[rows] = values
+        self._mark_present(rows)
+
+    def _mark_present(self, rows):
+        new = np.unique(rows[~self.present[rows]])
+        self.present[new] = True
+        for row in new:
+            dict.__setitem__(self, self.words[row], self.matrix[row, ...])
+
+    def __setitem__(self, key, val):
+        if self.default not in self.index: raise KeyError("Default not yet in the vocabulary: " + self.default)
+        row = self.index.get(key, 0)
+        word = self.words[row]
+        view = dict.get(self, word)
+        if view is None:
+            view = self.matrix[row, ...]
+            self.present[row] = True
+            dict.__setitem__(self, word, view)
+        if val is not view:
+            view[...] = val
+
+    def __delitem__(self, key):
+        row = self.index[key]
+        self.matrix[row] = 0
+        self.present[row] = False
+        dict.__delitem__(self, key)
 
     def erase(self):
         for key in self.keys():
@@ -293,9 +675,12 @@ class WordMatrix(dict):
 
     def __missing__(self, key):
         if key == self.default: raise KeyError("Default not yet in the vocabulary: " + self.default)
-        if key in self.voc:
-            self[key] = np.zeros_like(self[self.default])
-            return self[key]
+        if key in self.index:
+            # rows of absent words are zero (or hold the state of a packed optimizer)
+            view = self.matrix[self.index[key], ...]
+            self.present[self.index[key]] = True
+            dict.__setitem__(self, key, view)
+            return view
         else:
             return self[self.default]
 
@@ -0,0 +1,188 @@
+from __future__ import division
+import multiprocessing
+import traceback
+import numpy as np
+import batched
+
+'''
+ Parallel training with worker processes.
+ A WorkerPool forks worker processes that hold the training examples and a copy of theta
+ whose parameter vector is in shared memory, such that updates of theta by the optimizer in
+ the main process are seen by the workers. Every minibatch is split into one contiguous
+ shard per worker, workers write the gradient of their shard to shared memory and the
+ gradients are summed in the order of the workers, such that results do not depend on
+ which worker finishes first.
+ An AsynchronousPool trains asynchronously (Hogwild): every worker trains minibatches of its
+ part of the data and updates the shared theta itself, without locking.
+'''
+
+
+class WorkerPool(object):
+    def __init__(self, theta, data, n_workers=None):
+        '''
+        :param theta:       parameters (a Theta object), moved to shared memory
+        :param data:        a batched.Forest or a list of (network, target) examples,
+                            minibatches are given as indices in data
+        :param n_workers:   number of worker processes, default one per cpu
+        '''
+        self.theta = theta.share()
+        self.flat = self.theta.flat
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        size = len(self.theta.flat)
+        self.gradients = np.ctypeslib.as_array(multiprocessing.RawArray('d', self.n_workers * size)).reshape(self.n_workers, size)
+        self.masks = np.ctypeslib.as_array(multiprocessing.RawArray('b', self.n_workers * size)).reshape(self.n_workers, size)
+
+        self.connections, self.workers = [], []
+        for i in xrange(self.n_workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_work, args=(self.theta, data, worker_connection,
+                                                                 self.gradients[i], self.masks[i]))
+            worker.daemon = True
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def shards(self, indices):
+        # split indices into one contiguous part per worker
+        return np.array_split(np.asarray(indices, dtype=int), self.n_workers)
+
+    def train_batch(self, indices, to_fix=[]):
+        '''
+        Compute the summed error and gradient of the examples with index in indices,
+        as training_routines.train_batch.
+        '''
+        if self.theta.flat is not self.flat:
+            raise RuntimeError('The parameters of theta are no longer in shared memory (theta was unpacked)')
+        shards = self.shards(indices)
+        busy = [i for i, shard in enumerate(shards) if len(shard) > 0]
+        for i in busy:
+            self.connections[i].send(shards[i])
+        results = [self.connections[i].recv() for i in busy]
+        for result in results:
+            if isinstance(result, str):
+                raise RuntimeError('Worker failed:\n' + result)
+
+        grads = self.theta.gradient()
+        present = np.zeros(len(grads.flat), dtype=bool)
+        for i in busy:
+            grads.flat += self.gradients[i]
+            present |= self.masks[i].astype(bool)
+        grads.mark_present(present)
+        grads.remove_all(to_fix)
+        return sum(results), grads
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for worker in self.workers:
+            worker.join()
+        self.connections, self.workers = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsynchronousPool(object):
+    def __init__(self, optimizer, data, n_workers=None, b_size=1, to_fix=[]):
+        '''
+        :param optimizer:   optimizer of the workers, theta and the optimizer state are moved to
+                            shared memory. Adam's time step is given to the workers at the start of
+                            every epoch and advanced by the updates of all workers after it
+        :param data:        a batched.Forest or a list of (network, target) examples
+        :param n_workers:   number of worker processes, default one per cpu
+        :param b_size:      number of examples per update
+        :param to_fix:      categories of parameters that are not updated
+        '''
+        self.optimizer = optimizer.share()
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.connections, self.workers = [], []
+        for i in xrange(self.n_workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_work_asynchronous,
+                                             args=(self.optimizer, data, worker_connection, b_size, to_fix))
+            worker.daemon = True
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def train_epoch(self, indices):
+        '''
+        Train on the examples with index in indices, split over the workers.
+        :return:    summed error of the examples (each computed before its update)
+        '''
+        shards = np.array_split(np.asarray(indices, dtype=int), self.n_workers)
+        t = getattr(self.optimizer, 't', None)
+        for connection, shard in zip(self.connections, shards):
+            connection.send((shard, t))
+        results = [connection.recv() for connection in self.connections]
+        for result in results:
+            if isinstance(result, str):
+                raise RuntimeError('Worker failed:\n' + result)
+        # the time step of the optimizer in the main process counts the updates of all workers
+        if t is not None: self.optimizer.t = t + sum([n_updates for _, n_updates in results])
+        return sum([error for error, _ in results])
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for worker in self.workers:
+            worker.join()
+        self.connections, self.workers = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _gradient(theta, data, indices):
+    # summed error and gradient of the examples with index in indices
+    grads = theta.gradient()
+    if isinstance(data, batched.Forest):
+        error = data.train(theta, grads, indices) if len(indices) > 0 else 0
+    else:
+        error = 0
+        for i in indices:
+            network, target = data[i]
+            error += network.train(theta, grads, activate=True, target=target)
+    return error, grads
+
+
+def _work(theta, data, connection, gradient, mask):
+    # worker process: compute gradients of shards until None is received
+    while True:
+        indices = connection.recv()
+        if indices is None:
+            return
+        try:
+            error, grads = _gradient(theta, data, indices)
+            gradient[:] = grads.flat
+            mask[:] = grads.mask()
+            connection.send(float(error))
+        except Exception:
+            connection.send(traceback.format_exc())
+
+
+def _work_asynchronous(optimizer, data, connection, b_size, to_fix):
+    # worker process: train on shards, updating theta after every minibatch, until None is received
+    while True:
+        message = connection.recv()
+        if message is None:
+            return
+        indices, t = message
+        if t is not None: optimizer.t = t
+        try:
+            error, n_updates = 0, 0
+            for start in xrange(0, len(indices), b_size):
+                batch_error, grads = _gradient(optimizer.theta, data, indices[start:start + b_size])
+                grads.remove_all(to_fix)
+                optimizer.update(grads)
+                error += batch_error
+                n_updates += 1
+            connection.send((float(error), n_updates))
+        except Exception:
+            connection.send(traceback.format_exc())
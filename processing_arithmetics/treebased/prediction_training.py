@@ -1,13 +1,13 @@
 from __future__ import division
 
 import data
+import myTheta
 
 import argparse, os
 import matplotlib.pyplot as plt
 from keras.models import Model
 from keras.layers import Dense, Input
 import numpy as np
-import pickle
 from keras.models import model_from_json
 
 
@@ -136,15 +136,15 @@ def main(args):
     if not os.path.exists(destination):
         os.mkdir(destination)
 
-    data_file = os.path.join(destination, 'keras_data' + str(args['seed']) + '.pik')
+    data_file = os.path.join(destination, 'keras_data' + str(args['seed']) + '.npz')
     if not os.path.exists(data_file):
-        dataset = data.convert4Keras(args['theta_file'], seed=args['seed'])
-        with open(data_file, 'wb') as f:
-            pickle.dump(dataset, f)
+        if not args['theta_file']: raise RuntimeError('A theta file is needed to create the data')
+        theta = myTheta.install_theta(args['theta_file'], seed=args['seed'], d=None, comparison=0)
+        dataset = data.data4prediction(theta, seed=args['seed'])
+        data.save_prediction_data(dataset, data_file)
     else:
         print 'Retrieving earlier created data'
-        with open(data_file, 'rb') as f:
-            data = pickle.load(f)
+        dataset = data.load_prediction_data(data_file)
 
     train_prediction(args, dataset, exp)
 
@@ -153,7 +153,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Train classifier')
     # data:
 
-    parser.add_argument('-theta', '--theta_file', type=str, help='File with pickled Theta', required=False)
+    parser.add_argument('-theta', '--theta_file', type=str, help='Theta checkpoint (or pickled Theta)', required=False)
     parser.add_argument('-exp', '--experiment', type=str, help='Identifier of the experiment', required=True)
     parser.add_argument('-o', '--out', type=str, help='Output name to store model', required=True)
     parser.add_argument('-s', '--seed', type=int, help='Random seed to be used', required=True)
@@ -2,28 +2,65 @@ from __future__ import division
 from numpy import random as np_random
 from matplotlib import pyplot as plt
 import Optimizer
+import parallel
+import myTheta
 import random as random0
+import numpy as np
 import os
-try: import cPickle as pickle
-except: import pickle
+import re
 from collections import defaultdict
 
 '''
-Storage of parameters as pickled theta object
+Storage of parameters as a checkpoint (see myTheta.save_checkpoint), with the state of the optimizer
 '''
-def store_theta(theta, out_file):
-    # secure storage: keep back-up of old version until writing is complete
-    try: os.rename(out_file, out_file+'.back-up')
-    except: True #file did probably not exist, don't bother
+def store_theta(theta, out_file, **states):
+    # secure storage: write to a temporary file and replace out_file when writing is complete
+    myTheta.save_checkpoint(theta, out_file + '.part', **states)
+    os.rename(out_file + '.part', out_file)
+    print '\tWrote theta to file: ',out_file
 
-    with open(out_file,'wb') as f: pickle.dump(theta,f)
+'''
+Resuming training: plain_train stores the epoch, the order of the training data, the states of the
+random generators and the evaluations so far with every checkpoint (as state 'training')
+'''
+def training_state(epoch, t_data, evals):
+    numpy_rng = np_random.get_state()
+    return {'epoch': epoch, 'order': np.array(t_data, dtype=int), 'evals': evals,
+            'numpy_rng': numpy_rng[1], 'numpy_rng_state': [numpy_rng[0]] + list(numpy_rng[2:]),
+            'random_state': random0.getstate()}
 
-    try: os.remove(out_file+'.back-up')
-    except: True #file did not exist, don't bother
-    print '\tWrote theta to file: ',out_file
+def last_checkpoint(outdir):
+    # the checkpoint of plain_train in outdir with the highest epoch, None if there is none
+    epochs = {}
+    for name in os.listdir(outdir) if os.path.isdir(outdir) else []:
+        match = re.match(r'comparisonStartEpoch(\d+)\.theta\.npz$', name)
+        if match: epochs[int(match.group(1))] = os.path.join(outdir, name)
+    return epochs[max(epochs)] if epochs else None
+
+def restore_checkpoint(optimizer, checkpoint):
+    '''
+    Restore theta, the state of the optimizer and the random generators from a checkpoint
+    :return:    epoch, order of the training data and evaluations stored with the checkpoint
+    '''
+    theta, states = myTheta.load_checkpoint(checkpoint)
+    if 'training' not in states or 'optimizer' not in states:
+        raise RuntimeError('Checkpoint ' + checkpoint + ' has no training state to resume from')
+    optimizer.theta.assign(theta)
+    optimizer.set_state(states['optimizer'])
+    training = states['training']
+    name, pos, has_gauss, cached_gaussian = training['numpy_rng_state']
+    np_random.set_state((str(name), training['numpy_rng'], pos, has_gauss, cached_gaussian))
+    version, internal_state, gauss = training['random_state']
+    random0.setstate((version, tuple(internal_state), gauss))
+    evals = defaultdict(list, [(str(kind), [dict((str(metric), value) for metric, value in e.items()) for e in eval])
+                               for kind, eval in training['evals'].items()])
+    return training['epoch'], list(training['order']), evals
 
 def train_comparison(args, theta, dataset):
     hyper_params = {k:args[k] for k in ['b_size']}
+    hyper_params['engine'] = args.get('engine', 'node')
+    hyper_params['workers'] = args.get('workers', 1)
+    hyper_params['asynchronous'] = args.get('asynchronous', False)
     hyper_params['to_fix'] = [] # a selection of parameters can be fixed, e.g. the word embeddings
     # initialize optimizer with learning rate (other hyperparams: default values)
     opt = args['optimizer']
@@ -33,14 +70,20 @@ def train_comparison(args, theta, dataset):
     else: raise RuntimeError("No valid optimizer chosen")
 
     # train model
-    evals = plain_train(optimizer, dataset, hyper_params, n_epochs=args['n_epochs'], outdir=args['out_dir'])
+    f = args.get('storage_freq', 10)
+    if hyper_params['asynchronous']:
+        if args.get('resume', False): raise RuntimeError('Resuming is only possible for synchronous training')
+        evals = hogwild_train(optimizer, dataset, hyper_params, n_epochs=args['n_epochs'], f=f, outdir=args['out_dir'])
+    else:
+        evals = plain_train(optimizer, dataset, hyper_params, n_epochs=args['n_epochs'], f=f, outdir=args['out_dir'],
+                            resume=args.get('resume', False))
 
     # store learned model
-    store_theta(theta, os.path.join(args['out_dir'], 'comparisonFinalModel.theta.pik'))
+    store_theta(optimizer.theta, os.path.join(args['out_dir'], 'comparisonFinalModel.theta.npz'), optimizer=optimizer.get_state())
 
     # run final evaluation
     for name, tb in dataset.iteritems():
-        print('Evaluation on '+name+' data ('+str(len(tb.examples))+' examples)')
+        print('Evaluation on '+name+' data ('+str(len(tb.items))+' examples)')
         tb.evaluate(optimizer.theta, verbose=1)
 
 
@@ -56,18 +99,37 @@ def train_comparison(args, theta, dataset):
 Train for nEpochs epochs on tTreebank.
 Evaluate on hTreebank after each epoch
 Print out traindata performance every 'verbose' batches
+With resume, training continues from the last checkpoint in outdir (if there is one)
 '''
-def plain_train(optimizer, dataset, hyper_params, n_epochs, verbose=50,f=10, outdir='tmp'):
+def plain_train(optimizer, dataset, hyper_params, n_epochs, verbose=50,f=10, outdir='tmp', resume=False):
     batchsize = hyper_params['b_size']
     evals = defaultdict(list)
-    t_data = dataset['train'].get_examples()
+    # with the batched engine, minibatches are computed from a compiled forest of the training examples
+    engine = hyper_params.get('engine', 'node')
+    if engine == 'batched':
+        examples = forest = dataset['train'].compile()
+    else:
+        examples = dataset['train'].examples
+    # the training data are indices of examples, shuffled every epoch
+    t_data = range(len(examples))
+    start = 0
+    checkpoint = last_checkpoint(outdir) if resume else None
+    if checkpoint is not None:
+        start, t_data, evals = restore_checkpoint(optimizer, checkpoint)
+        print 'Resumed training from', checkpoint, 'at epoch', start
+    # with more than one worker, minibatches are split over processes that share theta
+    workers = hyper_params.get('workers', 1)
+    pool = None
+    if workers != 1:
+        pool = parallel.WorkerPool(optimizer.theta, examples, workers or None)
+        print 'Training with', pool.n_workers, 'worker processes'
 
-    for i in range(n_epochs):
+    for i in range(start, n_epochs):
         # store model parameters,
         # train f epochs and run an evaluation
         if i%f ==0: # every f epochs: store model parameters and do verbose evaluation
-            out_file = os.path.join(outdir, 'comparisonStartEpoch' + str(i * f) + '.theta.pik')
-            store_theta(optimizer.theta, out_file)
+            out_file = os.path.join(outdir, 'comparisonStartEpoch' + str(i) + '.theta.npz')
+            store_theta(optimizer.theta, out_file, optimizer=optimizer.get_state(), training=training_state(i, t_data, evals))
             for name, tb in dataset.iteritems():
                 print('Evaluation on ' + name + ' data')
                 tb.evaluate(optimizer.theta, verbose=1)
@@ -77,7 +139,12 @@ def plain_train(optimizer, dataset, hyper_params, n_epochs, verbose=50,f=10, out
         np_random.shuffle(t_data)  # randomly split the data into parts of batchsize
         for batch in xrange((len(t_data) + batchsize - 1) // batchsize):
             minibatch = t_data[batch * batchsize:(batch + 1) * batchsize]
-            error,grads = train_batch(optimizer.theta, minibatch, to_fix=hyper_params['to_fix'])
+            if pool is not None:
+                error, grads = pool.train_batch(minibatch, to_fix=hyper_params['to_fix'])
+            elif engine == 'batched':
+                error, grads = train_forest_batch(optimizer.theta, forest, minibatch, to_fix=hyper_params['to_fix'])
+            else:
+                error,grads = train_batch(optimizer.theta, [examples[j] for j in minibatch], to_fix=hyper_params['to_fix'])
             if verbose>0 and batch % verbose == 0:
                 print ('\tBatch '+str(batch)+', average error: '+str(error / len(minibatch))+', theta norm: '+str(optimizer.theta.norm()))
             optimizer.update(grads)
@@ -87,6 +154,46 @@ def plain_train(optimizer, dataset, hyper_params, n_epochs, verbose=50,f=10, out
             eval = dataset[kind].evaluate(optimizer.theta,n=5000, verbose = 0)
             print('\tEstimated ' + ', '.join(([kind + ' ' + metric + ': ' + str(round(value,5)) for (metric, value) in eval.iteritems()])))
             evals[kind].append(eval)
+    # worker processes are daemons, they are also stopped if training fails
+    if pool is not None: pool.close()
+    return evals
+
+'''
+Asynchronous (Hogwild) training for nEpochs epochs on tTreebank:
+worker processes train minibatches of their part of the shuffled training data
+and update the parameters in shared memory without locking.
+Evaluation and storage of the model as in plain_train
+'''
+def hogwild_train(optimizer, dataset, hyper_params, n_epochs, f=10, outdir='tmp'):
+    evals = defaultdict(list)
+    if hyper_params.get('engine', 'node') == 'batched':
+        t_data = dataset['train'].compile()
+    else:
+        t_data = dataset['train'].get_examples()
+    pool = parallel.AsynchronousPool(optimizer, t_data, hyper_params.get('workers', 1) or None,
+                                     b_size=hyper_params['b_size'], to_fix=hyper_params['to_fix'])
+    print 'Asynchronous training with', pool.n_workers, 'worker processes'
+    indices = range(len(t_data))
+
+    for i in range(n_epochs):
+        if i%f ==0: # every f epochs: store model parameters and do verbose evaluation
+            out_file = os.path.join(outdir, 'comparisonStartEpoch' + str(i) + '.theta.npz')
+            store_theta(optimizer.theta, out_file, optimizer=optimizer.get_state())
+            for name, tb in dataset.iteritems():
+                print('Evaluation on ' + name + ' data')
+                tb.evaluate(optimizer.theta, verbose=1)
+
+        print 'Epoch', i, '(' + str(len(indices)) + ' examples)'
+        np_random.shuffle(indices)
+        error = pool.train_epoch(indices)
+        print ('\tAverage error: '+str(error / len(indices))+', theta norm: '+str(optimizer.theta.norm()))
+        optimizer.regularize()
+
+        for kind in ['train','heldout']:
+            eval = dataset[kind].evaluate(optimizer.theta,n=5000, verbose = 0)
+            print('\tEstimated ' + ', '.join(([kind + ' ' + metric + ': ' + str(round(value,5)) for (metric, value) in eval.iteritems()])))
+            evals[kind].append(eval)
+    pool.close()
     return evals
 
 '''
@@ -106,3 +213,13 @@ def train_batch(theta, examples, to_fix):
             error += derror
     grads.remove_all(to_fix)
     return error, grads
+
+'''
+Train a (mini)batch of the networks in a compiled forest with the batched engine,
+gives the same error and gradients as train_batch on the same examples
+'''
+def train_forest_batch(theta, forest, indices, to_fix):
+    grads = theta.gradient()
+    error = forest.train(theta, grads, indices) if len(indices) > 0 else 0
+    grads.remove_all(to_fix)
+    return error, grads
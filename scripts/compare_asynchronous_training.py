@@ -0,0 +1,77 @@
+from __future__ import division
+
+from processing_arithmetics.treebased import data, myTheta, Optimizer
+from processing_arithmetics.treebased import training_routines as ctr
+from matplotlib import pyplot as plt
+import numpy as np
+import argparse
+import time
+import os
+
+'''
+Compare the convergence of asynchronous (Hogwild) training of a comparison model
+with plain (synchronous) minibatch training, starting from the same parameters
+on the same data4comparison split.
+'''
+
+optimizers = {'sgd': Optimizer.SGD, 'adagrad': Optimizer.Adagrad, 'adam': Optimizer.Adam}
+
+def main(args):
+    dataset = data.data4comparison(seed=args['seed'], comparisonLayer=args['comparison'], debug=args['debug'])
+    results = {}
+    for mode in ['synchronous', 'asynchronous']:
+        theta = myTheta.install_theta('', seed=args['seed'], d=(args['dim'], args['dword']), comparison=args['comparison'])
+        optimizer = optimizers[args['optimizer']](theta, lr=args['learning_rate'], lambda_l2=args['lambda'])
+        hyper_params = {'b_size': args['b_size'], 'engine': 'node', 'to_fix': [], 'workers': args['workers']}
+        out_dir = os.path.join(args['out_dir'], mode)
+        if not os.path.exists(out_dir): os.makedirs(out_dir)
+
+        print('\n' + mode.capitalize() + ' training')
+        np.random.seed(args['seed'])
+        start = time.time()
+        if mode == 'asynchronous':
+            evals = ctr.hogwild_train(optimizer, dataset, hyper_params, args['n_epochs'], f=args['n_epochs'], outdir=out_dir)
+        else:
+            evals = ctr.plain_train(optimizer, dataset, hyper_params, args['n_epochs'], verbose=0, f=args['n_epochs'], outdir=out_dir)
+        results[mode] = (time.time() - start, evals)
+
+    loss = [key for key in results['synchronous'][1]['heldout'][0] if 'loss' in key][0]
+    print('\nHeldout %s and accuracy per epoch' % loss)
+    print('%6s %12s %10s %12s %10s' % ('epoch', 'sync loss', 'sync acc', 'async loss', 'async acc'))
+    for i in xrange(args['n_epochs']):
+        sync, async = results['synchronous'][1]['heldout'][i], results['asynchronous'][1]['heldout'][i]
+        print('%6i %12.5f %10.4f %12.5f %10.4f' % (i, sync[loss], sync['accuracy'], async[loss], async['accuracy']))
+    for mode in ['synchronous', 'asynchronous']:
+        print('%s training took %.1fs' % (mode.capitalize(), results[mode][0]))
+
+    for mode in ['synchronous', 'asynchronous']:
+        plt.plot([e[loss] for e in results[mode][1]['heldout']], label=mode)
+    plt.xlabel('epoch')
+    plt.ylabel('heldout ' + loss)
+    plt.legend()
+    plt.savefig(os.path.join(args['out_dir'], 'asynchronousConvergence.png'))
+
+
+def mybool(string):
+    if string in ['F', 'f', 'false', 'False']: return False
+    elif string in ['T', 't', 'true', 'True']: return True
+    else: raise Exception('Not a valid choice for arg: '+string)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare asynchronous with synchronous training of a comparison model')
+    parser.add_argument('-debug','--debug',type=mybool, default=False, required=False)
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed to be used', required=False)
+    parser.add_argument('-o','--out_dir', type=str, help='Output dir to store models and the convergence plot', required=True)
+    parser.add_argument('-dc','--comparison', type=int, default=0, help='Dimensionality of comparison layer (0 is no layer)', required=False)
+    parser.add_argument('-d','--dim', type=int, default = 2, help='Dimensionality of internal representations', required=False)
+    parser.add_argument('-dw','--dword', type=int, default = 2, help='Dimensionality of word embeddings', required=False)
+    parser.add_argument('-opt', '--optimizer', type=str, default='sgd', choices=['sgd', 'adagrad', 'adam'], help='Optimization scheme', required=False)
+    parser.add_argument('-n','--n_epochs', type=int, default=10, help='Number of epochs', required=False)
+    parser.add_argument('-b','--b_size', type=int, default = 50, help='Batch size (of every worker in asynchronous training)', required=False)
+    parser.add_argument('-l','--lambda', type=float, default=0.0001, help='Regularization parameter lambda_l2', required=False)
+    parser.add_argument('-lr','--learning_rate', type=float, default=0.01, help='Learning rate parameter', required=False)
+    parser.add_argument('-w', '--workers', type=int, default=0, help='Number of worker processes (0 is one per core)', required=False)
+
+    args = vars(parser.parse_args())
+
+    main(args)
@@ -0,0 +1,27 @@
+from processing_arithmetics.treebased import myTheta
+import argparse
+import os
+
+'''
+Convert pickled treebased models (.theta.pik files written by earlier versions of the code)
+into checkpoints (.theta.npz), see myTheta.save_checkpoint.
+'''
+
+def main(args):
+    for theta_file in args['theta_files']:
+        out_file = (theta_file[:-len('.pik')] if theta_file.endswith('.pik') else theta_file) + '.npz'
+        if os.path.exists(out_file) and not args['overwrite']:
+            print('Skipped ' + theta_file + ', ' + out_file + ' exists')
+            continue
+        myTheta.convert_theta(theta_file, out_file)
+        print('Converted ' + theta_file + ' to ' + out_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert pickled treebased models into checkpoints')
+    parser.add_argument('theta_files', type=str, nargs='+', help='Files with pickled theta')
+    parser.add_argument('-f', '--overwrite', action='store_true', help='Overwrite existing checkpoints')
+
+    args = vars(parser.parse_args())
+
+    main(args)
@@ -38,6 +38,7 @@ parser.add_argument("--val_split", help="Set validation split", default=0.1)
 parser.add_argument("-maxlen", help="Set maximum number of digits in expression that network should be able to parse", type=max_length, default=max_length(15))
 parser.add_argument("--verbosity", type=int, choices=[0, 1, 2], default=2)
 parser.add_argument("--debug", action="store_true", help="Run with small treebank for debugging")
+parser.add_argument("--profile", action="store_true", help="Print time and memory used by the different phases of every run")
 parser.add_argument("--target_folder", help="Set folder to store models", default="")
 
 args = parser.parse_args()
@@ -93,6 +94,9 @@ for model in args.models:
 
     results_all[model[:-3]] = evaluation
 
+    if args.profile:
+        print(training.profiler.summary())
+
 
 # dump all results
 output_name = args.output_name or args.target_folder+format+'_'+layer_type+'_dc'+str(args.seed)+'.results'
@@ -0,0 +1,29 @@
+import argparse
+import json
+from processing_arithmetics.sequential.sweep import Sweep
+
+"""
+Run a hyperparameter sweep over the arguments of
+train_sequential_model.py. Rerun with the same output
+directory to resume an interrupted sweep.
+"""
+
+###################################################
+# Create argument parser
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-spec", required=True, help="JSON file with the specification of the sweep")
+parser.add_argument("--out_dir", required=True, help="Directory to write models and results to")
+parser.add_argument("--workers", type=int, help="Number of trials to run in parallel", default=1)
+parser.add_argument("--cache_dir", help="Directory to cache generated data, defaults to out_dir/cache")
+parser.add_argument("--test", action="store_true", help="Test models after training")
+
+args = parser.parse_args()
+
+with open(args.spec) as f:
+    spec = json.load(f)
+
+sweep = Sweep(spec, out_dir=args.out_dir, n_workers=args.workers, test=args.test, cache_dir=args.cache_dir)
+results = sweep.run()
+
+print("Finished %i trials, results written to %s/results.csv" % (len(results), args.out_dir))
@@ -48,6 +48,7 @@ parser.add_argument("--loss_weights", help="Dictionary with loss weights for seq
 parser.add_argument("--dropout", help="Set dropout fraction", default=0.0)
 parser.add_argument("-b", "--batch_size", help="Set batch size", default=24)
 parser.add_argument("--val_split", help="Set validation split", default=0.1)
+parser.add_argument("--patience", type=int, help="Stop training when validation loss did not improve for this many epochs")
 parser.add_argument("--test", action="store_true", help="Test model after training")
 
 parser.add_argument("-maxlen", help="Set maximum number of digits in expression that network should be able to parse", type=max_length, default=max_length(15))
@@ -61,6 +62,7 @@ parser.add_argument("-fix_recurrent_weights", action="store_true", help="Fix rec
 parser.add_argument("--remove", action="store_true", help="Remove stored model after training")
 parser.add_argument("--verbosity", "-v", type=int, choices=[0,1,2])
 parser.add_argument("--debug", action="store_true", help="Run with small treebank for debugging")
+parser.add_argument("--profile", action="store_true", help="Print time and memory used by the different phases of every run")
 parser.add_argument("--visualise_embeddings", action="store_true", help="Visualise embeddings after training")
 
 #######################################################
@@ -112,7 +114,8 @@ for seed in xrange(args.seed, args.seed+args.N):
             optimizer=args.optimizer, loss_functions=args.loss_function,
             epochs=args.nb_epochs, verbosity=args.verbosity, filename=save_to,
             save_every=False, visualise_embeddings=args.visualise_embeddings,
-            loss_weights=args.loss_weights)
+            loss_weights=args.loss_weights,
+            early_stopping={'monitor': 'loss', 'patience': args.patience} if args.patience else None)
 
     print("Save model")
     hist = training.trainings_history
@@ -128,6 +131,8 @@ for seed in xrange(args.seed, args.seed+args.N):
 
     if not args.test:
         os.remove(save_to+'.h5')
+        if args.profile:
+            print(training.profiler.summary())
         exit()
 
 
@@ -166,6 +171,10 @@ for seed in xrange(args.seed, args.seed+args.N):
 
     results_all[save_to] = results
 
+    if args.profile:
+        print(training.profiler.summary())
+        training.profiler.reset()
+
 eval_file.close
 
 pickle.dump(results_all, open(args.save_to+'.results', 'wb'))
@@ -1,9 +1,9 @@
 from __future__ import division
 
-from processing_arithmetics.tree_based import data, myTheta
+from processing_arithmetics.treebased import data, myTheta
 import pickle
-from processing_arithmetics.tree_based import training_routines as ctr
-from processing_arithmetics.tree_based import prediction_training as ptr
+from processing_arithmetics.treebased import training_routines as ctr
+from processing_arithmetics.treebased import prediction_training as ptr
 from processing_arithmetics.arithmetics import treebanks
 import argparse
 import os
@@ -13,15 +13,16 @@ def main(args):
     theta = myTheta.install_theta(args['pars_c'],seed=args['seed'],d=(args['dim'],args['dword']),comparison=args['comparison'])
 
     # generate training and heldout data for comparion training and train model
-    dataset_c = data.data4comparison(seed=args['seed'], comparisonLayer=args['comparison'],debug=args['debug'])
-    comparison_args={k[:-1]:v for (k,v) in args.iteritems() if k[-1]=='c'}
+    dataset_c = data.data4comparison(seed=args['seed'], comparisonLayer=args['comparison'],debug=args['debug'],
+                                     cache_dir=args['cache_dir'] or None)
+    comparison_args={k[:-1].rstrip('_').lower():v for (k,v) in args.iteritems() if k[-1] in 'cC'}
     comparison_args['out_dir']=args['out_dir']
     print('Comparison training:'+ str(comparison_args))
     ctr.train_comparison(comparison_args, theta, dataset_c)
 
     # generate training and heldout data for prediction training and train model
     dataset_p = data.data4prediction(theta, seed=args['seed'], debug=args['debug'])
-    prediction_args = {k[:-1]: v for (k, v) in args.iteritems() if k[-1] == 'p'}
+    prediction_args = {k[:-1].rstrip('_').lower(): v for (k, v) in args.iteritems() if k[-1] in 'pP'}
     prediction_args['out_dir'] = args['out_dir']
     print('Prediction training:' + str(prediction_args))
     ptr.train_prediction(prediction_args,dataset_p,'prediction')
@@ -38,7 +39,8 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed to be used', required=False)
     # storage:
     parser.add_argument('-o','--out_dir', type=str, help='Output dir to store models', required=True)
-    parser.add_argument('-pc','--pars_c', type=str, default='', help='Existing model file (TreeRNN)', required=False)
+    parser.add_argument('-cache','--cache_dir', type=str, default='', help='Dir to store compiled treebanks, reused in later runs', required=False)
+    parser.add_argument('-pc','--pars_c', type=str, default='', help='Existing model file (TreeRNN): checkpoint or pickled theta', required=False)
     parser.add_argument('-pp', '--pars_p', type=str, default='', help='Existing model file (Keras)', required=False)
     # network hyperparameters TreeRNN:
     parser.add_argument('-dc','--comparison', type=int, default=0, help='Dimensionality of comparison layer (0 is no layer)', required=False)
@@ -52,8 +54,12 @@ if __name__ == "__main__":
     parser.add_argument('-nc','--n_epochsC', type=int, default=100, help='Number of epochs for comparison training', required=False)
     parser.add_argument('-bc','--b_sizeC', type=int, default = 50, help='Batch size for comparison training', required=False)
     parser.add_argument('-f', '--storage_freqC', type=int, default=10, help='Model is evaluated and stored after every f epochs', required=False)
+    parser.add_argument('-rc', '--resumeC', type=mybool, default=False, help='Resume comparison training from the last model stored in out_dir', required=False)
     parser.add_argument('-lc','--lambda_c', type=float, default=0.0001, help='Regularization parameter lambda_l2', required=False)
     parser.add_argument('-lrc','--learningRateC', type=float, default=0.01, help='Learning rate parameter', required=False)
+    parser.add_argument('-ec', '--engineC', type=str, default='batched', choices=['node', 'batched'], help='Compute minibatches node by node or batched', required=False)
+    parser.add_argument('-wc', '--workersC', type=int, default=1, help='Number of processes that compute minibatches (0 is one per core)', required=False)
+    parser.add_argument('-ac', '--asynchronousC', type=mybool, default=False, help='Asynchronous (Hogwild) training with workersC processes', required=False)
 
     # training hyperparameters prediction:
     parser.add_argument('-np', '--n_epochsP', type=int, default=100, help='Number of epochs for prediction training',
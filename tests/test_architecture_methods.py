@@ -54,6 +54,170 @@ def test_training(architecture, data):
     os.remove('temp.h5')
 
 
+def test_early_stopping(architecture, data):
+    training_data = architecture.generate_training_data({'L1':5, 'L2':10})
+    validation_data = architecture.generate_training_data({'L3':10})
+
+    if os.path.exists('temp.h5'):
+        os.remove('temp.h5')
+    # no epoch improves the loss by min_delta, training stops after patience epochs
+    architecture.train(training_data, batch_size=2, epochs=5, filename='temp',
+                       validation_data=validation_data, optimizer='adam',
+                       early_stopping={'monitor': 'loss', 'patience': 1, 'min_delta': 1e10})
+
+    assert architecture.stopped_epoch == 1
+    assert len(architecture.trainings_history.val_losses['output']) == 2
+    os.remove('temp.h5')
+
+
+def test_training_history(architecture, data, tmpdir):
+    import json
+    training_data = architecture.generate_training_data({'L1':5, 'L2':5})
+    validation_data = architecture.generate_training_data({'L3':5})
+
+    log_file = str(tmpdir.join('history.log'))
+    architecture.train(training_data, batch_size=2, epochs=3, filename=None,
+                       validation_data=validation_data, optimizer='adam',
+                       history_options={'batch_metrics': True, 'log_file': log_file, 'esp_every': 2})
+
+    history = architecture.trainings_history
+    assert len(history.losses['output']) == 3
+    assert not np.any(np.isnan(history.val_losses['output']))
+    assert history.n_batches == 3 * int(np.ceil(len(training_data[0]['input']) / 2.0))
+    assert history.esp_epochs == [0, 2]
+
+    lines = [json.loads(line) for line in open(log_file)]
+    epochs = [line for line in lines if line['kind'] == 'epoch']
+    assert [line['epoch'] for line in epochs] == [0, 1, 2]
+    assert np.allclose([line['loss'] for line in epochs], history.losses['output'])
+    assert len([line for line in lines if line['kind'] == 'batch']) == history.n_batches
+
+
+def test_checkpoints(architecture, data, tmpdir):
+    from processing_arithmetics.sequential.checkpoints import CheckpointWriter
+    training_data = architecture.generate_training_data({'L1':5, 'L2':5})
+
+    filename = str(tmpdir.join('model'))
+    architecture.train(training_data, batch_size=2, epochs=4, filename=filename,
+                       validation_split=0.2, optimizer='adam', save_every=1,
+                       history_options={'keep_checkpoints': 2})
+
+    # only the last two checkpoints are kept, final model is saved at the end
+    assert sorted(os.listdir(str(tmpdir))) == ['model_2.h5', 'model_3.h5', 'model_4.h5']
+
+    writer = CheckpointWriter()
+    writer.save(architecture.model, filename + '.h5')
+    writer.close()
+    weights = architecture.model.get_weights()
+    architecture.model.set_weights([np.zeros_like(w) for w in weights])
+    architecture.model.load_weights(filename + '.h5')
+    assert all([np.array_equal(w1, w2) for w1, w2 in zip(weights, architecture.model.get_weights())])
+
+    with pytest.raises(IOError):
+        architecture.save_model(filename + '.h5', overwrite=False)
+
+    # without a filename no checkpoints are written
+    architecture.train(training_data, batch_size=2, epochs=2, filename=None,
+                       validation_split=0.2, optimizer='adam', save_every=1)
+    assert architecture.trainings_history.checkpoints is None
+
+
+def test_checkpoint_writer_errors(architecture, data, tmpdir):
+    import time
+    import threading
+    from processing_arithmetics.sequential.checkpoints import CheckpointWriter
+    filename = str(tmpdir.join('model'))
+
+    def gated(writer):
+        # writing waits until the gate is opened
+        gate, write = threading.Event(), writer._write
+        def gated_write(*snapshot):
+            gate.wait()
+            write(*snapshot)
+        writer._write = gated_write
+        return writer, gate
+
+    # when writing cannot keep up, save does not wait and the oldest waiting snapshots are dropped
+    writer, gate = gated(CheckpointWriter(max_pending=1))
+    writer.save(architecture.model, '%s_0.h5' % filename)
+    while writer.pending:
+        time.sleep(0.01)
+    for i in range(1, 4):
+        writer.save(architecture.model, '%s_%i.h5' % (filename, i))
+    gate.set()
+    writer.close()
+    assert writer.written == ['%s_0.h5' % filename, '%s_3.h5' % filename]
+    assert writer.dropped == 2
+
+    # with block, save waits for room and no snapshot is dropped
+    writer, gate = gated(CheckpointWriter(max_pending=1, block=True))
+    threading.Timer(0.2, gate.set).start()
+    for i in range(4):
+        writer.save(architecture.model, '%s_%i.h5' % (filename, i))
+    writer.close()
+    assert writer.written == ['%s_%i.h5' % (filename, i) for i in range(4)]
+    assert writer.dropped == 0
+
+    # an error in writing a checkpoint is raised in the training thread
+    writer = CheckpointWriter()
+    def failing_write(*snapshot):
+        raise IOError('disk full')
+    writer._write = failing_write
+    writer.save(architecture.model, filename + '.h5')
+    with pytest.raises(IOError):
+        writer.wait()
+    writer.save(architecture.model, filename + '.h5')
+    with pytest.raises(IOError):
+        writer.close()
+    assert not os.path.exists(filename + '.h5')
+
+
+@pytest.mark.parametrize('options, batches', [
+    ({'every': 2, 'max_snapshots': 3}, [6, 8, 10]),
+    ({'schedule': 'log', 'max_snapshots': 10}, [0, 1, 2, 3, 5, 8]),
+])
+def test_embedding_snapshots(architecture, data, tmpdir, options, batches):
+    from processing_arithmetics.sequential.callbacks import VisualiseEmbeddings
+    training_data = architecture.generate_training_data({'L1':5, 'L2':5})
+    options['filename'] = str(tmpdir.join('embeddings.npy'))
+
+    # keep the callbacks of training
+    callbacks = []
+    generate_callbacks = architecture.generate_callbacks
+    def keep_callbacks(*args, **kwargs):
+        callbacks.extend(generate_callbacks(*args, **kwargs))
+        return callbacks
+    architecture.generate_callbacks = keep_callbacks
+    architecture.train(training_data, batch_size=2, epochs=2, filename=None, validation_split=0.0,
+                       optimizer='adam', visualise_embeddings=options)
+
+    # 10 training examples, 5 batches per epoch
+    callback = [callback for callback in callbacks if isinstance(callback, VisualiseEmbeddings)][0]
+    assert list(callback.snapshot_batches) == batches
+    assert list(architecture.embeddings_anim.shape) == [len(batches), architecture.input_dim, 2]
+    if batches[-1] == 10:
+        assert np.array_equal(architecture.embeddings_anim[-1], architecture.model.layers[1].get_weights()[0])
+
+
+def test_profiling(architecture, data):
+    architecture.profiler.reset()
+    training_data = architecture.generate_training_data({'L1':5, 'L2':5})
+    architecture.train(training_data, batch_size=2, epochs=2, filename=None,
+                       validation_split=0.2, optimizer='adam')
+
+    report = architecture.profiler.report()
+    assert list(report)[0] == 'generate_training_data'
+    assert set(['treebank', 'data_from_treebank', 'pad_sequences', 'compile', 'fit']) <= set(report)
+    assert report['generate_training_data']['examples'] == 10
+    assert report['epoch']['calls'] == 2
+    # 8 of the 10 examples are used for training, 2 for validation
+    assert report['epoch']['examples'] == 16
+    assert report['fit']['examples'] == 16
+    assert report['compile']['rss_mb'] > 0 and report['compile']['process_peak_rss_mb'] > 0
+    assert report['fit']['wall'] >= report['epoch']['wall']
+    assert 'fit' in architecture.profiler.summary()
+
+
 def test_testing(architecture, data):
     languages = {'L1':10, 'L2':15, 'L3':20}
     test_data = architecture.generate_test_data(data=languages, digits=data['digits'], test_separately=True)
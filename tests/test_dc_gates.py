@@ -72,3 +72,19 @@ def test_testing(dc_gates_model, data):
 
     # test model testing
     dc_gates_model.test(test_data, metrics=['mse', 'mspe', 'binary_accuracy'])
+
+
+def test_gate_activations(architecture, data):
+    from processing_arithmetics.sequential.GRU_output_gates import gru_gates_reference
+    X, Y = architecture.generate_training_data({'L2': 5, 'L3': 5})
+    hl, z, r = architecture.get_gate_activations(X['input'])
+
+    # hidden layer activations equal those of the original model
+    assert np.allclose(hl, architecture.get_activations(X['input']), atol=1e-6)
+
+    # gate values equal the values computed off-graph
+    embeddings = architecture.model.layers[1].get_weights()[0]
+    recurrent_weights = architecture.model.layers[2].get_weights()
+    hl_ref, z_ref, r_ref = gru_gates_reference(embeddings[X['input']], recurrent_weights, mask=X['input'] != 0)
+    for values, reference in [(hl, hl_ref), (z, z_ref), (r, r_ref)]:
+        assert np.allclose(values, reference, atol=1e-5)
@@ -0,0 +1,36 @@
+import itertools as it
+import numpy as np
+from processing_arithmetics.sequential.embedding_analysis import pairwise_distances, pair_distances, \
+    embedding_norms, digit_ordering, embedding_statistics
+from processing_arithmetics.sequential.analyser import distance_embeddings, length_embeddings
+from processing_arithmetics.sequential.architectures import Training
+
+
+def test_pair_distances():
+    embeddings = np.random.RandomState(0).randn(12, 4)
+    distances = [np.sqrt(np.sum((row1 - row2) ** 2)) for row1, row2 in it.combinations(embeddings, 2)]
+    assert np.allclose(pair_distances(embeddings), distances)
+    assert np.allclose(np.diag(pairwise_distances(embeddings)), 0)
+    assert np.isclose(distance_embeddings(embeddings), np.mean(distances))
+    assert np.isclose(length_embeddings(embeddings), np.mean([np.linalg.norm(row) for row in embeddings]))
+
+
+def test_population_statistics():
+    population = np.random.RandomState(1).randn(5, 26, 3)
+    statistics = embedding_statistics(population)
+    for i, embeddings in enumerate(population):
+        single = embedding_statistics(embeddings)
+        for key in statistics:
+            assert np.isclose(statistics[key][i], single[key])
+    assert np.allclose(embedding_norms(population)[2], embedding_norms(population[2]))
+
+
+def test_digit_ordering():
+    dmap = Training._dmap(np.arange(-10, 11), ['+', '-'])
+    embeddings = np.random.RandomState(2).randn(len(dmap) + 1, 2)
+    # place digits on a line in numerical order
+    for digit in np.arange(-10, 11):
+        embeddings[dmap[str(digit)]] = [digit, 0.5 * digit]
+    ordering = digit_ordering(embeddings, dmap)
+    assert np.isclose(ordering['distance_correlation'], 1)
+    assert np.isclose(ordering['projection_correlation'], 1)
@@ -0,0 +1,89 @@
+import pytest
+import numpy as np
+from processing_arithmetics.arithmetics.MathTreebank import MathTreebank
+from processing_arithmetics.sequential.architectures import ScalarPrediction
+from processing_arithmetics.sequential.extraction import RaggedStore, extract_activations
+from keras.preprocessing.sequence import pad_sequences
+from keras.layers import GRU
+
+
+@pytest.fixture(scope='module')
+def architecture():
+    architecture = ScalarPrediction(digits=np.arange(-10, 11), operators=['+', '-'])
+    architecture.generate_model(recurrent_layer=GRU, input_length=20,
+                                input_size=2, size_hidden=3)
+    return architecture
+
+
+@pytest.fixture(scope='module')
+def treebank():
+    return MathTreebank({'L1': 5, 'L2': 5, 'L3': 5}, digits=np.arange(-10, 11))
+
+
+@pytest.mark.parametrize('gates', [False, True])
+def test_extract_activations(architecture, treebank, tmpdir, gates):
+    store = extract_activations(architecture, treebank, str(tmpdir.join('store')), batch_size=4, gates=gates)
+    store = RaggedStore(str(tmpdir.join('store')))
+
+    assert len(store) == len(treebank.examples)
+    lengths = [len(expression.to_string().split()) for expression, answer in treebank.examples]
+    assert list(store.lengths()) == lengths
+
+    # compare with activations of padded sequences computed at once
+    X = pad_sequences([[architecture.dmap[s] for s in expression.to_string().split()]
+                       for expression, answer in treebank.examples], maxlen=20)
+    hl, z, r = architecture.get_gate_activations(X)
+    for i, length in enumerate(lengths):
+        assert np.allclose(store.sequence('hidden', i), hl[i, -length:], atol=1e-6)
+        assert np.array_equal(store.sequence('inputs', i), X[i, -length:])
+        if gates:
+            assert np.allclose(store.sequence('update_gate', i), z[i, -length:], atol=1e-6)
+
+    # final hidden state equals the output of the recurrent layer
+    last = store.offsets[1:] - 1
+    assert np.allclose(store.values('hidden')[last], architecture.get_activations(X), atol=1e-6)
+
+    batches = list(store.iter_batches('hidden', batch_size=10))
+    assert np.array_equal(np.concatenate(batches), store.values('hidden'))
+
+
+def test_state_space(architecture, treebank, tmpdir):
+    from processing_arithmetics.sequential.statespace import StateSpace, state_space
+    from sklearn.decomposition import PCA
+
+    store = extract_activations(architecture, treebank, str(tmpdir.join('store')))
+    hidden = np.asarray(store.values('hidden'))
+    pca = PCA(n_components=2).fit(hidden)
+
+    # components are equal up to their sign, incremental pca approximates them
+    space = StateSpace(n_components=2, method='randomized').fit(store)
+    assert np.allclose(np.abs(space.components), np.abs(pca.components_), atol=1e-4)
+    space = StateSpace(n_components=2, method='incremental', batch_size=7).fit(store)
+    assert np.allclose(np.abs(space.components), np.abs(pca.components_), atol=0.05)
+
+    # projection is cached with the store
+    space = state_space(store, batch_size=7)
+    assert tmpdir.join('store', 'statespace_hidden_incremental_2.npz').check()
+    assert np.allclose(state_space(store).components, space.components)
+
+    projected = space.project_store(store)
+    assert np.allclose(projected, space.transform(hidden), atol=1e-5)
+    assert 'hidden_pc' in RaggedStore(str(tmpdir.join('store'))).names
+    assert np.allclose(space.trajectories(store, [3])[0], store.sequence('hidden_pc', 3), atol=1e-5)
+
+
+def test_state_space_cache(architecture, treebank, tmpdir):
+    from processing_arithmetics.sequential.statespace import state_space
+    from sklearn.decomposition import PCA
+    path = str(tmpdir.join('store'))
+    space = state_space(extract_activations(architecture, treebank, path), method='randomized')
+
+    # extracting the activations of another model into the same store removes the cached state space
+    other = ScalarPrediction(digits=np.arange(-10, 11), operators=['+', '-'])
+    other.generate_model(recurrent_layer=GRU, input_length=20, input_size=2, size_hidden=3)
+    store = extract_activations(other, treebank, path)
+    assert not tmpdir.join('store', 'statespace_hidden_randomized_2.npz').check()
+    other_space = state_space(store, method='randomized')
+    assert not np.allclose(np.abs(other_space.components), np.abs(space.components))
+    pca = PCA(n_components=2).fit(np.asarray(store.values('hidden')))
+    assert np.allclose(np.abs(other_space.components), np.abs(pca.components_), atol=1e-4)
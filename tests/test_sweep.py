@@ -0,0 +1,79 @@
+import pytest
+import os
+from processing_arithmetics.sequential.sweep import Sweep, grid_search, random_search
+from processing_arithmetics.sequential.checkpoints import load_optimizer_weights
+
+
+def test_grid_search():
+    configs = grid_search({'size_hidden': [10, 15], 'format': ['infix', 'prefix', 'postfix'], 'seed': 0})
+    assert len(configs) == 6
+    assert set([(c['size_hidden'], c['format']) for c in configs]) == \
+        set([(s, f) for s in [10, 15] for f in ['infix', 'prefix', 'postfix']])
+
+
+def test_random_search():
+    parameters = {'size_hidden': {'distribution': 'randint', 'low': 5, 'high': 20},
+                  'dropout': {'distribution': 'uniform', 'low': 0.0, 'high': 0.5},
+                  'optimizer': ['adam', 'sgd']}
+    configs = random_search(parameters, n_trials=10, seed=3)
+    assert len(configs) == 10
+    assert all([5 <= c['size_hidden'] <= 20 and 0.0 <= c['dropout'] <= 0.5 for c in configs])
+    assert configs == random_search(parameters, n_trials=10, seed=3)
+
+
+def test_sweep_resume(tmpdir):
+    spec = {'search': 'grid', 'parameters': {'recurrent_layer': ['SimpleRNN']},
+            'fixed': {'size_hidden': 3, 'nb_epochs': 1, 'debug': True, 'maxlen': 9}}
+    out_dir = str(tmpdir.join('sweep'))
+    results = Sweep(spec, out_dir=out_dir).run()
+    assert len(results) == 1
+    assert os.path.exists(os.path.join(out_dir, 'results.csv'))
+
+    # rerunning the sweep does not train finished trials again
+    os.remove(os.path.join(out_dir, 'models', 'trial0000.h5'))
+    Sweep(spec, out_dir=out_dir).run()
+    assert not os.path.exists(os.path.join(out_dir, 'models', 'trial0000.h5'))
+
+    # sweep with different specification cannot be resumed in same folder
+    spec['parameters']['recurrent_layer'] = ['GRU']
+    with pytest.raises(ValueError):
+        Sweep(spec, out_dir=out_dir)
+
+
+def test_parallel_sweep(tmpdir):
+    spec = {'search': 'grid', 'parameters': {'size_hidden': [2, 3, 4]},
+            'fixed': {'recurrent_layer': 'SimpleRNN', 'nb_epochs': 1, 'debug': True, 'maxlen': 9}}
+    serial = Sweep(spec, out_dir=str(tmpdir.join('serial'))).run()
+
+    # workers run several trials, which give the same results as trials in a fresh process
+    parallel = Sweep(spec, out_dir=str(tmpdir.join('parallel')), n_workers=2).run()
+    losses = dict([(r['trial_id'], r['loss']) for r in serial])
+    assert sorted(losses) == sorted([r['trial_id'] for r in parallel])
+    assert all([abs(r['loss'] - losses[r['trial_id']]) < 1e-6 for r in parallel])
+
+
+def test_successive_halving(tmpdir):
+    spec = {'search': 'grid', 'parameters': {'size_hidden': [2, 3, 4]},
+            'fixed': {'recurrent_layer': 'SimpleRNN', 'nb_epochs': 3, 'debug': True, 'maxlen': 9},
+            'pruning': {'min_epochs': 1, 'eta': 3, 'monitor': 'val_loss'}}
+    sweep = Sweep(spec, out_dir=str(tmpdir.join('sweep')))
+    assert sweep.budgets(min_epochs=1, eta=3) == [1, 3]
+
+    results = sweep.run()
+    assert len(results) == 3
+    assert sorted([r['epochs'] for r in results]) == [1, 1, 3]
+    assert sum([r.get('pruned', False) for r in results]) == 2
+
+    # the continued trial resumed with the optimizer state of its first rung (adam counts its updates)
+    continued = [r for r in results if r['epochs'] == 3][0]
+    assert continued['model_file'].endswith('_rung1.h5')
+    first_rung = continued['model_file'].replace('_rung1', '_rung0')
+    updates = load_optimizer_weights(first_rung)[0]
+    assert updates > 0 and load_optimizer_weights(continued['model_file'])[0] == 3 * updates
+
+    # a rung that is interrupted before its results are stored is trained again from the previous rung
+    os.remove(os.path.join(sweep.out_dir, 'trials', continued['trial_id'] + '.pik'))
+    os.remove(os.path.join(sweep.out_dir, 'trials', continued['trial_id'] + '_rung1.pik'))
+    results = Sweep(spec, out_dir=sweep.out_dir).run()
+    assert sorted([r['epochs'] for r in results]) == [1, 1, 3]
+    assert load_optimizer_weights(continued['model_file'])[0] == 3 * updates
@@ -1,7 +1,9 @@
 import pytest
 import numpy as np
 
-from processing_arithmetics.treebased import data, myTheta
+from processing_arithmetics.treebased import data, myTheta, batched, Optimizer, parallel, activation
+from processing_arithmetics.treebased.training_routines import train_batch, train_forest_batch, plain_train
+from processing_arithmetics.arithmetics import treebanks as arithmetics
 # from processing_arithmetics.sequential.architectures import ScalarPrediction, ComparisonTraining, DiagnosticClassifier, Seq2Seq, Training
 # from keras.layers import SimpleRNN
 import pickle
@@ -20,6 +22,35 @@ def test_model_storage():
     model = myTheta.install_theta(modelfile, 0, 2, 5)
     assert model[('comparison', 'M')].shape == (5, 4)
 
+@pytest.mark.parametrize('mmap_mode', [None, 'r', 'c'])
+def test_checkpoint(mmap_mode, tmpdir):
+    theta = myTheta.install_theta('', 0, [2,2], 5)
+    dataset = data.data4comparison(0, True, True)
+    optimizer = Optimizer.Adam(theta, lr=0.05)
+    optimizer.update(train_batch(theta, dataset['train'].examples[:3], to_fix=[])[1])
+    checkpoint = str(tmpdir.join('model.theta.npz'))
+    myTheta.save_checkpoint(theta, checkpoint, optimizer=optimizer.get_state())
+
+    loaded, states = myTheta.load_checkpoint(checkpoint, mmap_mode)
+    assert isinstance(loaded.flat, np.memmap) == (mmap_mode is not None)
+    assert loaded.dims == theta.dims and set(loaded.keys()) == set(theta.keys())
+    for name in theta.keys():
+        if name == ('word',):
+            assert loaded[name].voc == theta[name].voc and loaded[name].keys() == theta[name].keys()
+            for word in theta[name].keys():
+                assert np.array_equal(loaded[name][word], theta[name][word])
+        else:
+            assert np.array_equal(loaded[name], theta[name])
+    assert dataset['heldout'].evaluate(loaded, verbose=0) == dataset['heldout'].evaluate(theta, verbose=0)
+    assert states['optimizer']['t'] == 1 and np.array_equal(states['optimizer']['ms'], optimizer.ms.flat)
+
+    # a pickled theta is converted into a checkpoint, load_theta reads both
+    modelfile = str(tmpdir.join('model.theta.pik'))
+    with open(modelfile, 'wb') as f: pickle.dump(theta, f)
+    myTheta.convert_theta(modelfile, checkpoint)
+    for theta_file in modelfile, checkpoint:
+        assert np.array_equal(myTheta.load_theta(theta_file).pack().flat, theta.flat)
+
 def _numgr(nw, target, theta, item, itemgrad, epsilon = 0.0001):
     it = np.nditer(item, flags=['multi_index'])
     while not it.finished:
@@ -66,5 +97,295 @@ def test_gradient():
             numgradflat = np.append(numgradflat, ngr)
         assert np.linalg.norm(numgradflat - gradflat) / (np.linalg.norm(numgradflat) + np.linalg.norm(gradflat)) < 0.00001
 
+@pytest.mark.parametrize('comparison', [0, 5])
+def test_batched_gradient(comparison):
+    theta = myTheta.install_theta('', 0, [2,2], comparison)
+    dataset = data.data4comparison(0, comparison > 0, True)
+    examples = dataset['train'].examples
+    forest = dataset['train'].compile()
+    indices = [0, 3, 4, 7, 10, 11]
+
+    error, grads = train_batch(theta, [examples[i] for i in indices], to_fix=[])
+    batched_error, batched_grads = train_forest_batch(theta, forest, indices, to_fix=[])
+    assert np.isclose(error, batched_error)
+    assert set(grads.keys()) == set(batched_grads.keys())
+    for name in grads.keys():
+        if name == ('word',):
+            for word in set(grads[name].keys()) | set(batched_grads[name].keys()):
+                assert np.allclose(grads[name][word], batched_grads[name][word])
+        else:
+            assert np.allclose(grads[name], batched_grads[name])
+
+    assert forest.predict(theta, indices) == [examples[i][0].predict(theta) for i in indices]
+
+@pytest.mark.parametrize('nonlinearity', ['identity', 'tanh', 'ReLU', 'sigmoid', 'softmax'])
+def test_activation(nonlinearity):
+    z = np.array([[-2., -0.5, 0., 0.5, 3.], [1., 0., -1., 2., -3.]])
+    reference = {'identity': (z, np.ones_like(z)),
+                 'tanh': (np.tanh(z), 1 - np.square(np.tanh(z))),
+                 'ReLU': (np.maximum(z, 0) + 0.01 * np.minimum(z, 0), 1 * (z >= 0) + 0.01 * (z <= 0)),
+                 'sigmoid': (1 / (1 + np.exp(-z)), np.exp(-z) / np.square(1 + np.exp(-z))),
+                 'softmax': (np.exp(z) / np.sum(np.exp(z), axis=1, keepdims=True), np.ones_like(z))}[nonlinearity]
+    a = activation.apply(z, nonlinearity)
+    assert np.allclose(a, reference[0])
+    assert np.allclose(activation.derivative(a, nonlinearity), reference[1])
+    # vectors are activated as the rows of a matrix
+    assert np.allclose(activation.apply(z[1], nonlinearity), reference[0][1])
+    # in place
+    out = z.copy()
+    assert activation.apply(out, nonlinearity, out=out) is out
+    assert np.allclose(out, reference[0])
+
+def test_stable_softmax():
+    a = activation.apply(np.array([1000., 1000., -1000.]), 'softmax')
+    assert np.allclose(a, [0.5, 0.5, 0.])
+
+@pytest.mark.parametrize('comparison', [0, 5])
+def test_compiled_treebank(comparison, tmpdir):
+    dataset = data.data4comparison(0, comparison > 0, True, cache_dir=str(tmpdir))
+    treebank = dataset['train']
+    forest = treebank.compile()
+    assert 'examples' not in vars(treebank)
+    # compiling the expressions gives the same forest as compiling the networks
+    networks = batched.Forest([nw for nw, _ in treebank.examples], [target for _, target in treebank.examples])
+    for name in batched.Forest._arrays + ['targets']:
+        assert np.array_equal(getattr(forest, name), getattr(networks, name))
+    assert (forest.cats, forest.nonlins, forest.words, forest.labels) == \
+           (networks.cats, networks.nonlins, networks.words, networks.labels)
+
+    # the cached forest is used by a new treebank with the same examples
+    cached = data.data4comparison(0, comparison > 0, True, cache_dir=str(tmpdir))['train']
+    assert tmpdir.join('comparison_train_seed0' + ('_comparison' if comparison else '') + '_debug.forest.npz').check()
+    loaded = cached.compile()
+    for name in batched.Forest._arrays + ['targets']:
+        assert np.array_equal(getattr(loaded, name), getattr(forest, name))
+    assert (loaded.cats, loaded.words, loaded.labels) == (forest.cats, forest.words, forest.labels)
+    theta = myTheta.install_theta('', 0, [2,2], comparison)
+    assert np.allclose(loaded.forward(theta), forest.forward(theta))
+
+    # a cached forest of other expressions (with the same labels) is not used
+    items = list(treebank.items)
+    items[0] = (items[1][0], items[0][1], items[0][2])
+    changed = data.CompareClassifyTB(items, comparison=comparison > 0, cache=treebank.cache)
+    assert not changed.compiled(batched.Forest.load(treebank.cache))
+    recompiled = changed.compile()
+    expected = batched.Forest.from_comparisons(items, changed.labels, comparison > 0)
+    for name in batched.Forest._arrays:
+        assert np.array_equal(getattr(recompiled, name), getattr(expected, name))
+    assert batched.Forest.load(treebank.cache).source == changed.fingerprint() != treebank.fingerprint()
+
+def test_parameter_binding():
+    theta = myTheta.install_theta('', 0, [2,2], 0)
+    treebank = data.data4comparison(0, False, True)['train']
+    forest = treebank.compile()
+    nw, target = treebank.examples[0]
+    key = ('composition', 'dummy', '(#X#, #X#, #X#)', 'I', 'M')
+    assert theta.resolve(('composition', 'dummy', '(x, y, z)', 'I', 'M')) == ('composition', '#X#', '(#X#, #X#, #X#)', 'I', 'M')
+    with pytest.raises(KeyError):
+        theta.resolve(('composition', 'dummy', '(x, y)', 'I', 'M'))
+
+    activations = forest.forward(theta)
+    # in place changes are seen through the bound references, replacing a value changes the version of theta
+    version = theta.version
+    theta[('classify', 'B')] += 0
+    assert theta.version == version
+    theta[key] = theta[('composition', '#X#', '(#X#, #X#, #X#)', 'I', 'M')].copy()
+    assert theta.version > version
+    assert theta.resolve(('composition', 'dummy', '(x, y, z)', 'I', 'M')) == key
+    theta[key] *= 0
+    nw.forward(theta)
+    assert np.allclose(forest.forward(theta)[0], nw.a)
+    assert not np.allclose(forest.forward(theta), activations)
+
+@pytest.mark.parametrize('comparison', [0, 5])
+def test_evaluate(comparison, capsys):
+    theta = myTheta.install_theta('', 0, [2,2], comparison)
+    treebank = data.data4comparison(0, comparison > 0, True)['heldout']
+    errors = [nw.evaluate(theta, target) for nw, target in treebank.examples]
+    correct = [nw.predict(theta, activate=False) == target for nw, target in treebank.examples]
+    results = treebank.evaluate(theta, verbose=1)
+    assert np.isclose(results['loss (cross entropy)'], np.mean(errors))
+    assert np.isclose(results['accuracy'], np.mean(correct))
+    assert 'Confusion' in capsys.readouterr()[0]
+    # n larger than the treebank evaluates all examples
+    assert treebank.evaluate(theta, n=10 * len(treebank.items), verbose=0) == results
+    sample = treebank.evaluate(theta, n=5, verbose=0)
+    assert 0 <= sample['accuracy'] <= 1
+    assert treebank.answers().shape == (len(treebank.items), 2)
+
+def test_data4prediction(tmpdir):
+    theta = myTheta.install_theta('', 0, [2,2], 0)
+    dataset = data.data4prediction(theta, 0, debug=True)
+    for part in ['train', 'heldout']:
+        examples = data.RNNTB(arithmetics.treebank(0, kind=part, debug=True).examples).examples
+        assert np.allclose(dataset['X_' + part]['all'], [nw.activate(theta) for nw, _ in examples])
+        assert list(dataset['Y_' + part]['all']) == [target for _, target in examples]
+        assert list(dataset['strings_' + part]['all']) == [str(nw) for nw, _ in examples]
+    tests = dict(arithmetics.treebank(0, kind='test', debug=True))
+    assert sorted(dataset['X_test'].keys()) == sorted(tests.keys())
+    for lan, treebank in tests.items():
+        assert list(dataset['Y_test'][lan]) == [answer for _, answer in treebank.examples]
+
+    filename = str(tmpdir.join('data.npz'))
+    data.save_prediction_data(dataset, filename)
+    restored = data.load_prediction_data(filename)
+    assert sorted(restored.keys()) == sorted(dataset.keys())
+    for name in dataset:
+        for lan in dataset[name]:
+            assert np.array_equal(restored[name][lan], dataset[name][lan])
+
+def test_word_matrix():
+    words = myTheta.WordMatrix(['UNKNOWN', 'a', 'b', 'c'], default=('UNKNOWN', np.zeros(2)),
+                               dic_items=[('a', np.ones(2)), ('b', 2 * np.ones(2))])
+    assert words.matrix.shape == (4, 2)
+    assert np.array_equal(words['b'], words.matrix[words.row('b')])
+    # words outside the vocabulary use the default
+    words['d'] = np.array([3., 4.])
+    assert np.array_equal(words['UNKNOWN'], [3., 4.])
+    assert np.array_equal(words['e'], words['UNKNOWN'])
+    assert 'c' not in words
+
+    # sparse accumulation of rows, rows can repeat
+    words.add_rows(words.rows(['a', 'c', 'a']), np.ones((3, 2)))
+    assert np.array_equal(words['a'], [3., 3.])
+    assert np.array_equal(words['c'], [1., 1.])
+    rows, values = words.sparse()
+    assert sorted([words.words[row] for row in rows]) == ['UNKNOWN', 'a', 'b', 'c']
+    # with more rows than words they are summed per column
+    words.add_rows(words.rows(['a', 'b', 'a', 'a', 'b']), np.arange(10.).reshape(5, 2))
+    assert np.array_equal(words['a'], [3. + 10., 3. + 13.])
+    assert np.array_equal(words['b'], [2. + 10., 2. + 12.])
+
+    restored = pickle.loads(pickle.dumps(words))
+    assert np.array_equal(restored.matrix, words.matrix)
+    restored.extend_vocabulary(['f'])
+    assert np.array_equal(restored['f'], restored['UNKNOWN'])
+    assert restored.matrix.shape == (5, 2)
+
+@pytest.mark.parametrize('optimizer', ['SGD', 'Adagrad', 'Adam'])
+def test_packed_theta(optimizer):
+    theta = myTheta.install_theta('', 0, [2,2], 5)
+    unpacked = pickle.loads(pickle.dumps(theta))
+    dataset = data.data4comparison(0, True, True)
+
+    packed_optimizer = getattr(Optimizer, optimizer)(theta, lr=0.05)
+    unpacked_optimizer = getattr(Optimizer, optimizer)(unpacked, lr=0.05)
+    assert theta.flat is not None
+    for name in theta.keys():
+        if name != ('word',):
+            assert np.shares_memory(theta[name], theta.flat)
+
+    # compare vectorized updates with updates key by key
+    unpacked.unpack()
+    for i, to_fix in enumerate([[], ['word'], []]):
+        examples = dataset['train'].examples[3 * i:3 * i + 3]
+        _, grads = train_batch(theta, examples, to_fix=to_fix)
+        _, unpacked_grads = train_batch(unpacked, examples, to_fix=to_fix)
+        assert packed_optimizer.packed(grads, []) is not None
+        assert unpacked_optimizer.packed(unpacked_grads, []) is None
+        packed_optimizer.update(grads)
+        unpacked_optimizer.update(unpacked_grads)
+    for name in theta.keys():
+        if name == ('word',):
+            for word in theta[name].keys():
+                assert np.allclose(theta[name][word], unpacked[name][word])
+        else:
+            assert np.allclose(theta[name], unpacked[name])
+    assert np.isclose(theta.norm(), unpacked.norm())
+
+    # a packed theta is pickled like an unpacked theta
+    restored = pickle.loads(pickle.dumps(theta))
+    assert restored.flat is None
+    assert np.array_equal(restored[('classify', 'M')], theta[('classify', 'M')])
+
+@pytest.mark.parametrize('optimizer', ['Adagrad', 'Adam'])
+def test_optimizer_state(optimizer):
+    theta = myTheta.install_theta('', 0, [2,2], 5)
+    dataset = data.data4comparison(0, True, True)
+    examples = dataset['train'].examples
+    trained = getattr(Optimizer, optimizer)(theta, lr=0.05)
+    for i in range(2):
+        trained.update(train_batch(trained.theta, examples[3 * i:3 * i + 3], to_fix=[])[1])
+
+    # a fresh optimizer with a copy of theta and the stored state continues identically
+    resumed = getattr(Optimizer, optimizer)(pickle.loads(pickle.dumps(trained.theta)), lr=0.01)
+    resumed.set_state(trained.get_state())
+    assert resumed.lr == trained.lr
+    for opt in trained, resumed:
+        opt.update(train_batch(opt.theta, examples[6:9], to_fix=['word'])[1])
+        opt.regularize()
+    assert np.allclose(trained.theta.flat, resumed.theta.flat)
+    for name, state in trained._states():
+        assert np.array_equal(state.flat, getattr(resumed, name).flat)
+
+@pytest.mark.parametrize('engine', ['node', 'batched'])
+def test_parallel_gradient(engine):
+    theta = myTheta.install_theta('', 0, [2,2], 5)
+    dataset = data.data4comparison(0, True, True)
+    examples = dataset['train'].examples
+    optimizer = Optimizer.Adam(theta, lr=0.05)
+    pool = parallel.WorkerPool(theta, dataset['train'].compile() if engine == 'batched' else examples, 3)
+    try:
+        for indices in [[0, 3, 4, 7, 10, 11, 12], [1, 2]]:
+            error, grads = train_batch(theta, [examples[i] for i in indices], to_fix=['word'])
+            parallel_error, parallel_grads = pool.train_batch(indices, to_fix=['word'])
+            assert np.isclose(error, parallel_error)
+            assert set(grads.keys()) == set(parallel_grads.keys())
+            assert np.allclose(grads.flat, parallel_grads.flat)
+            assert np.array_equal(grads.mask(), parallel_grads.mask())
+            # workers use the parameters after the update
+            optimizer.update(parallel_grads)
+    finally:
+        pool.close()
+
+def test_asynchronous_training():
+    theta = myTheta.install_theta('', 0, [2,2], 0)
+    dataset = data.data4comparison(0, False, True)
+    examples = dataset['train'].examples
+    optimizer = Optimizer.Adagrad(theta, lr=0.05)
+    before = theta.flat.copy()
+    pool = parallel.AsynchronousPool(optimizer, examples, 2, b_size=2, to_fix=['word'])
+    try:
+        error = pool.train_epoch(range(len(examples)))
+    finally:
+        pool.close()
+    assert np.isfinite(error) and error > 0
+    # the updates of the workers are made in shared memory
+    changed = theta.flat != before
+    assert changed.any()
+    assert np.array_equal(changed, optimizer.histgrad.flat != 0)
+    assert not changed[theta.mask(exclude=[k[0] for k in theta.keys() if k[0] != 'word'])].any()
+
+def test_asynchronous_time_step():
+    theta = myTheta.install_theta('', 0, [2,2], 0)
+    examples = data.data4comparison(0, False, True)['train'].examples
+    optimizer = Optimizer.Adam(theta, lr=0.05)
+    # the time step of adam counts the updates of all workers, also in the stored state
+    with parallel.AsynchronousPool(optimizer, examples, 2, b_size=2) as pool:
+        for epoch in range(2):
+            pool.train_epoch(range(len(examples)))
+    n_updates = sum([int(np.ceil(len(shard) / 2.)) for shard in np.array_split(range(len(examples)), 2)])
+    assert optimizer.t == 2 * n_updates
+    assert optimizer.get_state()['t'] == 2 * n_updates
+
+@pytest.mark.parametrize('engine', ['node', 'batched'])
+def test_resume_training(engine, tmpdir):
+    dataset = data.data4comparison(0, False, True)
+    hyper_params = {'b_size': 4, 'engine': engine, 'to_fix': []}
+    tmpdir.mkdir('complete'), tmpdir.mkdir('interrupted')
+    runs = []
+    # the interrupted run stops after epoch 2 and is resumed from its last checkpoint
+    for outdir, n_epochs, resume in [('complete', 5, False), ('interrupted', 3, False), ('interrupted', 5, True)]:
+        theta = myTheta.install_theta('', 0, [2,2], 0)
+        optimizer = Optimizer.Adam(theta, lr=0.05)
+        np.random.seed(0)
+        evals = plain_train(optimizer, dataset, hyper_params, n_epochs, verbose=0, f=2, outdir=str(tmpdir.join(outdir)), resume=resume)
+        runs.append((theta.flat.copy(), optimizer.t, evals))
+    assert tmpdir.join('complete', 'comparisonStartEpoch4.theta.npz').check()
+    # training that is resumed from the checkpoint of epoch 2 ends as training without interruption
+    (complete, t, evals), (resumed, resumed_t, resumed_evals) = runs[0], runs[2]
+    assert np.array_equal(complete, resumed) and t == resumed_t
+    assert resumed_evals == evals and len(evals['heldout']) == 5
+
 if __name__ == '__main__':
     pytest.main([__file__])